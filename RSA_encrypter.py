@@ -1,16 +1,79 @@
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+from collections import OrderedDict
+import hashlib
 import os
+import struct
+import threading
+
+SESSION_KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+CHUNK_NONCE = struct.Struct("!4xQ")  # chunk number
+CHUNK_AAD = struct.Struct("!Q?")  # file offset, last chunk
+
+def key_fingerprint(pem_key):
+    if isinstance(pem_key, str):
+        pem_key = pem_key.encode('utf-8')
+    return hashlib.sha256(pem_key.strip()).hexdigest()
+
+class KeyCache:
+    # Bounded LRU of imported RSA keys and their ready PKCS1_OAEP ciphers, keyed by the
+    # key fingerprint, so a PEM key is parsed once rather than on every message.
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, pem_key):
+        fingerprint = key_fingerprint(pem_key)
+        with self._lock:
+            entry = self.entries.get(fingerprint)
+            if entry is not None:
+                self.entries.move_to_end(fingerprint)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # Parse outside the lock; two threads racing on the same key both end up with a valid entry
+        rsa_key = RSA.import_key(pem_key)
+        entry = (rsa_key, PKCS1_OAEP.new(rsa_key))
+        with self._lock:
+            self.entries[fingerprint] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def key(self, pem_key):
+        return self.get(pem_key)[0]
+
+    def cipher(self, pem_key):
+        return self.get(pem_key)[1]
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+# Shared by every protocol that encrypts or decrypts with RSA keys
+key_cache = KeyCache()
 
 def encrypt_message(public_key, message):
-    rsa_key = RSA.import_key(public_key)
-    cipher = PKCS1_OAEP.new(rsa_key)
+    cipher = key_cache.cipher(public_key)
     encrypted_message = cipher.encrypt(message.encode())
     return encrypted_message
 
 def decrypt_message(private_key, encrypted_message):
-    rsa_key = RSA.import_key(private_key)
-    cipher = PKCS1_OAEP.new(rsa_key)
+    cipher = key_cache.cipher(private_key)
     try:
         decrypted_message = cipher.decrypt(encrypted_message)
         return decrypted_message.decode()
@@ -18,6 +81,77 @@ def decrypt_message(private_key, encrypted_message):
         print("Error decrypting message:", e)
         return None
 
+class SessionCipher:
+    # AES-GCM for all messages of one peer session. Only the session key itself goes
+    # through RSA/OAEP, so messages can be of any size and cost no public-key operation.
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+    def encrypt(self, message):
+        if isinstance(message, str):
+            message = message.encode()
+        nonce = get_random_bytes(NONCE_SIZE)
+        cipher = AES.new(self.session_key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(message)
+        return nonce + tag + ciphertext
+
+    def decrypt(self, encrypted_message):
+        nonce = encrypted_message[:NONCE_SIZE]
+        tag = encrypted_message[NONCE_SIZE:NONCE_SIZE + TAG_SIZE]
+        cipher = AES.new(self.session_key, AES.MODE_GCM, nonce=nonce)
+        try:
+            return cipher.decrypt_and_verify(encrypted_message[NONCE_SIZE + TAG_SIZE:], tag)
+        except ValueError as e:
+            print("Error decrypting message:", e)
+            return None
+
+    def chunk_cipher(self, prefix):
+        # A key of its own for one file stream, derived from the session key and a
+        # random prefix sent along with the stream
+        return ChunkCipher(HKDF(self.session_key, SESSION_KEY_SIZE, prefix, SHA256, context=b"ChatApp file stream"))
+
+class ChunkCipher:
+    # STREAM-style AES-GCM for one file stream, as encrypter.py does for database files:
+    # chunk n is sealed under nonce n and its AAD binds the chunk's file offset and
+    # whether it is the last one, so chunks cannot be reordered, dropped or cut short
+    # without the receiver noticing. Both ends count the chunks they have sealed or
+    # opened, so each stream must be opened in the order it was sealed.
+    def __init__(self, key):
+        self.key = key
+        self.index = 0
+
+    def cipher(self):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=CHUNK_NONCE.pack(self.index))
+        self.index += 1
+        return cipher
+
+    def seal(self, data, offset, last):
+        cipher = self.cipher()
+        cipher.update(CHUNK_AAD.pack(offset, last))
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return tag + ciphertext
+
+    def open(self, sealed, offset, last):
+        cipher = self.cipher()
+        cipher.update(CHUNK_AAD.pack(offset, last))
+        try:
+            return cipher.decrypt_and_verify(sealed[TAG_SIZE:], sealed[:TAG_SIZE])
+        except ValueError as e:
+            print("Error decrypting file chunk:", e)
+            return None
+
+def new_session(public_key):
+    # Returns the sender's cipher and the session key wrapped for the recipient
+    session_key = get_random_bytes(SESSION_KEY_SIZE)
+    return SessionCipher(session_key), key_cache.cipher(public_key).encrypt(session_key)
+
+def open_session(private_key, wrapped_key):
+    cipher = key_cache.cipher(private_key)
+    try:
+        return SessionCipher(cipher.decrypt(wrapped_key))
+    except ValueError as e:
+        print("Error opening session:", e)
+        return None
 
 def gen_keys(seed):
     os.environ['PYTHONHASHSEED'] = seed
@@ -63,4 +197,11 @@ if __name__ == "__main__":
 
     print("Now, B decrypts the message from A")
     decrypted_message_by_B = decrypt_message(private_key_B, encrypted_message_for_B)
-    print("Message from A decrypted by B:", decrypted_message_by_B)
+    print("Message from A decrypted by B:", decrypted_message_by_B, "\n\n")
+
+    print("For longer conversations, A wraps a session key for B once")
+    session_A, wrapped_key = new_session(public_key_B)
+    session_B = open_session(private_key_B, wrapped_key)
+    long_message = "Every following message is sealed with AES-GCM. " * 20
+    decrypted_long_message = session_B.decrypt(session_A.encrypt(long_message)).decode()
+    print(f"B decrypted a {len(decrypted_long_message)} character message:", decrypted_long_message == long_message)
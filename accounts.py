@@ -0,0 +1,84 @@
+import hashlib
+import hmac
+import ipaddress
+import os
+import string
+import threading
+from twisted.internet import defer, threads
+
+ITERATIONS = 200000
+
+def reserved_name(name):
+    # Names that already reach someone: client addresses and public-key fingerprints
+    try:
+        ipaddress.ip_address(name)
+        return True
+    except ValueError:
+        return len(name) == 64 and all(c in string.hexdigits for c in name)
+
+def password_digest(password, salt, iterations=ITERATIONS):
+    return hashlib.pbkdf2_hmac("sha256", password.encode('utf-8'), salt, iterations)
+
+class Accounts:
+    # Names claimed with a password. The first /login with a name registers it; from
+    # then on only connections that give its password can go by it, and only they get
+    # what the message store keeps for it. Kept in the store when there is one, else for
+    # the life of the process. Passwords are hashed on a thread, PBKDF2 is slow on purpose.
+    # Workers sharing a store check every /login against it, so a name registered by
+    # one worker cannot be registered again by another, nor taken there with /nick.
+    def __init__(self, store=None, iterations=ITERATIONS):
+        self.store = store
+        self.iterations = iterations
+        self.accounts = store.accounts() if store else {}  # name -> (salt, digest)
+        self.claiming = set()  # names whose password is being checked, kept from /nick meanwhile
+        self.elsewhere = ()  # names connections on other workers go by, set by the worker bus
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.claiming or self.registered(name)
+
+    def registered(self, name):
+        # Looked up in the store when not known here: another worker may have registered it
+        if name in self.accounts:
+            return True
+        entry = self.store.account(name) if self.store else None
+        if entry is not None:
+            self.accounts[name] = entry
+        return entry is not None
+
+    def rename(self, registry, session, name):
+        # /nick: whether the session now goes by name, which must be free and unregistered
+        return (not reserved_name(name) and name not in self.elsewhere and name not in self
+                and registry.rename(session, name))
+
+    def login(self, registry, session, name, password):
+        # /login: fires with whether the session now goes by name, logged in to it. A name
+        # another worker's connection goes by is only had with its password.
+        if (reserved_name(name) or name in self.claiming or not registry.available(session, name, name)
+                or (name in self.elsewhere and not self.registered(name))):
+            return defer.succeed(False)
+        self.claiming.add(name)
+        d = threads.deferToThread(self.check, name, password)
+        d.addBoth(self.checked, name)
+        d.addCallback(lambda valid: valid and registry.rename(session, name, name))
+        return d
+
+    def checked(self, result, name):
+        self.claiming.discard(name)
+        return result
+
+    def check(self, name, password):
+        with self._lock:
+            entry = self.accounts.get(name)
+            if entry is None and self.store:
+                entry = self.store.account(name)
+            if entry is None:
+                salt = os.urandom(16)
+                new = (salt, password_digest(password, salt, self.iterations))
+                entry = self.store.register(name, *new) if self.store else new
+                if entry == new:
+                    self.accounts[name] = new
+                    return True
+            self.accounts[name] = entry
+        salt, digest = entry
+        return hmac.compare_digest(password_digest(password, salt, self.iterations), digest)
@@ -0,0 +1,51 @@
+import argparse
+import contextlib
+import io
+import time
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+
+import test
+from keystore import export_pair
+from RSA_encrypter import gen_keys
+from Crypto.PublicKey import RSA
+
+# Measures how many connections ChatFactory can accept per second. The "before" mode
+# reproduces the old behaviour of generating a fresh RSA key pair for every connection.
+
+class LegacyChatProtocol(test.ChatProtocol):
+    def __init__(self, factory):
+        super().__init__(factory)
+        self._keys = defer.succeed(gen_keys("benchmark"))
+
+class LegacyChatFactory(test.ChatFactory):
+    def buildProtocol(self, addr):
+        return LegacyChatProtocol(self)
+
+def accept_storm(factory, connections):
+    start = time.perf_counter()
+    for n in range(connections):
+        peer = IPv4Address('TCP', f"10.0.{n // 250}.{n % 250 + 1}", 40000 + n % 20000)
+        proto = factory.buildProtocol(peer)
+        proto.makeConnection(StringTransport(peerAddress=peer))
+        proto.connectionLost(None)
+    return connections / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="ChatFactory accepts/sec before and after the key pool")
+    parser.add_argument("--legacy", type=int, default=5, help="connections for the per-connection key run")
+    parser.add_argument("--connections", type=int, default=20000)
+    args = parser.parse_args()
+
+    identity = export_pair(RSA.generate(2048))
+    # Keep the per-connection console output out of the measurement
+    with contextlib.redirect_stdout(io.StringIO()):
+        before = accept_storm(LegacyChatFactory("127.0.0.1", 9000, identity), args.legacy)
+        after = accept_storm(test.ChatFactory("127.0.0.1", 9000, identity), args.connections)
+    print(f"before (gen_keys per connection): {before:10.1f} accepts/sec")
+    print(f"after  (shared identity + pool):  {after:10.1f} accepts/sec")
+    print(f"speedup: {after / before:.0f}x")
+
+if __name__ == "__main__":
+    main()
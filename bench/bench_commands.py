@@ -0,0 +1,72 @@
+import argparse
+import time
+
+from commands import chat_commands
+
+# Per-line dispatch overhead with the chat commands plus enough plugin commands to make
+# --commands in total: the command registry against the startswith chain the servers
+# used before, which decoded the whole line and tested the commands one by one before
+# splitting out the arguments and encoding the message again.
+
+class NullProtocol:
+    handled = 0
+
+    def handle(self, *args):
+        self.handled += 1
+
+def null_protocol(registry):
+    # A protocol whose every handler the registry names does nothing
+    handlers = {command.handler: NullProtocol.handle for command in registry if isinstance(command.handler, str)}
+    return type("Protocol", (NullProtocol,), handlers)()
+
+def registry_with(count):
+    registry = chat_commands()
+    for n in range(count - len(registry.commands)):
+        registry.add(f"/plugin{n}", "handle", [str], payload=True, usage=f"/plugin{n} <arg> <text>", help="plugin")
+    return registry
+
+def chain_dispatch(names, protocol, line):
+    # The old shape: decode, then one startswith per command until one matches
+    line = line.decode('utf-8')
+    for name in names:
+        if line.startswith(name):
+            parts = line.split(" ", 2)
+            protocol.handle(*[part.encode('utf-8') for part in parts[1:]])
+            return name
+    protocol.handle(line.encode('utf-8'))
+    return None
+
+def measure(dispatch, lines, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for line in lines:
+            dispatch(line)
+    return (time.perf_counter() - start) / (rounds * len(lines))
+
+def main():
+    parser = argparse.ArgumentParser(description="Dispatch cost per line, command registry against a startswith chain")
+    parser.add_argument("--commands", type=int, default=60)
+    parser.add_argument("--rounds", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=4096, help="message bytes in the payload lines")
+    args = parser.parse_args()
+
+    registry = registry_with(args.commands)
+    names = [command.name for command in registry]
+    protocol = null_protocol(registry)
+    body = b"x" * args.size
+    cases = {
+        "first command": b"/exit",
+        "last command": f"{names[-1]} arg short text".encode(),
+        "/send, payload": b"/send bob " + body,
+        "/nick": b"/nick alice",
+        "chat line": b"hello everyone, " + body,
+    }
+    print(f"{len(names)} commands registered, {args.size} byte payloads")
+    for case, line in cases.items():
+        registry_time = measure(lambda line: registry.dispatch(protocol, line), [line], args.rounds)
+        chain_time = measure(lambda line: chain_dispatch(names, protocol, line), [line], args.rounds)
+        print(f"{case:16} registry {registry_time * 1e9:8.0f} ns/line   chain {chain_time * 1e9:8.0f} ns/line   "
+              f"{chain_time / registry_time:5.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import argparse
+import random
+import time
+
+from twisted.internet.task import Clock
+
+import node
+from bench.common import CountingTransport, connect_clients
+from chatlog import logger
+from compression import CODECS, PREFERENCE, StreamSwitch
+from fanout import FanOut
+
+# What compression and batching do to the bytes a server sends, replayed on a chat
+# corpus (synthetic by default, or one message per line of --corpus).
+#
+# node: node.py's ChatFactory in process on a simulated clock. --clients clients are in
+#       one room and messages arrive at --rate per second (Poisson), each from one of
+#       them. Every client's stream is compressed on its own; client 0 decodes its stream
+#       to see when each message reaches it. Reported per message: bytes on the wire to
+#       all clients, writes per client, server CPU (reactor thread) and the client's
+#       decoding CPU, and the latency batching adds (simulated time, so CPU not counted).
+# test: test.py's per-message compression, applied before a message is encrypted and
+#       fanned out: the bytes of each message on its own (kept as it is when compressing
+#       does not make it smaller) and the CPU to compress and decompress it.
+
+WORDS = ("the a to and of I you it is that in for on was with me my we so but not have "
+         "be just like what do can this are if at all no yes ok okay lol haha thanks know "
+         "think get will one about good going out time now see then they really sure here "
+         "there when how today tomorrow meeting later lunch coffee build test deploy fixed "
+         "broken server client message room channel review merge branch release").split()
+NAMES = ("alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi")
+
+def synthetic_corpus(count, seed):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    corpus = []
+    for _ in range(count):
+        words = rng.choices(WORDS, weights, k=max(1, int(rng.expovariate(1 / 9))))
+        if rng.random() < 0.2:
+            words.insert(0, f"@{rng.choice(NAMES)}")
+        if rng.random() < 0.05:
+            words.append(f"https://example.com/{rng.getrandbits(40):x}")
+        corpus.append(" ".join(words).encode())
+    return corpus
+
+def load_corpus(args):
+    if args.corpus is None:
+        return synthetic_corpus(args.messages, args.seed)
+    with open(args.corpus, 'rb') as file:
+        corpus = [line.strip() for line in file if line.strip()]
+    return (corpus * (args.messages // len(corpus) + 1))[:args.messages]
+
+class DecodingTransport(CountingTransport):
+    # Client 0's connection: decodes what it gets and notes when each message arrives
+    clock = None
+
+    def __init__(self, peer):
+        super().__init__(peer)
+        self.switch = None
+        self.partial = b""
+        self.arrived = []
+        self.seconds = 0.0
+
+    def write(self, data):
+        super().write(data)
+        started = time.perf_counter()
+        data = self.switch.feed(data) if self.switch is not None else data
+        self.seconds += time.perf_counter() - started
+        lines = (self.partial + data).split(b"\r\n")
+        self.partial = lines.pop()
+        now = self.clock.seconds()
+        self.arrived.extend(now for line in lines if line.startswith(b"#bench "))
+
+    def writeSequence(self, seq):
+        self.write(b"".join(seq))
+
+def advance(clock, seconds):
+    # To clock.seconds() + seconds, stopping at each call due on the way, so held
+    # messages go out at the time they were due
+    target = clock.seconds() + seconds
+    while True:
+        due = min((call.getTime() for call in clock.getDelayedCalls()), default=target)
+        if due >= target:
+            break
+        clock.advance(max(0.0, due - clock.seconds()))
+    clock.advance(target - clock.seconds())
+
+def run_node(corpus, args, codec, batch):
+    clock = Clock()
+    DecodingTransport.clock = clock
+    factory = node.ChatFactory("127.0.0.1", 9000, compress=[codec] if codec else [], batch_ms=args.batch_ms)
+    factory.fanout = factory.rooms.fanout = factory.transfers.fanout = FanOut(clock=clock, delay=args.batch_ms / 1000)
+    made = []
+    def transport(peer):
+        made.append((CountingTransport if made else DecodingTransport)(peer))
+        return made[-1]
+    clients = connect_clients(factory, args.clients, transport)
+    observer = clients[0].transport
+    observer.switch = StreamSwitch(factory.compression.token(clients[0].session.conn_id), CODECS.get(codec))
+    options = ([f"compress={codec}"] if codec else []) + (["batch"] if batch else [])
+    for proto in clients:
+        if options:
+            proto.lineReceived(("/caps " + " ".join(options)).encode())
+        proto.lineReceived(b"/join #bench")
+    clock.advance(0)
+    advance(clock, 1)
+    transports = [proto.transport.transport if codec else proto.transport for proto in clients]
+    written = sum(transport.written for transport in transports)
+    writes = sum(transport.writes for transport in transports)
+
+    rng = random.Random(args.seed)
+    published = []
+    started = time.perf_counter()
+    for message in corpus:
+        advance(clock, rng.expovariate(args.rate))
+        published.append(clock.seconds())
+        rng.choice(clients).lineReceived(b"/msg #bench " + message)
+        clock.advance(0)
+    advance(clock, 1)
+    seconds = time.perf_counter() - started - observer.seconds
+
+    count = len(corpus)
+    latencies = sorted(arrived - sent for arrived, sent in zip(observer.arrived, published))
+    if len(latencies) != count:
+        print(f"  client 0 got {len(latencies)} of {count} messages")
+    return {
+        "bytes": (sum(transport.written for transport in transports) - written) / count,
+        "writes": (sum(transport.writes for transport in transports) - writes) / count / args.clients,
+        "server_us": seconds / count * 1e6,
+        "client_us": observer.seconds / count * 1e6,
+        "latency_ms": sum(latencies) / max(1, len(latencies)) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+def run_message(corpus, codec):
+    # test.py: each message compressed once (before it is sealed) and opened by each client
+    sizes = 0
+    pack_seconds = unpack_seconds = 0.0
+    for message in corpus:
+        started = time.perf_counter()
+        packed = codec.pack(message) if codec else message
+        pack_seconds += time.perf_counter() - started
+        if len(packed) >= len(message):
+            packed = None
+        if packed is not None:
+            started = time.perf_counter()
+            codec.unpack(packed, 1 << 16)
+            unpack_seconds += time.perf_counter() - started
+        sizes += len(packed if packed is not None else message)
+    count = len(corpus)
+    return sizes / count, pack_seconds / count * 1e6, unpack_seconds / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes, CPU and latency of compression and batching")
+    parser.add_argument("--corpus", help="file of chat messages, one per line (default: synthetic)")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=50, help="clients in the room (node)")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second to the room (node)")
+    parser.add_argument("--batch-ms", type=float, default=10)
+    parser.add_argument("--codecs", default=",".join(["none"] + [name for name in PREFERENCE if name in CODECS]))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logger.enabled = False
+
+    corpus = load_corpus(args)
+    raw = sum(len(message) for message in corpus) / len(corpus)
+    names = [name for name in args.codecs.split(",") if name == "none" or name in CODECS]
+    print(f"{len(corpus)} messages, {raw:.1f} bytes on average")
+
+    print(f"node: {args.clients} clients in one room, {args.rate:g} messages/sec, batching {args.batch_ms:g} ms")
+    print(f"  {'codec':10} {'batch':5} {'bytes/msg':>10} {'writes/msg':>10} {'server us':>10} "
+          f"{'client us':>10} {'added ms':>9} {'max ms':>7}")
+    for name in names:
+        for batch in (False, True):
+            result = run_node(corpus, args, None if name == "none" else name, batch)
+            print(f"  {name:10} {'yes' if batch else 'no':5} {result['bytes']:10.0f} {result['writes']:10.2f} "
+                  f"{result['server_us']:10.1f} {result['client_us']:10.2f} {result['latency_ms']:9.2f} "
+                  f"{result['max_ms']:7.2f}")
+
+    print("test: each message compressed on its own")
+    print(f"  {'codec':10} {'bytes/msg':>10} {'ratio':>6} {'pack us':>8} {'unpack us':>10}")
+    for name in names:
+        size, pack_us, unpack_us = run_message(corpus, CODECS.get(name))
+        print(f"  {name:10} {size:10.1f} {size / raw:6.2f} {pack_us:8.2f} {unpack_us:10.2f}")
+
+if __name__ == "__main__":
+    main()
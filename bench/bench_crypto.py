@@ -0,0 +1,125 @@
+import argparse
+import contextlib
+import io
+import subprocess
+import sys
+import time
+from twisted.internet import protocol, reactor
+
+import test
+from framing import FRAME_TEXT, FrameReceiver
+from keystore import KeyPool, export_pair
+from Crypto.PublicKey import RSA
+
+# Echo latency of a quiet client while another client floods encrypted /send messages
+# to users whose key pairs and sessions do not exist yet. Each of those needs an RSA key
+# pair from the pool (generated inline once the pool runs dry) and an RSA/OAEP key wrap.
+# With --threads 0 that crypto runs on the reactor thread, as it used to.
+
+class Client(FrameReceiver):
+    def __init__(self, name, connected):
+        self.name = name
+        self.onConnected = connected
+        self.sent_at = None
+        self.rtts = []
+
+    def connectionMade(self):
+        self.sendFrame(FRAME_TEXT, f"/nick {self.name}".encode())
+        self.onConnected(self)
+
+    def frameReceived(self, frame_type, flags, payload):
+        if self.sent_at is not None and bytes(payload) == b"No rooms yet":
+            self.rtts.append(time.perf_counter() - self.sent_at)
+            self.sent_at = None
+
+    def ping(self):
+        if self.sent_at is None:
+            self.sent_at = time.perf_counter()
+            self.sendFrame(FRAME_TEXT, b"/rooms")
+
+class ClientFactory(protocol.ClientFactory):
+    def __init__(self, name, connected):
+        self.name = name
+        self.onConnected = connected
+
+    def buildProtocol(self, addr):
+        return Client(self.name, self.onConnected)
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+def run(args):
+    identity = export_pair(RSA.generate(2048))
+    factory = test.ChatFactory("127.0.0.1", 0, identity, crypto_threads=args.threads)
+    factory.keyPool = KeyPool(args.pool, args.bits)
+    port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+    address = port.getHost()
+    clients = {}
+
+    def connected(client):
+        clients[client.name] = client
+        if len(clients) == args.recipients + 2:
+            reactor.callLater(1, start)
+
+    def connect(name):
+        reactor.connectTCP(address.host, address.port, ClientFactory(name, connected))
+
+    def ping():
+        clients["observer"].ping()
+        reactor.callLater(args.interval, ping)
+
+    def flood(n=0):
+        if n < args.messages:
+            clients["flooder"].sendFrame(FRAME_TEXT, f"/send r{n % args.recipients} message {n}".encode())
+            reactor.callLater(args.interval / 4, flood, n + 1)
+        else:
+            reactor.callLater(args.interval * 10, finish)
+
+    def start():
+        clients["observer"].rtts.clear()
+        ping()
+        reactor.callLater(args.interval * 10, flood)
+
+    def finish():
+        crypto = factory.crypto
+        if crypto.pending:
+            reactor.callLater(args.interval, finish)  # keep measuring until the crypto is done
+            return
+        rtts = clients["observer"].rtts
+        print(f"threads={args.threads:<2} echo p50 {percentile(rtts, 0.5) * 1000:8.2f} ms   "
+              f"p99 {percentile(rtts, 0.99) * 1000:8.2f} ms   max {max(rtts) * 1000:8.2f} ms   "
+              f"shed {crypto.shed}")
+        for operation, latency, runtime in crypto.stats():
+            print(f"  {operation:12} latency {latency.summary()}")
+            print(f"  {'':12} runtime {runtime.summary()}")
+        reactor.stop()
+
+    for name in ["observer", "flooder"] + [f"r{n}" for n in range(args.recipients)]:
+        connect(name)
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        reactor.run()
+    print("\n".join(line for line in output.getvalue().splitlines()
+                    if line.startswith(("threads=", "  "))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo latency while one client floods encrypted sends")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--recipients", type=int, default=12)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--pool", type=int, default=2, help="key pool size, small so it runs dry")
+    parser.add_argument("--bits", type=int, default=2048)
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between echo requests")
+    args = parser.parse_args()
+    if len(args.threads) == 1:
+        args.threads = args.threads[0]
+        run(args)
+        return
+    for threads in args.threads:
+        command = [sys.executable, "-m", "bench.bench_crypto", "--threads", str(threads),
+                   "--recipients", str(args.recipients), "--messages", str(args.messages),
+                   "--pool", str(args.pool), "--bits", str(args.bits), "--interval", str(args.interval)]
+        subprocess.run(command, check=True)
+
+if __name__ == "__main__":
+    main()
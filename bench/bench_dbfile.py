@@ -0,0 +1,81 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import encrypter
+
+# Throughput and peak memory of encrypting and decrypting a database file: the old
+# whole-file Fernet token against the chunked AES-GCM format. Every run happens in a
+# fresh process so each one reports its own peak RSS.
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def legacy_encrypt(source, destination):
+    with open(source, 'rb') as file:
+        data = file.read()
+    with open(destination, 'wb') as file:
+        file.write(encrypter.encrypt(data))
+
+def run(mode, source, destination, workers):
+    if mode == "legacy":
+        legacy_encrypt(source, destination)
+    elif mode == "encrypt":
+        encrypter.encrypt_file(source, destination, workers=workers)
+    elif mode == "decrypt":
+        if not encrypter.decrypt_file(source, destination, workers):
+            raise SystemExit("decryption failed")
+
+def measure(mode, source, destination, workers, size_mb):
+    command = [sys.executable, "-m", "bench.bench_dbfile", "--run", mode,
+               "--source", source, "--destination", destination, "--workers", str(workers)]
+    start = time.perf_counter()
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    elapsed = time.perf_counter() - start
+    label = f"{mode} ({workers} threads)" if mode != "legacy" else mode
+    print(f"{label:22} {size_mb / elapsed:9.1f} MB/sec   peak RSS {float(output):8.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Database file encryption throughput and peak memory")
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--legacy-max-mb", type=int, default=256,
+                        help="skip the whole-file Fernet run above this size, it needs several times the file in RAM")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    parser.add_argument("--destination", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run(args.run, args.source, args.destination, args.workers)
+        print(peak_rss_mb())
+        return
+
+    directory = tempfile.mkdtemp(prefix="bench-dbfile-")
+    plain = os.path.join(directory, "SQL")
+    sealed = os.path.join(directory, "SQL.encrypted")
+    opened = os.path.join(directory, "SQL.decrypted")
+    block = os.urandom(1 << 20)
+    with open(plain, 'wb') as file:
+        for _ in range(args.size_mb):
+            file.write(block)
+    print(f"{args.size_mb} MB file, {encrypter.CHUNK_SIZE >> 10} KB chunks")
+    try:
+        if args.size_mb <= args.legacy_max_mb:
+            measure("legacy", plain, sealed, 1, args.size_mb)
+        else:
+            print(f"{'legacy':22} skipped above {args.legacy_max_mb} MB")
+        for workers in sorted({1, args.workers}):
+            measure("encrypt", plain, sealed, workers, args.size_mb)
+            measure("decrypt", sealed, opened, workers, args.size_mb)
+    finally:
+        for path in (plain, sealed, opened):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import io
+import time
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.protocols import basic
+
+import node
+from fanout import FanOut
+
+# Broadcast fan-out to simulated clients through node.py's ChatProtocol, comparing the
+# old per-client decode/encode/sendLine loop with the FanOut engine. Latency is measured
+# from the broadcast call to the write reaching each client's transport.
+
+class RecordingTransport:
+    disconnecting = False
+
+    def __init__(self, peer, stamps, latencies):
+        self.peer = peer
+        self.stamps = stamps
+        self.latencies = latencies
+        self.producer = None
+        self.written = 0
+        self.writes = 0
+
+    def getPeer(self):
+        return self.peer
+
+    def write(self, data):
+        self.writeSequence([data])
+
+    def writeSequence(self, seq):
+        now = time.perf_counter()
+        self.writes += 1
+        for data in seq:
+            self.written += len(data)
+            stamp = self.stamps.get(data)
+            if stamp is not None:
+                self.latencies.append(now - stamp)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+class LegacyChatProtocol(node.ChatProtocol):
+    # node.py's ChatProtocol as it was before the fan-out engine
+    sendLine = basic.LineReceiver.sendLine
+
+    def broadcast(self, message):
+        message_str = message.decode('utf-8')
+        for client in self.factory.registry:
+            client.sendLine(message_str.encode('utf-8'))
+
+class LegacyChatFactory(node.ChatFactory):
+    def buildProtocol(self, addr):
+        return LegacyChatProtocol(self)
+
+def run(factory, clock, args):
+    stamps, latencies = {}, []
+    transports = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n in range(args.clients):
+            peer = IPv4Address('TCP', f"10.{n // 65536}.{n // 256 % 256}.{n % 256}", 40000)
+            proto = factory.buildProtocol(peer)
+            transport = RecordingTransport(peer, stamps, latencies)
+            proto.makeConnection(transport)
+            transports.append(transport)
+    if clock is not None:
+        clock.advance(0)
+        for transport in transports[:int(args.clients * args.slow)]:
+            transport.producer.pauseProducing()
+    del latencies[:]
+
+    sender = next(iter(factory.registry))
+    start = time.perf_counter()
+    for n in range(args.messages):
+        message = f"message {n} from the benchmark".encode('utf-8')
+        stamps[message + b"\r\n"] = time.perf_counter()
+        sender.broadcast(message)
+        if clock is not None and n % args.burst == args.burst - 1:
+            clock.advance(0)
+    if clock is not None:
+        clock.advance(0)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] * 1e3 if latencies else float('nan')
+    writes = sum(transport.writes for transport in transports)
+    return args.messages / elapsed, len(latencies) / elapsed, p99, writes
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast fan-out throughput and delivery latency")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=10, help="broadcasts per reactor iteration")
+    parser.add_argument("--slow", type=float, default=0.01, help="fraction of clients that stop reading")
+    parser.add_argument("--max-buffer", type=int, default=16 * 1024, help="bytes queued for a paused client")
+    args = parser.parse_args()
+
+    legacy = run(LegacyChatFactory("127.0.0.1", 9000), None, args)
+    factory = node.ChatFactory("127.0.0.1", 9000)
+    clock = Clock()
+    factory.fanout = FanOut(max_buffer=args.max_buffer, clock=clock)
+    engine = run(factory, clock, args)
+
+    print(f"{'':>8} {'broadcasts/s':>13} {'deliveries/s':>13} {'p99 ms':>9} {'writes':>9}")
+    print(f"{'legacy':>8} {legacy[0]:>13.1f} {legacy[1]:>13.1f} {legacy[2]:>9.3f} {legacy[3]:>9}")
+    print(f"{'fanout':>8} {engine[0]:>13.1f} {engine[1]:>13.1f} {engine[2]:>9.3f} {engine[3]:>9}")
+    print(f"slow consumers: {int(args.clients * args.slow)}, messages dropped for them: {factory.fanout.dropped}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import contextlib
+import io
+import os
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import basic
+
+import node
+
+# Starts several node.py ChatFactory nodes on localhost in one reactor, links them in a
+# full mesh with /connect, and measures one-hop /send latency, forwarded msgs/sec and
+# that a broadcast reaches every client of every node exactly once.
+
+class BenchClient(basic.LineReceiver):
+    def connectionMade(self):
+        self.factory.connected.callback(self)
+        self.received = []
+        self.waiting = None
+
+    def lineReceived(self, line):
+        self.received.append((time.perf_counter(), line))
+        if self.waiting and len(self.received) >= self.waiting[0]:
+            d, self.waiting = self.waiting[1], None
+            d.callback(self)
+
+    def waitFor(self, count):
+        d = defer.Deferred()
+        if len(self.received) >= count:
+            d.callback(self)
+        else:
+            self.waiting = (count, d)
+        return d
+
+def connect_client(port, address):
+    factory = protocol.ClientFactory()
+    factory.protocol = BenchClient
+    factory.connected = defer.Deferred()
+    reactor.connectTCP("127.0.0.1", port, factory, bindAddress=(address, 0))
+    return factory.connected
+
+@defer.inlineCallbacks
+def run(args):
+    factories, ports = [], []
+    key = os.urandom(32)
+    for n in range(args.nodes):
+        factory = node.ChatFactory("127.0.0.1", args.port + n, federation_key=key)
+        ports.append(reactor.listenTCP(args.port + n, factory, interface="127.0.0.1"))
+        factories.append(factory)
+    for a in range(args.nodes):
+        for b in range(a + 1, args.nodes):
+            factories[a].federation.connect("127.0.0.1", args.port + b)
+    clients = []
+    for n in range(args.nodes):
+        clients.append((yield connect_client(args.port + n, f"127.2.0.{n + 1}")))
+    yield task.deferLater(reactor, 0.5, lambda: None)
+    links = [len(factory.federation.links) for factory in factories]
+
+    sender, receiver = clients[0], clients[1]
+    base = len(receiver.received)
+    latencies = []
+    for n in range(args.pings):
+        start = time.perf_counter()
+        sender.sendLine(f"/send 127.2.0.2 ping {n}".encode())
+        yield receiver.waitFor(base + n + 1)
+        latencies.append(receiver.received[-1][0] - start)
+    latencies.sort()
+
+    base = len(receiver.received)
+    start = time.perf_counter()
+    for n in range(args.messages):
+        sender.sendLine(f"/send 127.2.0.2 bulk {n}".encode())
+    yield receiver.waitFor(base + args.messages)
+    rate = args.messages / (time.perf_counter() - start)
+
+    bases = [len(client.received) for client in clients]
+    sender.sendLine(b"/broadcast hello mesh")
+    yield task.deferLater(reactor, 0.5, lambda: None)
+    copies = [len(client.received) - b for client, b in zip(clients, bases)]
+    duplicates = sum(factory.federation.duplicates for factory in factories)
+
+    for port in ports:
+        yield port.stopListening()
+    return links, latencies, rate, copies, duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description="Federation hop latency and forwarding throughput")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--pings", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--port", type=int, default=9300)
+    args = parser.parse_args()
+
+    results = []
+    def done(result):
+        results.append(result)
+        reactor.stop()
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+    with contextlib.redirect_stdout(io.StringIO()):
+        reactor.callWhenRunning(lambda: run(args).addCallbacks(done, failed))
+        reactor.run()
+    if not results:
+        return
+    links, latencies, rate, copies, duplicates = results[0]
+    print(f"links per node: {links}")
+    print(f"one-hop /send latency: p50 {latencies[len(latencies) // 2] * 1e3:.3f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.3f} ms")
+    print(f"forwarded /send: {rate:.1f} msgs/sec")
+    print(f"broadcast copies per client: {copies} (duplicates suppressed: {duplicates})")
+
+if __name__ == "__main__":
+    main()
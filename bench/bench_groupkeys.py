@@ -0,0 +1,103 @@
+import argparse
+import time
+
+from Crypto.PublicKey import RSA
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+import test
+from bench.common import connect_clients
+from chatlog import logger
+from fanout import FanOut
+from keystore import export_pair
+from RSA_encrypter import encrypt_message
+
+# Cost of one encrypted message to a room of --sizes members on test.py's ChatFactory,
+# in process, with crypto inline and every client's key pair made up front (--key-pairs
+# of them, shared round robin). Compares:
+#   rsa       one RSA/OAEP encrypt_message per member, as messages used to be encrypted
+#             (cut to what fits in one OAEP block: 190 bytes with a 2048-bit key)
+#   session   one AES-GCM seal per member with its pairwise session, the /send path
+#   sender    /msg with sender keys: sealed once, the same bytes fanned out to all
+#   rekey     the first /msg after a member joined: a new sender key announced to every
+#             member over its session, then the message
+# Times are for the reactor thread, fan-out writes included.
+
+def make_factory(size, pairs):
+    factory = test.ChatFactory("127.0.0.1", 9000, pairs[0], crypto_threads=0)
+    clock = Clock()
+    factory.fanout = factory.rooms.fanout = factory.transfers.fanout = FanOut(clock=clock)
+    clients = connect_clients(factory, size + 1)
+    for n, proto in enumerate(clients):
+        proto._keys = defer.succeed(pairs[n % len(pairs)])
+    for proto in clients[:size]:
+        proto.lineReceived(b"/join #group")
+    clock.advance(0)
+    return factory, clock, clients
+
+def written(clients):
+    return sum(proto.transport.written for proto in clients)
+
+def timed(clients, clock, messages, send):
+    before = written(clients)
+    started = time.perf_counter()
+    for n in range(messages):
+        send(n)
+        clock.advance(0)
+    elapsed = time.perf_counter() - started
+    return elapsed / messages, (written(clients) - before) / messages
+
+def report(name, size, seconds, sent):
+    sent = f"{sent:10.0f} bytes sent/message" if sent is not None else "   (encrypted only, not sent)"
+    print(f"  {name:8} {seconds * 1e6:12.1f} us/message {seconds * 1e6 / size:9.2f} us/member {sent}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-recipient encryption vs sender keys for group messages")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated group sizes")
+    parser.add_argument("--messages", type=int, default=2000, help="sender-key messages per group size")
+    parser.add_argument("--size", type=int, default=100, help="message bytes")
+    parser.add_argument("--key-bits", type=int, default=2048)
+    parser.add_argument("--key-pairs", type=int, default=4)
+    args = parser.parse_args()
+    logger.enabled = False
+
+    pairs = [export_pair(RSA.generate(args.key_bits)) for _ in range(args.key_pairs)]
+    body = "x" * args.size
+    for size in map(int, args.sizes.split(",")):
+        factory, clock, clients = make_factory(size, pairs)
+        members, newcomer = clients[:size], clients[size]
+        sender = members[0]
+        # Warm up: every member's session and the sender's key are set up once
+        sender.lineReceived(f"/msg #group {body}".encode())
+        for proto in members:
+            proto.deliverEncrypted(body)
+        clock.advance(0)
+        print(f"{size} members, {args.size} byte messages")
+
+        keys = [proto._keys.result[1] for proto in members]
+        rsa_body = body[:args.key_bits // 8 - 42]
+        rsa_messages = max(2, 200 // size)
+        seconds, _ = timed(clients, clock, rsa_messages, lambda n: [encrypt_message(key, rsa_body) for key in keys])
+        report("rsa", size, seconds, None)
+
+        per_member = max(10, args.messages * 10 // size)
+        seconds, sent = timed(clients, clock, per_member,
+                              lambda n: [proto.deliverEncrypted(body) for proto in members])
+        report("session", size, seconds, sent)
+
+        line = f"/msg #group {body}".encode()
+        seconds, sent = timed(clients, clock, args.messages, lambda n: sender.lineReceived(line))
+        report("sender", size, seconds, sent)
+
+        def rekey(n):
+            # A member leaves and comes back, then the sender's next message needs a new key
+            newcomer.lineReceived(b"/join #group" if n % 2 == 0 else b"/leave #group")
+            sender.lineReceived(line)
+        rekeys = max(10, args.messages // size)
+        seconds, sent = timed(clients, clock, rekeys, rekey)
+        report("rekey", size, seconds, sent)
+        stats = factory.senderKeys
+        print(f"  sender keys: {stats.created} created, {stats.announced} announced, {stats.sealed} messages sealed")
+
+if __name__ == "__main__":
+    main()
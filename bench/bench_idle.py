@@ -0,0 +1,160 @@
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+# Memory held per idle connection. A server process (node.py's or test.py's factory)
+# accepts --connections localhost connections from client processes that connect and
+# then never send anything; the growth of the server's RSS divided by the number of
+# connections is the cost of one idle client. Exits with status 1 above --target.
+#
+# Each process can hold at most RLIMIT_NOFILE sockets, so the clients are spread over
+# several processes and source addresses (127.1.x.y, each with its own ephemeral ports),
+# and the server needs a hard limit above --connections; it is raised where allowed.
+
+def raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(wanted, soft), max(wanted, hard)))
+    except (ValueError, OSError):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+def rss_kb():
+    with open("/proc/self/status") as file:
+        return next(int(line.split()[1]) for line in file if line.startswith("VmRSS:"))
+
+def serve(args):
+    # Runs in the server process; answers each line on stdin with "<rss kB> <clients>"
+    from twisted.internet import reactor, stdio
+    from twisted.protocols import basic
+    from chatlog import logger
+    logger.enabled = False
+    limit = raise_fd_limit(args.connections + 100)
+    if args.target == "node":
+        import node
+        factory = node.ChatFactory("127.0.0.1", args.port, **factory_options(args))
+    else:
+        import test
+        from keystore import export_pair
+        from Crypto.PublicKey import RSA
+        factory = test.ChatFactory("127.0.0.1", args.port, export_pair(RSA.generate(1024)), **factory_options(args))
+    reactor.listenTCP(args.port, factory, backlog=4096, interface="127.0.0.1")
+
+    class Control(basic.LineReceiver):
+        delimiter = b"\n"
+
+        def lineReceived(self, line):
+            self.sendLine(f"{rss_kb()} {len(factory.registry)} {limit}".encode())
+
+        def connectionLost(self, reason):
+            reactor.stop()
+
+    stdio.StandardIO(Control())
+    reactor.run()
+
+def factory_options(args):
+    return {"idle_timeout": args.idle_timeout}
+
+def hold(args):
+    # Runs in a client process: opens its share of the connections and keeps them open
+    limit = raise_fd_limit(args.count + 100)
+    count = min(args.count, limit - 100)
+    sockets = []
+    for n in range(count):
+        sock = socket.socket()
+        sock.bind((f"127.1.{args.first // 250 + n // 250 % 250}.{n % 250 + 1}", 0))
+        sock.connect(("127.0.0.1", args.port))
+        sockets.append(sock)
+    print(len(sockets), flush=True)
+    sys.stdin.read()  # until the parent closes our stdin
+
+def control(server, command=""):
+    server.stdin.write(f"{command}\n".encode())
+    server.stdin.flush()
+    rss, clients, limit = server.stdout.readline().split()
+    return int(rss), int(clients), int(limit)
+
+def run(args):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    base = [sys.executable, "-m", "bench.bench_idle", "--target", args.target, "--port", str(port),
+            "--idle-timeout", str(args.idle_timeout)]
+    server = subprocess.Popen(base + ["--serve", "--connections", str(args.connections)],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    time.sleep(1)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except OSError:
+            time.sleep(0.2)
+    time.sleep(0.5)
+    before, _, limit = control(server)
+    wanted = min(args.connections, limit - 100)
+    if wanted < args.connections:
+        print(f"the server can hold {limit} files, measuring {wanted} connections instead of {args.connections}")
+
+    clients = []
+    per_process = args.per_process
+    started = time.perf_counter()
+    for first in range(0, wanted, per_process):
+        count = min(per_process, wanted - first)
+        clients.append(subprocess.Popen(base + ["--hold", "--count", str(count), "--first", str(first)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+    opened = sum(int(client.stdout.readline() or 0) for client in clients)
+    last = -1
+    while True:
+        after, connected, _ = control(server)
+        # With --idle-timeout the first connections may be reaped before the last arrive
+        if connected >= opened or connected == last:
+            break
+        last = connected
+        time.sleep(0.5)
+    elapsed = time.perf_counter() - started
+    time.sleep(1)
+    after, connected, _ = control(server)
+
+    per_connection = (after - before) * 1024 / max(connected, 1)
+    print(f"{args.target}: {connected} idle connections in {elapsed:.1f} s, server RSS {before / 1024:.1f} MB -> "
+          f"{after / 1024:.1f} MB, {per_connection:.0f} bytes per connection (target {args.target_bytes})")
+
+    if args.idle_timeout:
+        # Every connection is idle, so all of them should be gone a sweep after the timeout
+        time.sleep(args.idle_timeout * 1.25 + 1)
+        _, left, _ = control(server)
+        print(f"{connected - left} reaped after {args.idle_timeout:g} s idle, {left} left")
+
+    for client in clients:
+        client.stdin.close()
+        client.wait()
+    server.stdin.close()
+    server.wait()
+    return per_connection <= args.target_bytes
+
+def main():
+    parser = argparse.ArgumentParser(description="Server memory per idle connection")
+    parser.add_argument("--target", choices=("node", "test"), default="node")
+    parser.add_argument("--connections", type=int, default=100000)
+    parser.add_argument("--per-process", type=int, default=15000, help="connections per client process")
+    parser.add_argument("--target-bytes", type=int, default=2048, help="fail above this many bytes per connection")
+    parser.add_argument("--idle-timeout", type=float, default=0, help="also check that idle connections are reaped")
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--hold", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--count", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--first", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+    elif args.hold:
+        hold(args)
+    else:
+        sys.exit(0 if run(args) else 1)
+
+if __name__ == "__main__":
+    main()
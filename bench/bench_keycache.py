@@ -0,0 +1,40 @@
+import argparse
+import time
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from keystore import KeyPool
+from RSA_encrypter import KeyCache
+
+# Cost of turning a peer's PEM key into a ready OAEP cipher, parsing every time versus
+# going through the shared LRU cache, for a room of peers messaging round robin.
+
+def uncached(pem_key):
+    return PKCS1_OAEP.new(RSA.import_key(pem_key))
+
+def measure(lookup, keys, lookups):
+    start = time.perf_counter()
+    for n in range(lookups):
+        lookup(keys[n % len(keys)])
+    return lookups / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Parsed-key cache lookup throughput")
+    parser.add_argument("--peers", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    parser.add_argument("--bits", type=int, default=1024, help="key size, only affects setup time")
+    args = parser.parse_args()
+
+    pool = KeyPool(bits=args.bits)
+    public_keys = [pool.get()[1] for _ in range(args.peers)]
+    cache = KeyCache(args.cache_size)
+
+    parse = measure(uncached, public_keys, args.lookups)
+    cached = measure(cache.cipher, public_keys, args.lookups)
+    print(f"import_key every time: {parse:12.1f} lookups/sec")
+    print(f"KeyCache:              {cached:12.1f} lookups/sec ({cached / parse:.0f}x)")
+    print("cache stats:", cache.stats())
+
+if __name__ == "__main__":
+    main()
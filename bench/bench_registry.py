@@ -0,0 +1,59 @@
+import argparse
+import random
+import time
+
+from registry import ClientRegistry
+
+# Join/leave churn and lookup throughput of ClientRegistry with many registered sessions.
+# Users hold one to three connections each, every session has a key fingerprint and
+# sits in a couple of rooms.
+
+def rate(count, start):
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="ClientRegistry churn and lookup throughput")
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--operations", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    registry = ClientRegistry()
+
+    def connect(n):
+        session = registry.register(object(), f"user{n // 2}", f"fp{n}")
+        registry.join(session, f"#room{rng.randrange(args.rooms)}")
+        registry.join(session, f"#room{rng.randrange(args.rooms)}")
+        return session
+
+    start = time.perf_counter()
+    sessions = [connect(n) for n in range(args.sessions)]
+    print(f"register:        {rate(args.sessions, start):12.1f} sessions/sec "
+          f"({len(registry)} sessions, {len(registry.users)} users, {len(registry.rooms)} rooms)")
+
+    users = [f"user{rng.randrange(args.sessions // 2)}" for _ in range(args.operations)]
+    fingerprints = [f"fp{rng.randrange(args.sessions)}" for _ in range(args.operations)]
+    conn_ids = [rng.choice(sessions).conn_id for _ in range(args.operations)]
+    start = time.perf_counter()
+    for user in users:
+        registry.byUser(user)
+    print(f"lookup by user:  {rate(args.operations, start):12.1f} lookups/sec")
+    start = time.perf_counter()
+    for fingerprint in fingerprints:
+        registry.byFingerprint(fingerprint)
+    print(f"lookup by key:   {rate(args.operations, start):12.1f} lookups/sec")
+    start = time.perf_counter()
+    for conn_id in conn_ids:
+        registry.get(conn_id)
+    print(f"lookup by conn:  {rate(args.operations, start):12.1f} lookups/sec")
+
+    start = time.perf_counter()
+    for n in range(args.operations):
+        slot = rng.randrange(len(sessions))
+        registry.unregister(sessions[slot])
+        sessions[slot] = connect(args.sessions + n)
+    print(f"leave + join:    {rate(args.operations, start):12.1f} churn ops/sec ({len(registry)} sessions)")
+
+if __name__ == "__main__":
+    main()
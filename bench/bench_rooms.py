@@ -0,0 +1,65 @@
+import argparse
+import random
+import time
+
+from twisted.internet.task import Clock
+
+import node
+from bench.common import connect_clients
+from fanout import FanOut
+
+# 10k simulated clients spread over 1k rooms of node.py's ChatFactory. Compares /msg
+# through the room router with the same traffic sent as server-wide broadcasts, which
+# is what the server could do before it had rooms.
+
+def main():
+    parser = argparse.ArgumentParser(description="Room pub-sub delivery cost")
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--history", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    factory = node.ChatFactory("127.0.0.1", 9000, args.history)
+    clock = Clock()
+    factory.fanout = factory.rooms.fanout = FanOut(clock=clock)
+    clients = connect_clients(factory, args.clients)
+    start = time.perf_counter()
+    for proto in clients:
+        proto.lineReceived(f"/join #room{rng.randrange(args.rooms)}".encode())
+    clock.advance(0)
+    print(f"joins: {args.clients / (time.perf_counter() - start):.1f}/sec, "
+          f"{len(factory.rooms.rooms)} rooms, {args.clients / len(factory.rooms.rooms):.1f} members on average")
+
+    senders = [rng.choice(clients) for _ in range(args.messages)]
+    lines = [f"/msg {next(iter(proto.session.rooms))} hello room".encode() for proto in senders]
+    written = sum(proto.transport.written for proto in clients)
+    start = time.perf_counter()
+    for n, (proto, line) in enumerate(zip(senders, lines)):
+        proto.lineReceived(line)
+        if n % 10 == 9:
+            clock.advance(0)
+    clock.advance(0)
+    elapsed = time.perf_counter() - start
+    delivered = sum(proto.transport.written for proto in clients) - written
+    print(f"room /msg:  {args.messages / elapsed:12.1f} msgs/sec, {delivered / args.messages:10.0f} bytes delivered per message")
+
+    broadcasts = args.messages // 10
+    written = sum(proto.transport.written for proto in clients)
+    start = time.perf_counter()
+    for n in range(broadcasts):
+        senders[n].broadcast(b"#room hello room")
+        if n % 10 == 9:
+            clock.advance(0)
+    clock.advance(0)
+    elapsed = time.perf_counter() - start
+    delivered = sum(proto.transport.written for proto in clients) - written
+    print(f"broadcast:  {broadcasts / elapsed:12.1f} msgs/sec, {delivered / broadcasts:10.0f} bytes delivered per message")
+
+    busiest = max(factory.rooms.stats(), key=lambda room: room[2])
+    print(f"busiest room {busiest[0]}: {busiest[1]} members, {busiest[2]} messages")
+
+if __name__ == "__main__":
+    main()
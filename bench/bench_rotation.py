@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import encrypter
+
+# Online key rotation of the users table: how fast KeyRotation re-encrypts rows, and
+# what it does to the latency of lookups and inserts running at the same time.
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def live_queries(conn, rng, rows, until):
+    # Alternates an email lookup and a single-row insert until until() is true
+    latencies = []
+    n = 0
+    while not until():
+        started = time.perf_counter()
+        if n % 2:
+            encrypter.insert_users(conn, [(f"new {n}", f"new{n}@example.com")])
+        else:
+            encrypter.find_users_by_email(conn, f"user{rng.randrange(rows)}@example.com")
+        latencies.append(time.perf_counter() - started)
+        n += 1
+        time.sleep(0.001)
+    return latencies
+
+def report(label, latencies):
+    print(f"{label:28} p50 {percentile(latencies, 0.5) * 1000:7.3f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.3f} ms   ({len(latencies)} queries)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Online key rotation throughput and impact on live queries")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--duty", type=float, nargs="+", default=[0.2, 1.0])
+    parser.add_argument("--baseline-seconds", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-rotation-"), "SQL")
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    encrypter.setup_users(conn)
+    encrypter.insert_users(conn, ((f"user {n}", f"user{n}@example.com") for n in range(args.rows)))
+
+    deadline = time.perf_counter() + args.baseline_seconds
+    report("no rotation:", live_queries(conn, rng, args.rows, lambda: time.perf_counter() > deadline))
+    for duty in args.duty:
+        encrypter.add_key()
+        job = encrypter.KeyRotation(path, batch_size=args.batch_size, duty=duty)
+        started = time.perf_counter()
+        job.start()
+        latencies = live_queries(conn, rng, args.rows, lambda: job.done)
+        job.wait()
+        elapsed = time.perf_counter() - started
+        print(f"rotation, duty {duty:.2f}:       {job.rotated / elapsed:9.1f} rows/sec ({job.rotated} rows in {elapsed:.1f} s)")
+        report(f"during rotation, duty {duty:.2f}:", latencies)
+
+    # A crash: stop a job half way, start a new one and check it resumes from the checkpoint
+    encrypter.add_key()
+    job = encrypter.KeyRotation(path, batch_size=args.batch_size, duty=1.0)
+    job.start()
+    while job.scanned < args.rows // 2:
+        time.sleep(0.01)
+    job.stop()
+    resumed = encrypter.KeyRotation(path, batch_size=args.batch_size, duty=1.0)
+    resumed.start()
+    resumed.wait()
+    print(f"resume:                      stopped after {job.scanned} rows, resumed job scanned {resumed.scanned}")
+    conn.close()
+
+if __name__ == "__main__":
+    main()
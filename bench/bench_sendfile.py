@@ -0,0 +1,194 @@
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import basic
+
+from framing import FRAME_FILE_CHUNK, FRAME_FILE_END, FRAME_GROUP_MESSAGE, FRAME_TEXT, FrameReceiver, encode_frame
+
+# /sendfile throughput and what a transfer does to chat on the same connection. The
+# server (node.py's or test.py's factory) runs in its own process with a shared
+# directory holding a --size MB file. Three clients connect: a receiver, a sender that
+# asks for the file to be sent to the receiver, and a pinger that broadcasts a
+# chat line every --interval ms. The receiver counts the file bytes as they arrive (it
+# does not decrypt test.py's chunks) and measures how late each ping reaches it, first
+# for a few seconds with no transfer and then during the transfer. Pings arrive in the
+# order they were sent, so the n-th one received is matched with the n-th send time:
+# test.py's come as sender-key messages the receiver does not open, as in loadgen.py.
+# The run fails if no pings arrive.
+
+PING = b"ping "
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+def serve(args):
+    from chatlog import logger
+    logger.enabled = False
+    if args.target == "node":
+        import node
+        factory = node.ChatFactory("127.0.0.1", args.port, files_dir=args.files)
+    else:
+        import test
+        from keystore import export_pair
+        from Crypto.PublicKey import RSA
+        factory = test.ChatFactory("127.0.0.1", args.port, export_pair(RSA.generate(2048)), files_dir=args.files)
+    reactor.listenTCP(args.port, factory, interface="127.0.0.1")
+    print("ready", flush=True)
+    reactor.run()
+
+class Receiver:
+    def setup(self, bench):
+        self.bench = bench
+        self.bytes = 0
+        self.pings = 0
+        self.done = defer.Deferred()
+
+    def pingReceived(self):
+        sent = self.bench.sent
+        if self.pings < len(sent):
+            self.bench.latencies.append(time.monotonic() - sent[self.pings])
+        self.pings += 1
+
+class LineSink(Receiver, basic.LineReceiver):
+    def connectionMade(self):
+        self.sendLine(b"/nick receiver")
+
+    def lineReceived(self, line):
+        if line.startswith(b"/chunk "):
+            self.remaining = int(line.split()[2])
+            self.setRawMode()
+        elif line.startswith(b"/filedone "):
+            self.done.callback(None)
+        elif line.startswith(PING):
+            self.pingReceived()
+
+    def rawDataReceived(self, data):
+        chunk = min(len(data), self.remaining)
+        self.bytes += chunk
+        self.remaining -= chunk
+        if not self.remaining:
+            self.setLineMode(data[chunk:])
+
+class FrameSink(Receiver, FrameReceiver):
+    def connectionMade(self):
+        self.transport.write(encode_frame(FRAME_TEXT, b"/nick receiver"))
+
+    def frameReceived(self, frame_type, flags, payload):
+        if frame_type == FRAME_FILE_CHUNK:
+            self.bytes += len(payload)
+        elif frame_type == FRAME_FILE_END:
+            self.done.callback(None)
+        elif frame_type == FRAME_GROUP_MESSAGE:
+            self.pingReceived()
+
+class Client(protocol.Protocol):
+    # The sender and the pinger: they only write
+    target = "node"
+
+    def command(self, command):
+        if self.target == "node":
+            self.transport.write(command + b"\r\n")
+        else:
+            self.transport.write(encode_frame(FRAME_TEXT, command))
+
+class Bench:
+    def __init__(self, args, port):
+        self.args = args
+        self.port = port
+        self.sent = []
+        self.latencies = []
+
+    def connect(self, protocol_class):
+        return protocol.ClientCreator(reactor, protocol_class).connectTCP("127.0.0.1", self.port)
+
+    @defer.inlineCallbacks
+    def run(self):
+        Client.target = self.args.target
+        receiver = yield self.connect(LineSink if self.args.target == "node" else FrameSink)
+        receiver.setup(self)
+        sender = yield self.connect(Client)
+        pinger = yield self.connect(Client)
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        ping = task.LoopingCall(self.ping, pinger)
+        ping.start(self.args.interval / 1000)
+
+        yield task.deferLater(reactor, self.args.idle, lambda: None)
+        idle, self.latencies = self.latencies, []
+
+        started = time.perf_counter()
+        sender.command(b"/sendfile receiver bench.bin")
+        yield receiver.done
+        elapsed = time.perf_counter() - started
+        ping.stop()
+        busy = self.latencies
+
+        megabytes = receiver.bytes / 1e6
+        print(f"{self.args.target}: {megabytes:.0f} MB in {elapsed:.2f} s, {megabytes / elapsed:.0f} MB/sec "
+              f"(hashing the file first included)")
+        for name, samples in (("chat, no transfer", idle), ("chat during transfer", busy)):
+            print(f"  {name:22} {len(samples):5} pings   p50 {percentile(samples, 0.5) * 1000:7.2f} ms   "
+                  f"p99 {percentile(samples, 0.99) * 1000:7.2f} ms   max {max(samples or [0]) * 1000:7.2f} ms")
+        if not idle or not busy:
+            print("  no pings reached the receiver, the latencies measure nothing")
+            return False
+        return True
+
+    def ping(self, pinger):
+        self.sent.append(time.monotonic())
+        pinger.command(PING + str(len(self.sent)).encode())
+
+def write_file(path, megabytes):
+    block = os.urandom(1 << 20)
+    with open(path, 'wb') as file:
+        for _ in range(megabytes):
+            file.write(block)
+
+def main():
+    parser = argparse.ArgumentParser(description="/sendfile MB/sec and chat latency during a transfer")
+    parser.add_argument("--target", choices=("node", "test"), default="node")
+    parser.add_argument("--size", type=int, default=1024, help="file size in MB")
+    parser.add_argument("--interval", type=float, default=20, help="ms between chat pings")
+    parser.add_argument("--idle", type=float, default=3, help="seconds of pings before the transfer")
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--files", help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    directory = tempfile.mkdtemp(prefix="bench-sendfile-")
+    write_file(os.path.join(directory, "bench.bin"), args.size)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen([sys.executable, "-m", "bench.bench_sendfile", "--serve", "--target", args.target,
+                               "--port", str(port), "--files", directory], stdout=subprocess.PIPE)
+    server.stdout.readline()
+
+    outcome = []
+
+    def finish(result):
+        outcome.append(result)
+        reactor.stop()
+        return result
+
+    try:
+        Bench(args, port).run().addBoth(finish)
+        reactor.run()
+    finally:
+        server.kill()
+        shutil.rmtree(directory)
+    if outcome != [True]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import time
+
+from Crypto.PublicKey import RSA
+from keystore import export_pair
+from RSA_encrypter import decrypt_message, encrypt_message, new_session, open_session
+
+# Compares the old path (PKCS1_OAEP over the message, split into OAEP sized blocks once
+# it no longer fits into one) with RSA wrapped AES-GCM sessions.
+
+OAEP_BLOCK = 190  # leaves room for multi-byte characters under the 214 byte limit
+SIZES = [64, 1024, 16 * 1024, 256 * 1024, 1024 * 1024]
+
+def oaep_round_trip(private_key, public_key, message):
+    blocks = [message[i:i + OAEP_BLOCK] for i in range(0, len(message), OAEP_BLOCK)]
+    return "".join(decrypt_message(private_key, encrypt_message(public_key, block)) for block in blocks)
+
+def session_round_trip(sender, receiver, message):
+    return receiver.decrypt(sender.encrypt(message))
+
+def measure(round_trip, size, budget):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        round_trip(size)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget:
+            return count / elapsed, count * size / elapsed / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="OAEP vs session encryption throughput")
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds per measurement")
+    parser.add_argument("--oaep-max", type=int, default=16 * 1024,
+                        help="largest size run on the OAEP path, which needs one RSA decrypt per 190 bytes")
+    args = parser.parse_args()
+
+    private_key, public_key = export_pair(RSA.generate(2048))
+    sender, wrapped_key = new_session(public_key)
+    receiver = open_session(private_key, wrapped_key)
+    messages = {size: "x" * size for size in SIZES}
+
+    print(f"{'size':>8} {'oaep msg/s':>12} {'oaep MB/s':>10} {'aes msg/s':>12} {'aes MB/s':>10}")
+    for size in SIZES:
+        message = messages[size]
+        session = measure(lambda _: session_round_trip(sender, receiver, message), size, args.budget)
+        if size <= args.oaep_max:
+            oaep = measure(lambda _: oaep_round_trip(private_key, public_key, message), size, args.budget)
+            print(f"{size:>8} {oaep[0]:>12.1f} {oaep[1]:>10.3f} {session[0]:>12.1f} {session[1]:>10.1f}")
+        else:
+            print(f"{size:>8} {'-':>12} {'-':>10} {session[0]:>12.1f} {session[1]:>10.1f}")
+
+if __name__ == "__main__":
+    main()
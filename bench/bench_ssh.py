@@ -0,0 +1,117 @@
+import argparse
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import paramiko
+
+from ssh_client import SSHChannel, SUBSYSTEM
+from ssh_server import ChatSubsystem, SSHServer
+
+# Messages/sec and latency of ssh_client's two ways to send: an exec request running
+# "echo <message>" per message (send_message), against the persistent "chat" subsystem
+# channel of SSHChannel, both one message at a time and pipelined. The server is a
+# local paramiko server in its own process that really runs the exec'd commands.
+#
+# An exec message counts as delivered when its command exited; a channel message when
+# the server's acknowledgement of it arrived.
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+class BenchServer(SSHServer):
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.execute, args=(channel, command), daemon=True).start()
+        return True
+
+    def execute(self, channel, command):
+        result = subprocess.run(command.decode('utf-8'), shell=True, capture_output=True)
+        channel.sendall(result.stdout)
+        channel.send_exit_status(result.returncode)
+        channel.close()
+
+def serve(args):
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    print(listener.getsockname()[1], flush=True)
+    while True:
+        sock, _ = listener.accept()
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler(SUBSYSTEM, ChatSubsystem, lambda subsystem, message: None)
+        transport.start_server(server=BenchServer())
+
+def exec_path(port, messages):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect("127.0.0.1", port=port, username="bench", password="bench", allow_agent=False, look_for_keys=False)
+    latencies = []
+    started = time.perf_counter()
+    for n in range(messages):
+        sent = time.perf_counter()
+        stdin, stdout, stderr = client.exec_command(f"echo 'message {n}'")
+        stdout.read()
+        stdout.channel.close()
+        latencies.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - started
+    client.close()
+    return elapsed, latencies
+
+def channel_path(port, messages, size, window):
+    # A fresh channel numbers its messages from 1
+    sent_at = [0.0] * (messages + 1)
+    latencies = []
+    acked = [0]
+
+    def on_ack(seq):
+        now = time.perf_counter()
+        for n in range(acked[0] + 1, seq + 1):
+            latencies.append(now - sent_at[n])
+        acked[0] = max(acked[0], seq)
+
+    channel = SSHChannel("127.0.0.1", port, "bench", "bench", on_ack=on_ack, window=window).start()
+    body = b"x" * size
+    started = time.perf_counter()
+    for n in range(1, messages + 1):
+        sent_at[n] = time.perf_counter()
+        channel.send(body)
+        if window == 1:
+            channel.flush()
+    channel.flush()
+    elapsed = time.perf_counter() - started
+    channel.close()
+    return elapsed, latencies
+
+def report(name, messages, elapsed, latencies):
+    print(f"{name:24} {messages / elapsed:9.0f} msgs/sec   p50 {percentile(latencies, 0.5) * 1000:7.2f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="SSH messages/sec and latency, exec per message against one persistent channel")
+    parser.add_argument("--messages", type=int, default=20000, help="messages over the persistent channel")
+    parser.add_argument("--exec-messages", type=int, default=300, help="messages sent with exec requests")
+    parser.add_argument("--size", type=int, default=100, help="message bytes")
+    parser.add_argument("--window", type=int, default=1024, help="unacknowledged messages when pipelining")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    server = subprocess.Popen([sys.executable, "-m", "bench.bench_ssh", "--serve"], stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    try:
+        report("exec per message", args.exec_messages, *exec_path(port, args.exec_messages))
+        report("channel, one at a time", args.exec_messages, *channel_path(port, args.exec_messages, args.size, 1))
+        report("channel, pipelined", args.messages, *channel_path(port, args.messages, args.size, args.window))
+    finally:
+        server.kill()
+
+if __name__ == "__main__":
+    main()
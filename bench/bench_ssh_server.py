@@ -0,0 +1,103 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ssh_client import SSHChannel
+
+# Handshake rate and message throughput of ssh_server.SSHChatServer in front of a node
+# ChatFactory, with --clients concurrent localhost SSH clients. Every client connects
+# (key exchange, password authentication, the "chat" subsystem channel), picks a
+# nickname and then sends --messages "/send <partner> ..." lines to another client,
+# pipelined. Sent counts a message once the server acknowledged it; delivered once
+# the partner received it through the registry and the fan-out.
+
+def serve(args):
+    from twisted.internet import reactor
+    from chatlog import logger
+    from node import ChatFactory
+    from ssh_server import SSHChatServer
+    logger.enabled = False
+    resource.setrlimit(resource.RLIMIT_NOFILE, (resource.getrlimit(resource.RLIMIT_NOFILE)[1],) * 2)
+    factory = ChatFactory("127.0.0.1", 0)
+    factory.doStart()
+    server = SSHChatServer(factory, "127.0.0.1", 0, args.host_key, args.clients + 16).start()
+    print(server.port, flush=True)
+    reactor.run()
+
+class Client:
+    def __init__(self, port, number):
+        self.number = number
+        self.delivered = 0
+        self.channel = SSHChannel("127.0.0.1", port, f"user{number}", "bench", on_message=self.received)
+
+    def received(self, message):
+        self.delivered += message.count(b"bench ")
+
+def main():
+    parser = argparse.ArgumentParser(description="SSH chat server handshakes/sec and msgs/sec with concurrent clients")
+    parser.add_argument("--clients", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=200, help="messages per client")
+    parser.add_argument("--concurrency", type=int, default=32, help="clients connecting at the same time")
+    parser.add_argument("--size", type=int, default=100, help="message bytes")
+    parser.add_argument("--host-key", help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    host_key = os.path.join(tempfile.mkdtemp(prefix="bench-ssh-"), "ssh_host_key")
+    server = subprocess.Popen([sys.executable, "-m", "bench.bench_ssh_server", "--serve", "--clients", str(args.clients),
+                               "--host-key", host_key], stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    try:
+        clients = [Client(port, n) for n in range(args.clients)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(lambda client: client.channel.start(), clients))
+        elapsed = time.perf_counter() - started
+        print(f"{args.clients} clients connected in {elapsed:.2f} s, {args.clients / elapsed:.0f} handshakes/sec "
+              f"({args.concurrency} at a time)")
+
+        for client in clients:
+            client.channel.send(f"/nick user{client.number}")
+        for client in clients:
+            client.channel.flush()
+        time.sleep(0.5)
+
+        body = "x" * args.size
+        total = args.clients * args.messages
+
+        def send(client):
+            partner = f"user{client.number ^ 1 if client.number ^ 1 < args.clients else client.number}"
+            for n in range(args.messages):
+                client.channel.send(f"/send {partner} bench {n} {body}")
+            client.channel.flush()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=send, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sent = time.perf_counter() - started
+        deadline = time.monotonic() + 60
+        while sum(client.delivered for client in clients) < total and time.monotonic() < deadline:
+            time.sleep(0.05)
+        delivered_elapsed = time.perf_counter() - started
+        delivered = sum(client.delivered for client in clients)
+        print(f"{total} messages sent in {sent:.2f} s, {total / sent:.0f} msgs/sec acknowledged; "
+              f"{delivered} delivered in {delivered_elapsed:.2f} s, {delivered / delivered_elapsed:.0f} msgs/sec")
+        for client in clients:
+            client.channel.close()
+    finally:
+        server.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from message_store import MessageStore
+
+# Write throughput of MessageStore and the latency of paging through one user's history
+# once the table is large. Inserts are queued from this thread the way the reactor
+# queues them; the writer thread commits them in batches.
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description="MessageStore insert throughput and history paging latency")
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--db", help="database file, a temporary one by default")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-store-"), "messages.db")
+    store = MessageStore(path, args.batch_size)
+    store.start()
+
+    message = b"x" * 100
+    start = time.perf_counter()
+    for n in range(args.rows):
+        store.store(f"user{n % args.users}", f"user{rng.randrange(args.users)}", message, n % 10 != 0)
+    queued = time.perf_counter() - start
+    print(f"enqueue:         {args.rows / queued:12.1f} messages/sec (backlog {store.backlog()})")
+    store.stop()
+    elapsed = time.perf_counter() - start
+    print(f"insert:          {store.written / elapsed:12.1f} rows/sec "
+          f"({store.written} rows in {store.batches} transactions)")
+
+    for label, before in (("history page 1:", False), ("history page 2:", True)):
+        latencies = []
+        for _ in range(args.queries):
+            user = f"user{rng.randrange(args.users)}"
+            cursor = None
+            if before:
+                rows = store.fetchHistory(user)
+                cursor = (rows[-1][2], rows[-1][0]) if rows else None
+            query_start = time.perf_counter()
+            store.fetchHistory(user, cursor)
+            latencies.append(time.perf_counter() - query_start)
+        print(f"{label:16} p50 {percentile(latencies, 0.5) * 1000:7.3f} ms   "
+              f"p99 {percentile(latencies, 0.99) * 1000:7.3f} ms")
+
+    latencies = []
+    for _ in range(args.queries):
+        query_start = time.perf_counter()
+        store.fetchPending(f"user{rng.randrange(args.users)}")
+        latencies.append(time.perf_counter() - query_start)
+    print(f"pending fetch:   p50 {percentile(latencies, 0.5) * 1000:7.3f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.3f} ms")
+    if not args.db:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import os
+import random
+import resource
+import sqlite3
+import tempfile
+import time
+
+import encrypter
+
+# The encrypted users table at scale: bulk inserts, decrypting every row through the
+# lazy cursor, and finding a user by email through the blind index against decrypting
+# the table until the email turns up, which is the only option without the index.
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def scan_for(conn, email):
+    return [row for row in encrypter.iter_users(conn) if row[2] == email]
+
+def main():
+    parser = argparse.ArgumentParser(description="Encrypted users table throughput and email lookup latency")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--scans", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(prefix="bench-users-"), "SQL")
+    conn = sqlite3.connect(path)
+    encrypter.setup_users(conn)
+
+    start = time.perf_counter()
+    encrypter.insert_users(conn, ((f"user {n}", f"user{n}@example.com") for n in range(args.rows)))
+    print(f"insert:          {args.rows / (time.perf_counter() - start):12.1f} rows/sec")
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    count = sum(1 for _ in encrypter.iter_users(conn))
+    print(f"decrypt all:     {count / (time.perf_counter() - start):12.1f} rows/sec "
+          f"(peak RSS {rss:.1f} MB before, {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB after)")
+
+    latencies = []
+    for _ in range(args.lookups):
+        email = f"user{rng.randrange(args.rows)}@example.com"
+        query_start = time.perf_counter()
+        assert encrypter.find_users_by_email(conn, email)
+        latencies.append(time.perf_counter() - query_start)
+    print(f"blind index:     p50 {percentile(latencies, 0.5) * 1000:9.3f} ms   p99 {percentile(latencies, 0.99) * 1000:9.3f} ms")
+
+    latencies = []
+    for _ in range(args.scans):
+        email = f"user{rng.randrange(args.rows)}@example.com"
+        query_start = time.perf_counter()
+        assert scan_for(conn, email)
+        latencies.append(time.perf_counter() - query_start)
+    print(f"decrypt scan:    p50 {percentile(latencies, 0.5) * 1000:9.3f} ms   ({args.scans} scans)")
+    conn.close()
+    os.remove(path)
+
+if __name__ == "__main__":
+    main()
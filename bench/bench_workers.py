@@ -0,0 +1,108 @@
+import argparse
+import multiprocessing
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+# Load test for node.py --workers N. Client processes open connections from distinct
+# loopback addresses (clients are still keyed by IP) and stream pipelined
+# "/send <IP> <message>" lines to a partner connection, which usually lives on another
+# worker. The score is the number of routed messages clients receive per second.
+
+NODE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "node.py")
+
+def client_address(n):
+    return f"127.1.{n // 250}.{n % 250 + 1}"
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start listening on {port}")
+
+def client_process(port, first, count, total, warmup, duration, results):
+    selector = selectors.DefaultSelector()
+    outgoing = {}
+    for n in range(first, first + count):
+        sock = socket.create_connection(("127.0.0.1", port), source_address=(client_address(n), 0))
+        sock.setblocking(False)
+        partner = client_address((n + total // 2) % total)
+        outgoing[sock] = [f"/send {partner} hello from {n}\r\n".encode() * 64, 0]
+        selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    # Send from halfway through the warmup, once every worker has announced its clients
+    start = time.time() + warmup
+    send_from = start - warmup / 2
+    deadline = start + duration
+    received = 0
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        for key, events in selector.select(0.05):
+            sock = key.fileobj
+            if events & selectors.EVENT_READ:
+                try:
+                    data = sock.recv(262144)
+                except BlockingIOError:
+                    data = None
+                if data and now >= start:
+                    received += data.count(b"\n")
+            if events & selectors.EVENT_WRITE and now >= send_from:
+                batch, offset = outgoing[sock]
+                try:
+                    offset += sock.send(batch[offset:])
+                except BlockingIOError:
+                    pass
+                outgoing[sock][1] = offset % len(batch)
+    results.put(received)
+    for sock in outgoing:
+        sock.close()
+
+def run(workers, args):
+    server = subprocess.Popen([sys.executable, NODE, "--ip", "127.0.0.1", "--port", str(args.port),
+                               "--workers", str(workers)], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.port)
+        results = multiprocessing.Queue()
+        total = args.clients * args.connections
+        clients = [multiprocessing.Process(target=client_process,
+                                           args=(args.port, n * args.connections, args.connections,
+                                                 total, args.warmup, args.duration, results))
+                   for n in range(args.clients)]
+        for client in clients:
+            client.start()
+        received = sum(results.get() for _ in clients)
+        for client in clients:
+            client.join()
+        return received / args.duration
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-worker chat server load test")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--connections", type=int, default=50, help="connections per client process")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs available")
+    baseline = None
+    for workers in args.workers:
+        rate = run(workers, args)
+        baseline = baseline or rate
+        print(f"{workers:>3} workers: {rate:12.1f} msgs/sec  scaling {rate / baseline:5.2f}x of {workers}x ideal")
+
+if __name__ == "__main__":
+    main()
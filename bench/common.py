@@ -0,0 +1,55 @@
+import contextlib
+import io
+
+from twisted.internet.address import IPv4Address
+
+# Shared pieces for the in-process benchmarks: a transport that only counts what is
+# written to it, and a helper that connects many simulated clients to a factory.
+
+class CountingTransport:
+    disconnecting = False
+    connected = True
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.producer = None
+        self.written = 0
+        self.writes = 0
+
+    def getPeer(self):
+        return self.peer
+
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', 9000)
+
+    def write(self, data):
+        self.writes += 1
+        self.written += len(data)
+
+    def writeSequence(self, seq):
+        self.writes += 1
+        self.written += sum(len(data) for data in seq)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    abortConnection = loseConnection
+
+def client_address(n):
+    return f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}"
+
+def connect_clients(factory, count, transport_class=CountingTransport):
+    protocols = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n in range(count):
+            peer = IPv4Address('TCP', client_address(n), 40000 + n % 20000)
+            proto = factory.buildProtocol(peer)
+            proto.makeConnection(transport_class(peer))
+            protocols.append(proto)
+    return protocols
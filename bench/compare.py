@@ -0,0 +1,62 @@
+import argparse
+import json
+import sys
+
+# Compares two result files written by bench.loadgen --json, for example one from the
+# last release and one from a branch. Runs are matched by scenario, target, mode and
+# client count (the latest run of each wins), and any metric that got worse by more
+# than --threshold percent is reported as a regression; the exit status is 1 if any is.
+
+# (name, how to read it from a result, whether higher is better)
+METRICS = (
+    ("ops/sec", lambda result: result["ops_per_sec"], True),
+    ("p50 ms", lambda result: result["latency_ms"]["p50"], False),
+    ("p99 ms", lambda result: result["latency_ms"]["p99"], False),
+    ("p999 ms", lambda result: result["latency_ms"]["p999"], False),
+    ("cpu ms/op", lambda result: result["server"]["cpu_seconds"] * 1000 / max(result["operations"], 1), False),
+    ("rss MB", lambda result: result["server"]["peak_rss_mb"], False),
+)
+
+def load(path):
+    with open(path) as file:
+        results = json.load(file)
+    if isinstance(results, dict):
+        results = [results]
+    return {(result["scenario"], result["target"], result["mode"], result["params"]["clients"]): result
+            for result in results}
+
+def change(old, new):
+    if old == 0:
+        return 0.0 if new == 0 else float("inf")
+    return (new - old) / old * 100
+
+def compare(baseline, current, threshold):
+    regressions = 0
+    for key in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[key], current[key]
+        print(f"{key[0]} {key[1]}/{key[2]} {key[3]} clients ({old.get('commit')} -> {new.get('commit')})")
+        for name, read, higher_is_better in METRICS:
+            before, after = read(old), read(new)
+            percent = change(before, after)
+            worse = -percent if higher_is_better else percent
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {name:10} {before:12.3f} {after:12.3f} {percent:+8.1f}%{flag}")
+    for key in sorted(baseline.keys() ^ current.keys()):
+        print(f"{key[0]} {key[1]}/{key[2]} {key[3]} clients: only in {'baseline' if key in baseline else 'current'}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two bench.loadgen result files")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10, help="percent a metric may get worse")
+    args = parser.parse_args()
+    regressions = compare(load(args.baseline), load(args.current), args.threshold)
+    print(f"{regressions} regressions over {args.threshold:g}%")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,501 @@
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import basic
+
+from chatlog import logger
+from framing import FRAME_GROUP_MESSAGE, FRAME_SESSION_MESSAGE, FRAME_TEXT, FrameReceiver, encode_frame
+
+# Load generator for node.py and test.py. The server runs in this process (sharing the
+# reactor with the clients) or as a subprocess started the way an operator would start
+# it, and is driven over real TCP connections by simulated clients:
+#
+#   connect    - connect storm: every client connects at once (--concurrency in flight)
+#   send       - clients in pairs, /send to their partner at --rate messages per second
+#   broadcast  - one client broadcasts at --rate, every client receives each message
+#   large      - like send, with --size byte messages
+#   slow       - like broadcast, while --slow of the clients stop reading
+#
+# Latency is measured from the moment a message is written until it is read by the
+# receiver. Messages between two clients arrive in order, so the n-th message a client
+# reads is matched with the n-th one its source wrote; nothing has to be decrypted.
+# Every run is printed and, with --json, appended to a file for bench.compare.
+
+SCENARIOS = ("connect", "send", "broadcast", "large", "slow")
+MARKER = b"~b"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+class LoadClient:
+    # Shared by the line client (node.py) and the frame client (test.py)
+    def setup(self, run, number):
+        self.run = run
+        self.number = number
+        self.name = f"c{number}"
+        self.slow = False
+        self.source = None
+        self.sent_at = []
+        self.received = 0
+        self.started = None
+        self.welcomed = defer.Deferred()
+        self.named = defer.Deferred()
+
+    def connectionMade(self):
+        self.run.connected += 1
+
+    def connectionLost(self, reason):
+        self.run.disconnected += 1
+
+    def textReceived(self, text):
+        if not self.welcomed.called:
+            self.welcomed.callback(time.perf_counter() - self.started)
+        elif not self.named.called and text.startswith(b"You are now known as"):
+            self.named.callback(self)
+
+    def messageReceived(self):
+        source = self.source
+        if source is not None and self.received < len(source.sent_at):
+            self.run.delivered(self, time.perf_counter() - source.sent_at[self.received])
+        self.received += 1
+
+    def send(self, command):
+        self.sent_at.append(time.perf_counter())
+        self.command(command)
+
+class LineClient(LoadClient, basic.LineReceiver):
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def lineReceived(self, line):
+        if line.startswith(MARKER):
+            self.messageReceived()
+        else:
+            self.textReceived(line)
+
+    def command(self, command):
+        self.sendLine(command)
+
+class FrameClient(LoadClient, FrameReceiver):
+    def frameReceived(self, frame_type, flags, payload):
+        if frame_type in (FRAME_SESSION_MESSAGE, FRAME_GROUP_MESSAGE) or payload[:len(MARKER)] == MARKER:
+            self.messageReceived()
+        elif frame_type == FRAME_TEXT:
+            self.textReceived(bytes(payload))
+
+    def command(self, command):
+        self.transport.write(encode_frame(FRAME_TEXT, command))
+
+class LoadClientFactory(protocol.ClientFactory):
+    # done fires with (client, seconds from dialling to the welcome line), or with None
+    # when there is no welcome line within the timeout. A connection the server's full
+    # accept queue never took can look established to the client and wait forever.
+    def __init__(self, client_class, run, number, timeout):
+        self.client_class = client_class
+        self.run = run
+        self.number = number
+        self.client = None
+        self.started = time.perf_counter()
+        self.done = defer.Deferred()
+        self.timeout = reactor.callLater(timeout, self.giveUp)
+
+    def buildProtocol(self, addr):
+        self.client = self.client_class()
+        self.client.setup(self.run, self.number)
+        self.client.started = self.started
+        self.client.welcomed.addCallback(self.welcomed)
+        return self.client
+
+    def welcomed(self, latency):
+        self.timeout.cancel()
+        self.done.callback((self.client, latency))
+
+    def giveUp(self):
+        if self.client is not None:
+            self.client.transport.abortConnection()
+        self.failed()
+
+    def failed(self):
+        if not self.done.called:
+            if self.timeout.active():
+                self.timeout.cancel()
+            self.done.callback(None)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed()
+
+    def clientConnectionLost(self, connector, reason):
+        self.failed()
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+def process_usage(pid=None):
+    # (CPU seconds, peak RSS in MB) of this process, or of a server subprocess from /proc
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    with open(f"/proc/{pid}/status") as file:
+        peak = next(int(line.split()[1]) for line in file if line.startswith("VmHWM:"))
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, peak / 1024
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        return None
+
+class Server:
+    # The server under test and where its CPU and memory are read from
+    def __init__(self, args):
+        self.args = args
+        self.port = args.port or free_port()
+        self.process = None
+        self.directory = None
+        self.listening = None
+        self.factory = None
+
+    def start(self):
+        if self.args.mode == "inproc":
+            self.startInProcess()
+        else:
+            self.startProcess()
+        return self.waitForPort()
+
+    def startInProcess(self):
+        logger.enabled = False  # the server's log would share the terminal with the results
+        if self.args.target == "node":
+            import node
+            self.factory = node.ChatFactory("127.0.0.1", self.port)
+        else:
+            import test
+            from keystore import KeyPool, export_pair
+            from Crypto.PublicKey import RSA
+            identity = export_pair(RSA.generate(2048))
+            self.factory = test.ChatFactory("127.0.0.1", self.port, identity)
+            self.factory.keyPool = KeyPool(self.args.key_pool, self.args.key_bits)
+        self.listening = reactor.listenTCP(self.port, self.factory, backlog=self.args.backlog, interface="127.0.0.1")
+
+    def startProcess(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # Its own directory, so test.py creates a throwaway identity and message store;
+        # its own session, so the password prompt reads stdin rather than the terminal
+        self.directory = tempfile.mkdtemp(prefix="chat-loadgen-")
+        if self.args.target == "node":
+            command = [sys.executable, os.path.join(root, "node.py"), "--ip", "127.0.0.1", "--port", str(self.port)]
+            answers = b""
+        else:
+            command = [sys.executable, os.path.join(root, "test.py")]
+            answers = f"127.0.0.1\n{self.port}\n\n".encode()
+        self.process = subprocess.Popen(command, cwd=self.directory, stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                        start_new_session=True)
+        self.process.stdin.write(answers)
+        self.process.stdin.flush()  # stdin stays open, closing it would end the console
+
+    @defer.inlineCallbacks
+    def waitForPort(self):
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError(f"server exited with status {self.process.returncode}")
+            with socket.socket() as sock:
+                if sock.connect_ex(("127.0.0.1", self.port)) == 0:
+                    return
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        raise RuntimeError("server did not start listening")
+
+    def usage(self):
+        return process_usage(self.process.pid if self.process else None)
+
+    def stats(self):
+        # Counters only reachable when the server shares this process
+        if self.factory is None:
+            return {}
+        return {"fanout_dropped": self.factory.fanout.dropped, "fanout_written": self.factory.fanout.written}
+
+    def stop(self):
+        if self.listening is not None:
+            self.listening.stopListening()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process.stdin.close()
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                os.unlink(os.path.join(self.directory, name))
+            os.rmdir(self.directory)
+
+class LoadRun:
+    def __init__(self, args, server):
+        self.args = args
+        self.server = server
+        self.client_class = LineClient if args.target == "node" else FrameClient
+        self.clients = []
+        self.connected = 0
+        self.disconnected = 0
+        self.failed = 0
+        self.latencies = []
+        self.measuring = False
+        self.sent = 0
+
+    def delivered(self, client, latency):
+        if self.measuring and not client.slow:
+            self.latencies.append(latency)
+
+    def connectOne(self, number):
+        factory = LoadClientFactory(self.client_class, self, number, self.args.connect_timeout)
+        reactor.connectTCP("127.0.0.1", self.server.port, factory, timeout=self.args.connect_timeout)
+        return factory.done
+
+    @defer.inlineCallbacks
+    def connectAll(self):
+        # At most --concurrency connections are being set up at any time
+        results = []
+        numbers = iter(range(self.args.clients))
+
+        @defer.inlineCallbacks
+        def worker():
+            for number in numbers:
+                result = yield self.connectOne(number)
+                if result is None:
+                    self.failed += 1
+                else:
+                    results.append(result)
+
+        yield defer.gatherResults([worker() for _ in range(self.args.concurrency)])
+        self.clients = [client for client, latency in sorted(results, key=lambda result: result[0].number)]
+        return [latency for client, latency in results]
+
+    def waitFor(self, condition, timeout=60):
+        done = defer.Deferred()
+        deadline = time.monotonic() + timeout
+
+        def check():
+            if condition():
+                loop.stop()
+                done.callback(None)
+            elif time.monotonic() > deadline:
+                loop.stop()
+                done.errback(RuntimeError("timed out"))
+
+        loop = task.LoopingCall(check)
+        loop.start(0.01)
+        return done
+
+    @defer.inlineCallbacks
+    def name(self):
+        for client in self.clients:
+            client.command(f"/nick {client.name}".encode())
+        yield defer.gatherResults([client.named for client in self.clients])
+
+    def payload(self, size):
+        return MARKER + b"x" * max(0, size - len(MARKER))
+
+    def pairs(self):
+        clients = self.clients[:len(self.clients) // 2 * 2]
+        for a, b in zip(clients[::2], clients[1::2]):
+            a.source, b.source = b, a
+        return [(client, f"/send {client.source.name} ".encode()) for client in clients]
+
+    def fanout(self):
+        broadcaster = self.clients[0]
+        for client in self.clients:
+            client.source = broadcaster
+        return [(broadcaster, b"/broadcast ")]
+
+    def expected(self):
+        return sum(len(client.source.sent_at) for client in self.clients if client.source and not client.slow)
+
+    def received(self):
+        return sum(min(client.received, len(client.source.sent_at))
+                   for client in self.clients if client.source and not client.slow)
+
+    def reset(self):
+        for client in self.clients:
+            client.sent_at = []
+            client.received = 0
+        self.latencies = []
+
+    @defer.inlineCallbacks
+    def drive(self, senders, message):
+        # Warm up with one message per sender (for test.py this sets up the key pairs
+        # and sessions), then send at --rate for --duration and wait for the rest
+        for client, command in senders:
+            client.send(command + message)
+        yield self.waitFor(lambda: self.received() == self.expected(), self.args.drain)
+        self.reset()
+        self.baseline()
+        if self.args.scenario == "slow":
+            for client in self.clients[1:][:int(len(self.clients) * self.args.slow)]:
+                client.slow = True
+                client.transport.pauseProducing()
+
+        self.measuring = True
+        started = time.perf_counter()
+        turn = 0
+
+        def tick():
+            nonlocal turn
+            due = int((time.perf_counter() - started) * self.args.rate) - self.sent
+            for _ in range(due):
+                client, command = senders[turn % len(senders)]
+                turn += 1
+                self.sent += 1
+                client.send(command + message)
+            if time.perf_counter() - started >= self.args.duration:
+                loop.stop()
+
+        loop = task.LoopingCall(tick)
+        yield loop.start(0.005)
+        try:
+            yield self.waitFor(lambda: self.received() == self.expected(), self.args.drain)
+        except RuntimeError:
+            pass  # report what arrived
+        return time.perf_counter() - started
+
+    def baseline(self):
+        # CPU is counted from here, so setup (and test.py's key generation) is left out
+        self.cpu = self.server.usage()[0], process_usage()[0]
+
+    @defer.inlineCallbacks
+    def run(self):
+        args = self.args
+        self.baseline()
+        started = time.perf_counter()
+        connect_latencies = yield self.connectAll()
+        if args.scenario == "connect":
+            elapsed = time.perf_counter() - started
+            latencies = sorted(connect_latencies)
+            operations = len(latencies)
+        else:
+            yield self.name()
+            if args.scenario in ("send", "large"):
+                senders = self.pairs()
+            else:
+                senders = self.fanout()
+            elapsed = yield self.drive(senders, self.payload(args.size))
+            latencies = sorted(self.latencies)
+            operations = self.received()
+        server_cpu, server_rss = self.server.usage()
+        client_cpu, client_rss = process_usage()
+        cpu, own_cpu = self.cpu
+        return {
+            "scenario": args.scenario,
+            "target": args.target,
+            "mode": args.mode,
+            "commit": commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {"clients": args.clients, "rate": args.rate, "duration": args.duration, "size": args.size,
+                       "slow": args.slow, "concurrency": args.concurrency, "backlog": args.backlog},
+            "clients": len(self.clients),
+            "failed_connections": self.failed,
+            "disconnected": self.disconnected,
+            "sent": self.sent,
+            "expected": self.expected() if args.scenario != "connect" else operations,
+            "operations": operations,
+            "elapsed_seconds": round(elapsed, 3),
+            "ops_per_sec": round(operations / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 3)
+                           for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999), ("max", 1.0))},
+            # In-process the server and the clients share one process and one set of numbers
+            "server": {"cpu_seconds": round(server_cpu - cpu, 3), "peak_rss_mb": round(server_rss, 1),
+                       **self.server.stats()},
+            "loadgen": {"cpu_seconds": round(client_cpu - own_cpu, 3), "peak_rss_mb": round(client_rss, 1)},
+        }
+
+def report(result):
+    latency = result["latency_ms"]
+    unit = "connections" if result["scenario"] == "connect" else "messages"
+    print(f"{result['scenario']:9} {result['target']}/{result['mode']:10} {result['clients']:6} clients  "
+          f"{result['ops_per_sec']:10.1f} {unit}/sec  p50 {latency['p50']:8.2f} ms  p99 {latency['p99']:8.2f} ms  "
+          f"p999 {latency['p999']:8.2f} ms  server cpu {result['server']['cpu_seconds']:.2f} s  "
+          f"rss {result['server']['peak_rss_mb']:.1f} MB")
+    if result["operations"] < result["expected"]:
+        print(f"  incomplete: {result['operations']} of {result['expected']} messages delivered")
+    if result["failed_connections"] or result["disconnected"]:
+        print(f"  {result['failed_connections']} connections failed, {result['disconnected']} were closed")
+
+def save(path, result):
+    results = []
+    if os.path.exists(path):
+        with open(path) as file:
+            results = json.load(file)
+    results.append(result)
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+def run_scenario(args):
+    server = Server(args)
+    outcome = {}
+
+    @defer.inlineCallbacks
+    def go():
+        try:
+            yield server.start()
+            outcome["result"] = yield LoadRun(args, server).run()
+        except Exception as error:
+            outcome["error"] = error
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(go)
+    reactor.run()
+    server.stop()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive node.py or test.py with many simulated clients")
+    parser.add_argument("--scenario", choices=SCENARIOS, nargs="+", default=list(SCENARIOS))
+    parser.add_argument("--target", choices=("node", "test"), default="node")
+    parser.add_argument("--mode", choices=("inproc", "subprocess"), default="subprocess")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=2000, help="messages per second sent by all clients together")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of sending")
+    parser.add_argument("--size", type=int, help="message bytes (default 100, 12000 for large; node.py lines stop at 16 KiB)")
+    parser.add_argument("--slow", type=float, default=0.1, help="fraction of clients that stop reading in the slow scenario")
+    parser.add_argument("--concurrency", type=int,
+                        help="connections being set up at once (default 200 for connect, 32 to set up the others)")
+    parser.add_argument("--connect-timeout", type=float, default=10, help="seconds to wait for the welcome line")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for messages still in flight")
+    parser.add_argument("--port", type=int, help="server port, a free one by default")
+    parser.add_argument("--backlog", type=int, default=50, help="listen backlog of an in-process server")
+    parser.add_argument("--key-bits", type=int, default=2048, help="session key size of an in-process test.py")
+    parser.add_argument("--key-pool", type=int, default=8, help="key pool size of an in-process test.py")
+    parser.add_argument("--json", help="append the results to this JSON file")
+    args = parser.parse_args()
+
+    if len(args.scenario) > 1:
+        # A fresh process per scenario, so one run's memory and connections don't leak
+        # into the next; the last --scenario on the command line wins
+        for scenario in args.scenario:
+            subprocess.run([sys.executable, "-m", "bench.loadgen", *sys.argv[1:], "--scenario", scenario])
+        return
+    args.scenario = args.scenario[0]
+    if args.size is None:
+        args.size = 12000 if args.scenario == "large" else 100
+    if args.concurrency is None:
+        # Only the storm should overflow the server's accept queue
+        args.concurrency = 200 if args.scenario == "connect" else 32
+
+    result = run_scenario(args)
+    report(result)
+    if args.json:
+        save(args.json, result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import os
+import time
+from twisted.internet import reactor
+from chatlog import logger
+from filetransfer import pick_recipient, shared_file
+from metrics import show_stats
+
+# What node.py's and test.py's servers have in common. Their protocols differ in how
+# lines and messages travel (plain lines, or frames with encrypted messages), the
+# commands below only reply with sendLine and hand messages to the factory.
+
+class ChatProtocolBase:
+    # The commands of a client connection; mixed in before the receiver class
+    def __init__(self, factory):
+        self.factory = factory
+
+    def connectionMade(self):
+        peer = self.transport.getPeer()
+        logger.log(f"Client connected from {peer.host}:{peer.port}")
+        self.factory.metrics.inc("connections_total")
+        # Known by address until the client picks a nickname
+        self.session = self.factory.registry.register(self, peer.host)
+        self.factory.fanout.attach(self)
+        self.sendLine(self.factory.compression.hello(self.session.conn_id))
+
+    def dataReceived(self, data):
+        self.factory.metrics.inc("bytes_received_total", len(data))
+        self.session.last_seen = time.monotonic()
+        super().dataReceived(data)
+
+    def lineReceived(self, line):
+        started = time.perf_counter()
+        # Any line that is not a command is a message to everyone
+        command = self.commands.dispatch(self, line)
+        if command is None:
+            self.chatMessage(line)
+        metrics = self.factory.metrics
+        metrics.inc("lines_received_total")
+        metrics.observe("command_seconds", command or "message", time.perf_counter() - started)
+
+    def chatMessage(self, line):
+        logger.log(f"Received message: {line.decode('utf-8', 'replace')}")
+        self.broadcast(line)
+
+    def stopServer(self):
+        reactor.stop()
+
+    def ping(self):
+        self.sendLine(b"pong")
+
+    def sendToClient(self, user, message):
+        # The body may still be a view of the received data; the store copies what it keeps
+        if self.factory.sendMessage(self.session.user, user, message):
+            return
+        if self.factory.keeps(user):
+            self.sendLine(f"{user} is offline, the message will be delivered when they reconnect.".encode('utf-8'))
+        else:
+            self.sendLine(f"User {user} not found.".encode('utf-8'))
+
+    def showHistory(self, before=None):
+        if not self.factory.store:
+            self.sendLine(b"Message history is not enabled on this server.")
+            return
+        if self.session.account is None:
+            self.sendLine(b"Log in with /login <name> <password> to see your messages.")
+            return
+        self.factory.store.history(self.session.account, before).addCallback(self.sendHistory)
+
+    def setNickname(self, name):
+        if not self.factory.accounts.rename(self.factory.registry, self.session, name):
+            self.sendLine(f"The name {name} is taken.".encode('utf-8'))
+            return
+        self.renamed(name)
+
+    def login(self, name, password):
+        self.factory.accounts.login(self.factory.registry, self.session, name, password).addCallback(
+            self.loggedIn, name)
+
+    def loggedIn(self, success, name):
+        if not success:
+            self.sendLine(f"Could not log in as {name}: wrong password, or the name is in use.".encode('utf-8'))
+            return
+        self.renamed(name)
+
+    def renamed(self, name):
+        self.sendLine(f"You are now known as {name}".encode('utf-8'))
+
+    def showRooms(self):
+        rooms = [f"{name}: {members} members, {messages} messages"
+                 for name, members, messages in self.factory.rooms.stats()]
+        self.sendLine("\n".join(rooms or ["No rooms yet"]).encode('utf-8'))
+
+    showStats = show_stats
+
+    def showHelp(self):
+        self.sendLine(self.commands.help().encode('utf-8'))
+
+    def broadcastMessage(self, message=b""):
+        self.broadcast(bytes(message).strip())
+
+    def disconnectClient(self):
+        self.transport.loseConnection()
+
+    def sendFile(self, user, name):
+        # Clients can only send files from the server's shared directory
+        name = bytes(name).decode('utf-8')
+        path = shared_file(self.factory.files_dir, name)
+        if path is None:
+            self.sendLine(f"No file {name} to share.".encode('utf-8'))
+            return
+        self.offerFile(user, path)
+
+    def offerFile(self, user, path):
+        recipients = self.factory.findClients(user)
+        if not recipients:
+            self.sendLine(f"User {user} not found.".encode('utf-8'))
+            return
+        self.factory.transfers.sendFile(self, pick_recipient(recipients), path).addCallback(
+            lambda transfer: self.sendLine(f"Sending {transfer.name} ({transfer.size} bytes) to {user} "
+                                           f"as transfer {transfer.id}".encode('utf-8')))
+
+    def resumeFile(self, transfer_id, offset):
+        resumed = self.factory.transfers.resume(self, transfer_id, offset)
+        if resumed is None:
+            self.sendLine(f"No interrupted transfer {transfer_id} to you.".encode('utf-8'))
+            return
+        resumed.addCallback(lambda transfer: transfer is None and self.sendLine(
+            f"The file of transfer {transfer_id} changed, it cannot be resumed.".encode('utf-8')))
+
+class ChatConsoleBase:
+    # The server's console: commands typed on stdin, replies printed. Mixed in before
+    # the server's ChatProtocol.
+    def connectionMade(self):
+        self.transport.write(b">>> ")  # Write prompt symbol when connection is made
+
+    def dataReceived(self, data):
+        if self.commands.dispatch(self, data.strip()) is None:
+            print("Unknown command. Type '/help' to see the list of valid commands.")
+        self.transport.write(b">>> ")  # Write prompt symbol again after handling command
+
+    def sendFile(self, user, path):
+        # The console may send any file the server can read
+        path = bytes(path).decode('utf-8')
+        if not os.path.isfile(path):
+            print(f"No file {path}")
+            return
+        self.offerFile(user, path)
+
+    def sendToClient(self, user, message):
+        message = bytes(message)
+        if self.factory.sendMessage("console", user, message):
+            return
+        if self.factory.keeps(user):
+            print(f"{user} is offline, the message will be delivered when they reconnect.")
+        else:
+            print(f"User {user} not found.")
+
+class ChatFactoryBase:
+    # Accepting connections and keeping messages for registered names. Subclasses set
+    # protocol and provide deliver (to this process's connections of a user) and route
+    # (to all of them, wherever they are).
+    def startFactory(self):
+        self.reaper.start()
+        if self.store:
+            self.store.start()
+
+    def stopFactory(self):
+        self.reaper.stop()
+        if self.store:
+            self.store.stop()
+
+    def buildProtocol(self, addr):
+        if self.max_clients and len(self.registry) >= self.max_clients:
+            self.metrics.inc("connections_refused_total")
+            return None  # the listening port closes the socket
+        return self.protocol(self)
+
+    def findClients(self, user):
+        return self.registry.byUser(user)
+
+    def keeps(self, user):
+        # Messages are kept only for registered names: what is kept for one goes to no
+        # one but the connections logged in to it
+        return self.store is not None and self.accounts.registered(user)
+
+    def sendMessage(self, sender, user, message):
+        # Returns whether the user got the message now. With a store every message to a
+        # registered name is kept, and one for them while offline waits until they log in.
+        delivered = self.route(user, message)
+        if self.keeps(user):
+            self.store.store(sender, user, bytes(message), delivered)
+        return delivered
+
+    # Called by the registry when a user's first connection arrives
+    def announce(self, user):
+        if self.keeps(user):
+            # A registered name is only ever had by connections logged in to it
+            self.deliverPending(user)
+
+    def deliverPending(self, user, after=None):
+        def deliver(rows):
+            delivered = [message_id for message_id, sender, timestamp, message in rows
+                         if self.deliver(user, f"{sender}: {message}".encode('utf-8'))]
+            if delivered:
+                self.store.markDelivered(delivered)
+            if len(delivered) == len(rows) and rows:
+                self.deliverPending(user, (rows[-1][2], rows[-1][0]))
+        self.store.pending(user, after).addCallback(deliver)
@@ -0,0 +1,77 @@
+import atexit
+import queue
+import sys
+import threading
+import time
+
+class RateLimitedLogger:
+    # Replacement for print() on the hot path. Lines are queued for a background thread
+    # that writes them, so a slow terminal or pipe never blocks the reactor. A token
+    # bucket lets through rate lines per second, with bursts up to burst; the rest are
+    # dropped and counted, and the count is logged once lines get through again.
+    def __init__(self, rate=50, burst=200, max_queue=10000):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.dropped = 0
+        self.enabled = True
+        self._queue = queue.Queue(max_queue)
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def log(self, message):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            self.dropped += 1
+            return
+        self.tokens -= 1
+        if self.suppressed:
+            self._put(f"({self.suppressed} log lines suppressed)")
+            self.suppressed = 0
+        self._put(message)
+
+    def _put(self, message):
+        if self._writer is None:
+            self._start()
+        try:
+            # The stream is taken now, so a redirect_stdout around the call still applies
+            self._queue.put_nowait((sys.stdout, message))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="chatlog", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write(self):
+        while True:
+            stream, message = self._queue.get()
+            self._emit(stream, message)
+
+    def _emit(self, stream, message):
+        try:
+            stream.write(message + "\n")
+            stream.flush()
+        except (OSError, ValueError):
+            pass  # stdout closed; logging must never take the server down
+
+    def flush(self):
+        # Writes out whatever is still queued, on the calling thread
+        while True:
+            try:
+                stream, message = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._emit(stream, message)
+
+logger = RateLimitedLogger()
@@ -0,0 +1,155 @@
+import importlib
+
+class UsageError(Exception):
+    # Raised by a converter or a handler when a command was used the wrong way
+    pass
+
+def room(value):
+    if not value.startswith("#") or len(value) < 2:
+        raise UsageError(value)
+    return value
+
+def cursor(value):
+    # The "<timestamp>:<id>" that /history prints for the next page
+    timestamp, _, message_id = value.partition(":")
+    return float(timestamp), int(message_id)
+
+def choice(*values):
+    def convert(value):
+        if value not in values:
+            raise UsageError(value)
+        return value
+    return convert
+
+class Command:
+    # One command: the protocol method (or plain function) it calls and the arguments it
+    # takes, each converted from the line's space separated tokens. With payload, the
+    # rest of the line after the arguments is passed on undecoded as a memoryview of the
+    # line, so message bodies are never decoded, split or copied by the dispatcher.
+    def __init__(self, name, handler, args=(), optional=0, payload=False, usage=None, help=None):
+        self.name = name
+        self.key = name.encode('utf-8')
+        self.handler = handler
+        self.args = tuple(args)
+        self.payload = payload
+        self.required = len(self.args) + payload - optional
+        self.usage = usage or name
+        self.help = help
+
+    def parse(self, line, start):
+        values = []
+        end = len(line)
+        for convert in self.args:
+            if start > end or (start == end and len(values) < self.required):
+                break
+            stop = line.find(b" ", start)
+            if stop < 0:
+                stop = end
+            values.append(convert(line[start:stop].decode('utf-8')))
+            start = stop + 1
+        if self.payload and start <= end:
+            values.append(memoryview(line)[start:])
+        elif start < end:
+            raise UsageError("too many arguments")
+        if len(values) < self.required:
+            raise UsageError("missing arguments")
+        return values
+
+    def call(self, protocol, values):
+        if isinstance(self.handler, str):
+            return getattr(protocol, self.handler)(*values)
+        return self.handler(protocol, *values)
+
+class CommandRegistry:
+    # Commands by name, looked up with one dict access on the first token of a line
+    # however many are registered. Handlers named by a string are methods of the
+    # protocol, so a subclass (the console) can handle a command its own way; plugin
+    # modules add commands with a register(registry) function.
+    def __init__(self):
+        self.commands = {}
+
+    def __contains__(self, name):
+        return name.encode('utf-8') in self.commands
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+    def add(self, name, handler, args=(), optional=0, payload=False, usage=None, help=None):
+        command = Command(name, handler, args, optional, payload, usage, help)
+        self.commands[command.key] = command
+        return command
+
+    def command(self, name, args=(), optional=0, payload=False, usage=None, help=None):
+        # Decorator form of add for functions taking (protocol, *arguments)
+        def register(function):
+            self.add(name, function, args, optional, payload, usage, help)
+            return function
+        return register
+
+    def remove(self, name):
+        self.commands.pop(name.encode('utf-8'), None)
+
+    def copy(self, *names):
+        # A registry of its own with all of these commands, or only the ones named
+        registry = CommandRegistry()
+        keys = [name.encode('utf-8') for name in names] or list(self.commands)
+        registry.commands = {key: self.commands[key] for key in keys}
+        return registry
+
+    def load(self, module_name):
+        importlib.import_module(module_name).register(self)
+
+    def help(self):
+        return "\n".join(["Available commands:"] + [f"  {command.usage}: {command.help}"
+                                                    for command in self.commands.values() if command.help])
+
+    def dispatch(self, protocol, line):
+        # Runs the command the line starts with and returns its name, or returns None
+        # when the line is not a command. Bad arguments get the usage line as reply.
+        space = line.find(b" ")
+        command = self.commands.get(line if space < 0 else line[:space])
+        if command is None:
+            return None
+        try:
+            values = command.parse(line, len(line) + 1 if space < 0 else space + 1)
+        except (UsageError, ValueError):
+            protocol.sendLine(f"Invalid command usage. Use {command.usage}".encode('utf-8'))
+            return command.name
+        try:
+            command.call(protocol, values)
+        except UsageError:
+            protocol.sendLine(f"Invalid command usage. Use {command.usage}".encode('utf-8'))
+        return command.name
+
+def chat_commands():
+    # The commands both servers understand; each adds its own and plugins add more
+    registry = CommandRegistry()
+    registry.add("/exit", "stopServer", help="Stop the server")
+    registry.add("/disconnect", "disconnectClient", help="Close your connection")
+    registry.add("/send", "sendToClient", [str], payload=True, usage="/send <user> <message>",
+                 help="Send a message to a user (nickname or IP)")
+    registry.add("/nick", "setNickname", [str], usage="/nick <name>",
+                 help="Choose the name other users reach you by, if no one has it or registered it")
+    registry.add("/login", "login", [str, str], usage="/login <name> <password>",
+                 help="Go by a name only its password gets, registering it the first time; "
+                      "messages kept for you need it")
+    registry.add("/join", "joinRoom", [room], usage="/join #<room>", help="Join a room")
+    registry.add("/leave", "leaveRoom", [room], usage="/leave #<room>", help="Leave a room you joined")
+    registry.add("/msg", "messageRoom", [room], payload=True, usage="/msg #<room> <message>",
+                 help="Send a message to everyone in a room you joined")
+    registry.add("/rooms", "showRooms", help="List rooms with their members and message counts")
+    registry.add("/history", "showHistory", [cursor], optional=1, usage="/history [<timestamp>:<id>]",
+                 help="Show the messages sent to you, newest last")
+    registry.add("/stats", "showStats", help="Show the server's counters and latencies")
+    registry.add("/broadcast", "broadcastMessage", payload=True, optional=1, usage="/broadcast <message>",
+                 help="Send a message to all connected clients")
+    registry.add("/sendfile", "sendFile", [str], payload=True, usage="/sendfile <user> <path>",
+                 help="Stream a file to a user")
+    registry.add("/resumefile", "resumeFile", [int, int], usage="/resumefile <id> <offset>",
+                 help="Continue an interrupted transfer to you from the bytes you already have")
+    registry.add("/ping", "ping", help="Keep an idle connection open; the server answers pong")
+    registry.add("/caps", "setCapabilities", payload=True, optional=1, usage="/caps [compress=<codec>] [batch]",
+                 help="Ask for compression and batching of what the server sends you, as offered by its /hello")
+    registry.add("/help", "showHelp", help="Show this help message")
+    registry.add("/connect", "connectToServer", [str, int], usage="/connect <IP> <port>", help="Connect to a server")
+    return registry
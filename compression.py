@@ -0,0 +1,244 @@
+import hashlib
+import hmac
+import os
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd is only offered where the zstandard package is installed
+
+# Negotiated compression of what the server sends to a client. Its first line is
+#   /hello <token> compress=<codecs, best first> batch=<ms>
+# and a client that wants compression or micro-batching answers "/caps compress=<codec>
+# batch"; the server confirms with "/caps <token> compress=<codec|none> batch=<ms>".
+# node.py compresses its whole stream to the client from the line after the
+# confirmation; test.py compresses each message on its own, before encrypting it, and
+# sets FLAG_COMPRESSED on its frame. Clients that never answer get what they always did.
+
+# Strings most server lines are made of, given to both ends up front so that even the
+# first short messages of a connection compress. Deflate reaches the end of the
+# dictionary most cheaply, so the most common strings are last.
+DICTIONARY = (
+    b"Older messages: /history No more messages. Message history is not enabled on this server. "
+    b"is offline, the message will be delivered when they reconnect. User not found. No file to share. "
+    b"Sending bytes to as transfer /file /chunk /filedone Invalid command usage. Use members, messages "
+    b"thanks thank you please sorry sure okay yeah yes no maybe what when where why how who "
+    b"good morning good night see you later let me know I think I don't know did you see "
+    b"the a to and of in is it that for on with this have be are was at you me my we "
+    b"/hello /caps compress= batch= Joined #Left #You are now known as pong\r\n: \r\n"
+)
+
+# Stream contexts are per connection, so they are kept small: chat lines are short and
+# gain little from a window larger than a few KB. About 32 KB (zlib) and 80 KB (zstd)
+# per compressed connection.
+ZLIB_LEVEL = 6
+ZLIB_WINDOW_BITS = 12
+ZLIB_MEM_LEVEL = 5
+ZSTD_LEVEL = 3
+ZSTD_WINDOW_LOG = 12
+
+class ZlibStream:
+    def __init__(self, dictionary):
+        options = {"zdict": dictionary} if dictionary else {}
+        self.deflate = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -ZLIB_WINDOW_BITS, ZLIB_MEM_LEVEL, **options)
+
+    def compress(self, data):
+        # Everything given so far, decodable by the peer as soon as it arrives
+        return self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+
+class ZlibCodec:
+    # Raw deflate, optionally primed with DICTIONARY
+    def __init__(self, name, dictionary=None):
+        self.name = name
+        self.dictionary = dictionary
+        self.options = {"zdict": dictionary} if dictionary else {}
+
+    def compressor(self):
+        return ZlibStream(self.dictionary)
+
+    def decompressor(self):
+        return zlib.decompressobj(-zlib.MAX_WBITS, **self.options)
+
+    def pack(self, data):
+        # One message on its own, independent of any before it
+        deflate = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -ZLIB_WINDOW_BITS, ZLIB_MEM_LEVEL, **self.options)
+        return deflate.compress(data) + deflate.flush()
+
+    def unpack(self, data, limit):
+        # None if it is damaged or would inflate beyond limit bytes
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS, **self.options)
+        try:
+            message = inflate.decompress(data, limit)
+        except zlib.error:
+            return None
+        return None if inflate.unconsumed_tail or not inflate.eof else message
+
+class ZstdStream:
+    def __init__(self, compressor):
+        self.stream = compressor.compressobj()
+
+    def compress(self, data):
+        return self.stream.compress(data) + self.stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+class ZstdCodec:
+    def __init__(self, name, dictionary=None):
+        self.name = name
+        self.dictionary = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT) \
+            if dictionary else None
+        self.params = zstandard.ZstdCompressionParameters.from_level(
+            ZSTD_LEVEL, window_log=ZSTD_WINDOW_LOG, write_checksum=0, write_dict_id=0, write_content_size=1)
+        self.context = zstandard.ZstdCompressor(dict_data=self.dictionary, compression_params=self.params)
+        self.decompression = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+
+    def compressor(self):
+        return ZstdStream(zstandard.ZstdCompressor(dict_data=self.dictionary, compression_params=self.params))
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor(dict_data=self.dictionary).decompressobj()
+
+    def pack(self, data):
+        return self.context.compress(data)
+
+    def unpack(self, data, limit):
+        try:
+            if not 0 <= zstandard.frame_content_size(data) <= limit:
+                return None  # unknown, or more than the caller takes
+            return self.decompression.decompress(data)
+        except zstandard.ZstdError:
+            return None
+
+# Best first. On chat lines zlib sends fewer bytes than zstd at these sizes, by the
+# most with each message on its own, and zstd costs less CPU (python -m bench.bench_compression)
+PREFERENCE = ("zlib+dict", "zlib", "zstd+dict", "zstd")
+CODECS = {"zlib+dict": ZlibCodec("zlib+dict", DICTIONARY), "zlib": ZlibCodec("zlib")}
+if zstandard is not None:
+    CODECS["zstd+dict"] = ZstdCodec("zstd+dict", DICTIONARY)
+    CODECS["zstd"] = ZstdCodec("zstd")
+
+def codec_names(value):
+    # --compress: comma separated codecs in order of preference, or "none"
+    names = [name for name in value.split(",") if name and name != "none"]
+    unknown = [name for name in names if name not in PREFERENCE]
+    if unknown:
+        raise ValueError(f"unknown codec {unknown[0]}")
+    return names
+
+class CompressedTransport:
+    # Stands in for a connection's transport once its stream is compressed: every write
+    # goes through the connection's compressor, flushed so the client can decode it at
+    # once. Everything else is the real transport's. dataBuffer is hidden so that file
+    # chunks are never written past the compressor with os.sendfile.
+    dataBuffer = None
+
+    def __init__(self, transport, codec, compression):
+        self.transport = transport
+        self.codec = codec
+        self.compressor = codec.compressor()
+        self.compression = compression
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        self.compression.raw += len(data)
+        self.compression.compressed += len(compressed)
+        self.transport.write(compressed)
+
+    def writeSequence(self, data):
+        self.write(b"".join(data))
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+class Compression:
+    # What one server offers: codecs (all available ones by default) and a batching
+    # budget in ms (0 for none), with its totals of bytes before and after compression
+    def __init__(self, codecs=None, batch_ms=0):
+        self.codecs = [name for name in (PREFERENCE if codecs is None else codecs) if name in CODECS]
+        self.batch_ms = batch_ms
+        self.secret = os.urandom(16)
+        self.raw = 0
+        self.compressed = 0
+
+    def token(self, conn_id):
+        # Only the client sees its hello, so no one else can fake its confirmation
+        return hmac.new(self.secret, str(conn_id).encode(), hashlib.sha256).hexdigest()[:8]
+
+    def hello(self, conn_id):
+        return f"/hello {self.token(conn_id)} compress={','.join(self.codecs) or 'none'} batch={self.batch_ms:g}".encode()
+
+    def negotiate(self, options):
+        # The codec (or None) and whether to batch for the options of a client's /caps
+        codec = None
+        batch = False
+        for option in options.split():
+            key, _, value = option.partition("=")
+            if key == "compress" and value in self.codecs:
+                codec = CODECS[value]
+            elif key == "batch":
+                batch = bool(self.batch_ms)
+        return codec, batch
+
+    def confirmation(self, conn_id, codec, batch):
+        return (f"/caps {self.token(conn_id)} compress={codec.name if codec else 'none'} "
+                f"batch={self.batch_ms if batch else 0:g}").encode()
+
+    def transport(self, transport, codec):
+        return CompressedTransport(transport, codec, self)
+
+    def pack(self, codec, data):
+        # One message compressed, or None if that does not make it smaller
+        packed = codec.pack(data)
+        if len(packed) >= len(data):
+            return None
+        self.raw += len(data)
+        self.compressed += len(packed)
+        return packed
+
+def parse_caps(line):
+    # The token and options of a "/hello" or "/caps" line from the server
+    fields = bytes(line).decode('utf-8').split()
+    options = dict(field.partition("=")[::2] for field in fields[2:])
+    return fields[1] if len(fields) > 1 else "", options
+
+def caps_request(hello, codecs=PREFERENCE, batch=True):
+    # A client's answer to the server's hello: the first offered codec it has, and
+    # batching if it wants it and it is offered. Returns (token, line, codec name)
+    token, offered = parse_caps(hello)
+    offer = offered.get("compress", "none").split(",")
+    choice = next((name for name in offer if name in codecs and name in CODECS), None)
+    options = [f"compress={choice}"] if choice else []
+    if batch and float(offered.get("batch", 0)):
+        options.append("batch")
+    return token, ("/caps " + " ".join(options)).encode(), choice
+
+class StreamSwitch:
+    # Client side of node.py's compressed stream. feed() takes what the connection
+    # received and returns what to parse as lines: until the server's confirmation of
+    # compression (a line starting with "/caps <token> ") the bytes as they are, a
+    # complete line at a time, and after it everything decompressed.
+    def __init__(self, token, codec):
+        self.marker = f"/caps {token} ".encode()
+        self.codec = codec
+        self.decompressor = None
+        self.waiting = codec is not None
+        self.partial = b""
+
+    def feed(self, data):
+        if self.decompressor is not None:
+            return self.decompressor.decompress(data)
+        if not self.waiting:
+            return data
+        data = self.partial + data
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                self.partial = data[start:]
+                return data[:start]
+            if data.startswith(self.marker, start):
+                self.waiting = False
+                self.partial = b""
+                if b"compress=none" in data[start:end]:
+                    return data
+                self.decompressor = self.codec.decompressor()
+                return data[:end + 1] + self.decompressor.decompress(data[end + 1:])
+            start = end + 1
@@ -0,0 +1,67 @@
+import time
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+from metrics import Histogram
+
+class CryptoOverloaded(Exception):
+    pass
+
+class CryptoExecutor:
+    # Runs RSA and other slow crypto on a thread pool so that one expensive call never
+    # stalls the reactor; callers get a Deferred. pycryptodome and cryptography release
+    # the GIL inside their C code, so the threads do run in parallel.
+    #
+    # At most max_pending operations are queued or running; beyond that run() fails at
+    # once with CryptoOverloaded instead of letting the queue, and its latency, grow.
+    # With size=0 operations run inline on the calling thread, as they used to.
+    def __init__(self, size=4, max_pending=256, clock=reactor):
+        self.size = size
+        self.max_pending = max_pending
+        self.clock = clock
+        self.pending = 0
+        self.shed = 0
+        self.latency = {}  # operation -> Histogram, from run() to the result
+        self.runtime = {}  # operation -> Histogram, time spent in the pool thread
+        self.pool = ThreadPool(minthreads=0, maxthreads=size, name="crypto") if size else None
+
+    def start(self):
+        if self.pool and not self.pool.started:
+            self.pool.start()
+
+    def stop(self):
+        if self.pool and self.pool.started:
+            self.pool.stop()
+
+    def run(self, operation, function, *args):
+        if self.pending >= self.max_pending:
+            self.shed += 1
+            return defer.fail(CryptoOverloaded(f"{operation}: {self.pending} crypto operations already queued"))
+        submitted = time.perf_counter()
+        if self.pool is None:
+            return defer.maybeDeferred(lambda: self.observe(operation, submitted, self.timed(function, *args)))
+        self.pending += 1
+        d = threads.deferToThreadPool(self.clock, self.pool, self.timed, function, *args)
+        d.addBoth(self.finished)
+        d.addCallback(lambda result: self.observe(operation, submitted, result))
+        return d
+
+    def timed(self, function, *args):
+        started = time.perf_counter()
+        value = function(*args)
+        return started, time.perf_counter(), value
+
+    def finished(self, result):
+        self.pending -= 1
+        return result
+
+    def observe(self, operation, submitted, result):
+        started, finished, value = result
+        if operation not in self.latency:
+            self.latency[operation] = Histogram()
+            self.runtime[operation] = Histogram()
+        self.latency[operation].observe(time.perf_counter() - submitted)
+        self.runtime[operation].observe(finished - started)
+        return value
+
+    def stats(self):
+        return [(operation, histogram, self.runtime[operation]) for operation, histogram in self.latency.items()]
@@ -1,94 +1,443 @@
+import base64
+import hmac
+import json
+import os
 import sqlite3
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+# The key ring: every key that may still have data encrypted under it, by key ID.
+# New data is always encrypted with the current key (key_id); ciphertexts carry the ID
+# of their key, so old data stays readable while it is being re-encrypted.
 key = "O3mV9mbudpasPFkJGSM3riU6pRKcyvlSsAJLAo1eAdo="
-def encrypt(data):
-    global key
-    cipher = Fernet(key)
-    encrypted_data = cipher.encrypt(data)  # No need to encode here
-    return encrypted_data
+key_id = 1
+keys = {key_id: key}
+current = (key_id, key)  # both at once, for readers on other threads
+keyring_path = None  # where the ring is kept, see open_keyring
+KEYED_TOKEN = struct.Struct("!BH")  # marker, key ID; Fernet tokens never start with 0x01
+KEYED_TOKEN_MARKER = 1
+ciphers = {}  # one Fernet instance per key, building one derives its subkeys again
+index_keys = {}  # blind index key per key
+
+def get_cipher(fernet_key):
+    cipher = ciphers.get(fernet_key)
+    if cipher is None:
+        cipher = ciphers[fernet_key] = Fernet(fernet_key)
+    return cipher
+
+def use_key(new_key_id, fernet_key):
+    # Adds a key to the ring and makes it the one new data is encrypted with. A kept
+    # ring is saved first, so nothing is encrypted with a key that could be lost.
+    global key, key_id, current
+    keys[new_key_id] = fernet_key
+    if keyring_path is not None:
+        save_keyring(keyring_path, new_key_id)
+    key, key_id = fernet_key, new_key_id
+    current = (new_key_id, fernet_key)
+
+def add_key(fernet_key=None):
+    fernet_key = fernet_key or Fernet.generate_key().decode()
+    use_key(max(keys) + 1, fernet_key)
+    return key_id
+
+def retire_key(old_key_id):
+    # Only once nothing is encrypted under it any more
+    if old_key_id == key_id:
+        return
+    fernet_key = keys.pop(old_key_id, None)
+    if fernet_key is not None and fernet_key not in keys.values():
+        ciphers.pop(fernet_key, None)
+        index_keys.pop(fernet_key, None)
+    if keyring_path is not None:
+        save_keyring(keyring_path)
+
+def save_keyring(path, current_id=None):
+    # Only the owner may read the key ring. Written next to it and swapped in, so a
+    # crash never leaves half a ring.
+    partial = path + ".saving"
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as file:
+        json.dump({"current": current_id or key_id, "keys": keys}, file)
+    os.replace(partial, path)
+
+def load_keyring(path):
+    with open(path) as file:
+        keyring = json.load(file)
+    keys.clear()
+    keys.update((int(ring_id), fernet_key) for ring_id, fernet_key in keyring["keys"].items())
+    use_key(keyring["current"], keys[keyring["current"]])
+
+def open_keyring(path):
+    # Keeps the ring in path: loads it if it is there, else starts it with the keys in
+    # memory. From then on added and retired keys are saved to it.
+    global keyring_path
+    if os.path.exists(path):
+        load_keyring(path)
+    else:
+        save_keyring(path)
+    keyring_path = path
+
+def token_key_id(encrypted_data):
+    # Tokens from before the key ring have no key ID and were made with key 1
+    if encrypted_data[:1] == bytes([KEYED_TOKEN_MARKER]):
+        return KEYED_TOKEN.unpack_from(encrypted_data)[1]
+    return 1
+
+def encrypt(data, ring_id=None):
+    # With the current key unless ring_id is given; the ID written is the key's used
+    ring_id, fernet_key = current if ring_id is None else (ring_id, keys[ring_id])
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    encrypted_data = get_cipher(fernet_key).encrypt(data)
+    return KEYED_TOKEN.pack(KEYED_TOKEN_MARKER, ring_id) + encrypted_data
+
+def open_token(encrypted_data):
+    token_id = token_key_id(encrypted_data)
+    if encrypted_data[:1] == bytes([KEYED_TOKEN_MARKER]):
+        encrypted_data = encrypted_data[KEYED_TOKEN.size:]
+    return get_cipher(keys[token_id]).decrypt(encrypted_data)
 
 def decrypt(encrypted_data):
-    global key
-    cipher = Fernet(key)
-    decrypted_data = cipher.decrypt(encrypted_data).decode()
+    decrypted_data = open_token(encrypted_data).decode()
     return decrypted_data
 
-def insert_data(conn, cursor, key):
+def derive_key(info, ring_id=None):
+    # Subkeys for purposes other than Fernet tokens, derived from a key in the ring
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=info).derive(base64.urlsafe_b64decode(keys[ring_id or key_id]))
+
+def blind_index(value, ring_id=None):
+    # Equal values give equal digests, so an encrypted column can be searched by
+    # equality through an ordinary SQL index without decrypting any row
+    ring_id = ring_id or key_id
+    digest_key = index_keys.get(keys[ring_id])
+    if digest_key is None:
+        digest_key = index_keys[keys[ring_id]] = derive_key(b"ChatApp blind index", ring_id)
+    return hmac.new(digest_key, value.strip().lower().encode('utf-8'), "sha256").digest()
+
+def setup_users(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT, email TEXT, email_index BLOB)")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    if "email_index" not in columns:
+        # Tables from before the blind index: add the column and fill it in once
+        conn.execute("ALTER TABLE users ADD COLUMN email_index BLOB")
+        updates = ((blind_index(email), user_id) for user_id, name, email in iter_users(conn))
+        conn.executemany("UPDATE users SET email_index = ? WHERE id = ?", list(updates))
+    conn.execute("CREATE INDEX IF NOT EXISTS users_email_index ON users (email_index)")
+    conn.commit()
+
+def insert_users(conn, users):
+    # users is any iterable of (name, email); all of them go in one transaction
+    rows = ((encrypt(name), encrypt(email), blind_index(email)) for name, email in users)
+    with conn:
+        conn.executemany("INSERT INTO users (name, email, email_index) VALUES (?, ?, ?)", rows)
+
+def iter_users(conn, batch_size=1000):
+    # Yields decrypted (id, name, email) rows, fetching and decrypting a batch at a time
+    cursor = conn.execute("SELECT id, name, email FROM users ORDER BY id")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for user_id, name, email in rows:
+            yield user_id, decrypt(name), decrypt(email)
+
+def find_users_by_email(conn, email):
+    # While a rotation runs, rows are indexed under either key, so look for every digest
+    digests = [blind_index(email, ring_id) for ring_id in keys]
+    rows = conn.execute(f"SELECT id, name, email FROM users WHERE email_index IN ({', '.join('?' * len(digests))})",
+                        digests)
+    return [(user_id, decrypt(name), decrypt(found)) for user_id, name, found in rows]
+
+def insert_data(conn, cursor):
     name = input("Enter name: ")
     email = input("Enter email: ")
     # Encrypting data before inserting
-    encrypted_name = encrypt(name, key)
-    encrypted_email = encrypt(email, key)
-    cursor.execute("INSERT INTO users (name, email) VALUES (?, ?)", (encrypted_name, encrypted_email))
-    conn.commit()
+    insert_users(conn, [(name, email)])
     print("Data inserted successfully!")
 
 def display_data(cursor):
-    global key
-    cursor.execute("SELECT * FROM users")
-    rows = cursor.fetchall()
-    for row in rows:
-        decrypted_name = decrypt(row[1])
-        decrypted_email = decrypt(row[2])
-        print(f"Name: {decrypted_name}, Email: {decrypted_email}")
-
-def encrypt_db(db_name, encrypted_db_name):
-    global key
-    # Read the contents of the database
-    with open(db_name, 'rb') as file:
-        data = file.read()
-    
-    # Encrypt the entire database
-    encrypted_data = encrypt(data)
-    with open(encrypted_db_name, 'wb') as file:
-        file.write(encrypted_data)
+    for user_id, name, email in iter_users(cursor.connection):
+        print(f"Name: {name}, Email: {email}")
+
+# Encrypted database files are a header followed by fixed-size chunks, each sealed with
+# AES-GCM under its own nonce (the file's random prefix plus the chunk index). The chunk
+# index and whether it is the last chunk are authenticated too, so chunks cannot be
+# reordered, dropped or cut off. Every chunk but the last is full, which puts chunk i
+# at a known offset and lets it be decrypted on its own.
+FILE_MAGIC = b"CHDB"
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct("!4sBHI8s")  # magic, version, key ID, chunk size, nonce prefix
+FILE_HEADER_V1 = struct.Struct("!4sBI8s")  # before the key ring, always key 1
+CHUNK_SIZE = 1 << 20
+TAG_SIZE = 16
+
+def file_key(ring_id=None):
+    # A separate AES key for files, derived from a key in the ring
+    return derive_key(b"ChatApp database file", ring_id)
+
+def chunk_nonce(prefix, index):
+    return prefix + struct.pack("!I", index)
+
+def chunk_aad(header, index, last):
+    return header + struct.pack("!I?", index, last)
+
+def read_chunks(file, chunk_size):
+    # Yields (index, data, last); looks one chunk ahead to know which one is the last
+    index = 0
+    data = file.read(chunk_size)
+    while True:
+        following = file.read(chunk_size)
+        yield index, data, not following
+        if not following:
+            return
+        index += 1
+        data = following
+
+def process_chunks(function, chunks, workers):
+    # Applies function to every chunk in order, on a thread pool when workers > 1. At
+    # most 2 * workers chunks are in flight, so memory stays flat for any file size.
+    if workers <= 1:
+        for chunk in chunks:
+            yield function(*chunk)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(function, *chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def new_header(chunk_size, ring_id):
+    header = FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, ring_id, chunk_size, os.urandom(8))
+    return header, header[-8:]
+
+def encrypt_file(source, destination, chunk_size=CHUNK_SIZE, workers=1):
+    ring_id = key_id
+    cipher = AESGCM(file_key(ring_id))
+    header, prefix = new_header(chunk_size, ring_id)
+
+    def seal(index, data, last):
+        return cipher.encrypt(chunk_nonce(prefix, index), data, chunk_aad(header, index, last))
+
+    with open(source, 'rb') as reader, open(destination, 'wb') as writer:
+        writer.write(header)
+        for sealed in process_chunks(seal, read_chunks(reader, chunk_size), workers):
+            writer.write(sealed)
+
+def read_header(file):
+    # Returns (header, key ID, chunk size, nonce prefix), or None if this is not a
+    # chunked file or its key is not in the ring
+    start = file.read(len(FILE_MAGIC) + 1)
+    if start[:len(FILE_MAGIC)] != FILE_MAGIC or len(start) < len(FILE_MAGIC) + 1:
+        return None
+    layout = {1: FILE_HEADER_V1, FILE_VERSION: FILE_HEADER}.get(start[-1])
+    if layout is None:
+        return None
+    header = start + file.read(layout.size - len(start))
+    if len(header) < layout.size:
+        return None
+    if layout is FILE_HEADER_V1:
+        magic, version, chunk_size, prefix = layout.unpack(header)
+        ring_id = 1
+    else:
+        magic, version, ring_id, chunk_size, prefix = layout.unpack(header)
+    if ring_id not in keys:
+        return None
+    return header, ring_id, chunk_size, prefix
+
+def is_chunked_file(path):
+    with open(path, 'rb') as file:
+        return file.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+def decrypt_file(source, destination, workers=1):
+    # Returns False if the file is not in the chunked format or fails authentication
+    with open(source, 'rb') as reader:
+        parsed = read_header(reader)
+        if parsed is None:
+            return False
+        header, ring_id, chunk_size, prefix = parsed
+        cipher = AESGCM(file_key(ring_id))
+
+        def open_chunk(index, sealed, last):
+            return cipher.decrypt(chunk_nonce(prefix, index), sealed, chunk_aad(header, index, last))
+
+        try:
+            with open(destination, 'wb') as writer:
+                for data in process_chunks(open_chunk, read_chunks(reader, chunk_size + TAG_SIZE), workers):
+                    writer.write(data)
+        except InvalidTag:
+            os.remove(destination)
+            return False
+    return True
+
+def decrypt_chunk(source, index):
+    # Random access: decrypts chunk index alone, None if there is no such chunk
+    with open(source, 'rb') as reader:
+        parsed = read_header(reader)
+        if parsed is None:
+            return None
+        header, ring_id, chunk_size, prefix = parsed
+        cipher = AESGCM(file_key(ring_id))
+        offset = len(header) + index * (chunk_size + TAG_SIZE)
+        size = os.fstat(reader.fileno()).st_size
+        if index < 0 or offset >= size:
+            return None
+        reader.seek(offset)
+        sealed = reader.read(chunk_size + TAG_SIZE)
+        last = offset + len(sealed) == size
+        try:
+            return cipher.decrypt(chunk_nonce(prefix, index), sealed, chunk_aad(header, index, last))
+        except InvalidTag:
+            return None
+
+def rotate_file(path, workers=1):
+    # Re-seals an encrypted file under the current key chunk by chunk, without the
+    # plaintext ever reaching the disk, then swaps it in. False if it could not be read.
+    rotated = path + ".rotating"
+    with open(path, 'rb') as reader:
+        parsed = read_header(reader)
+        if parsed is None:
+            return False
+        old_header, ring_id, chunk_size, old_prefix = parsed
+        new_id = key_id
+        if ring_id == new_id:
+            return True
+        old_cipher, cipher = AESGCM(file_key(ring_id)), AESGCM(file_key(new_id))
+        header, prefix = new_header(chunk_size, new_id)
+
+        def reseal(index, sealed, last):
+            data = old_cipher.decrypt(chunk_nonce(old_prefix, index), sealed, chunk_aad(old_header, index, last))
+            return cipher.encrypt(chunk_nonce(prefix, index), data, chunk_aad(header, index, last))
+
+        try:
+            with open(rotated, 'wb') as writer:
+                writer.write(header)
+                for sealed in process_chunks(reseal, read_chunks(reader, chunk_size + TAG_SIZE), workers):
+                    writer.write(sealed)
+        except InvalidTag:
+            os.remove(rotated)
+            return False
+    os.replace(rotated, path)
+    return True
+
+class KeyRotation:
+    # Re-encrypts the encrypted columns of a table under the current key, a small batch
+    # at a time on a background thread. The last row done is saved in the same
+    # transaction as each batch, so after a crash the job picks up where it stopped.
+    # After each batch it sleeps long enough to keep its share of the time at duty, so
+    # live queries keep their latency. Batches are kept small: a query that arrives
+    # during one waits until the thread lets go of the interpreter and the core. The
+    # batch size bounds that wait; the duty only sets how many queries run into it.
+    # A row that changes while its batch is being worked on is left alone; it was
+    # written under the current key anyway.
+    def __init__(self, path, table="users", columns=("name", "email"), indexes=None,
+                 batch_size=20, duty=0.2):
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.indexes = {"email_index": "email"} if indexes is None and table == "users" else indexes or {}
+        self.batch_size = batch_size
+        self.duty = duty
+        self.key_id = key_id
+        self.scanned = 0
+        self.rotated = 0
+        self.done = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self.run, name="KeyRotation", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def checkpoint(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS key_rotation (name TEXT PRIMARY KEY, key_id INTEGER, last_id INTEGER)")
+        row = conn.execute("SELECT key_id, last_id FROM key_rotation WHERE name = ?", (self.table,)).fetchone()
+        return row[1] if row and row[0] == self.key_id else 0
+
+    def run(self):
+        conn = sqlite3.connect(self.path)
+        columns = ", ".join(self.columns)
+        select = f"SELECT id, {columns} FROM {self.table} WHERE id > ? ORDER BY id LIMIT ?"
+        assignments = ", ".join(f"{column} = ?" for column in (*self.columns, *self.indexes))
+        unchanged = " AND ".join(f"{column} = ?" for column in self.columns)
+        update = f"UPDATE {self.table} SET {assignments} WHERE id = ? AND {unchanged}"
+        last_id = self.checkpoint(conn)
+        while not self._stopping.is_set():
+            started = time.perf_counter()
+            rows = conn.execute(select, (last_id, self.batch_size)).fetchall()
+            if not rows:
+                self.done = True
+                break
+            updates = [self.reencrypt(row) for row in rows
+                       if any(token_key_id(value) != self.key_id for value in row[1:])]
+            last_id = rows[-1][0]
+            with conn:
+                conn.executemany(update, updates)
+                conn.execute("INSERT OR REPLACE INTO key_rotation (name, key_id, last_id) VALUES (?, ?, ?)",
+                             (self.table, self.key_id, last_id))
+            self.scanned += len(rows)
+            self.rotated += len(updates)
+            busy = time.perf_counter() - started
+            self._stopping.wait(busy * (1 - self.duty) / self.duty)
+        conn.close()
+
+    def reencrypt(self, row):
+        plain = {column: open_token(value) for column, value in zip(self.columns, row[1:])}
+        sealed = [encrypt(plain[column], self.key_id) for column in self.columns]
+        digests = [blind_index(plain[column].decode(), self.key_id) for column in self.indexes.values()]
+        return (*sealed, *digests, row[0], *row[1:])
+
+def encrypt_db(db_name, encrypted_db_name, workers=1):
+    encrypt_file(db_name, encrypted_db_name, workers=workers)
     print("Database encrypted successfully!")
 
-def decrypt_db(encrypted_db_name, decrypted_db_name):
-    # Read the contents of the encrypted database
-    global key
-    with open(encrypted_db_name, 'rb') as file:
-        encrypted_data = file.read()
-    
-    # Decrypt the entire database
-    decrypted_data = decrypt(encrypted_data, key)
-    with open(decrypted_db_name, 'wb') as file:
-        file.write(decrypted_data)
+def decrypt_db(encrypted_db_name, decrypted_db_name, workers=1):
+    if is_chunked_file(encrypted_db_name):
+        if not decrypt_file(encrypted_db_name, decrypted_db_name, workers):
+            print("Database could not be decrypted: it is damaged or was encrypted with another key.")
+            return
+    else:
+        # Files written before the chunked format are a single Fernet token under key 1
+        with open(encrypted_db_name, 'rb') as file:
+            decrypted_data = get_cipher(keys[1]).decrypt(file.read())
+        with open(decrypted_db_name, 'wb') as file:
+            file.write(decrypted_data)
     print("Database decrypted successfully!")
 
 def main():
     db_name = "SQL"
-    
-    encrypted_db_name = db_name + ".encrypted"
-    decrypted_db_name = db_name + ".decrypted"
-    running = True
     # Connect to the database
     conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
 
     # Create a table if it doesn't exist
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                      (id INTEGER PRIMARY KEY, name TEXT, email TEXT)''')
-    if (running == False):            
-        conn.close()
-"""
-    # Ask the user whether they want to encrypt, decrypt, insert data, or display data
-    choice = input("Do you want to encrypt, decrypt, insert data, or display data? (encrypt/decrypt/insert/display): ")
-
-    if choice.lower() == "encrypt":
-        encrypt_db(db_name, encrypted_db_name, key)
-    elif choice.lower() == "decrypt":
-        decrypt_db(encrypted_db_name, decrypted_db_name, key)
-    elif choice.lower() == "insert":
-        insert_data(conn, cursor, key)
-    elif choice.lower() == "display":
-        display_data(cursor, key)
-    else:
-        print("Invalid choice!")
-        """
+    setup_users(conn)
 
     # Close the connection
+    conn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+from collections import deque
+from twisted.internet import reactor
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
+DROP = "drop"
+DISCONNECT = "disconnect"
+
+@implementer(IPushProducer)
+class ClientQueue:
+    # Outbound queue of one connection. It is registered as the transport's streaming
+    # producer, so the transport pauses it when its own write buffer is full; while
+    # paused, messages wait here up to max_buffer bytes before the slow consumer policy
+    # kicks in. An idle connection holds no buffer: the list of pending messages is
+    # created by the first message after a flush and handed to writeSequence as it is.
+    # Streams (file transfers) are pulled a chunk per flush, after the pending messages.
+    # A batched queue (see FanOut) also remembers when it last wrote.
+    __slots__ = ("fanout", "client", "transport", "pending", "pendingBytes", "paused", "dropped", "streams",
+                 "batched", "flushed")
+
+    def __init__(self, fanout, client):
+        self.fanout = fanout
+        self.client = client
+        self.transport = client.transport
+        self.pending = None
+        self.pendingBytes = 0
+        self.paused = False
+        self.dropped = 0
+        self.streams = None
+        self.batched = False
+        self.flushed = 0.0
+        self.transport.registerProducer(self, True)
+
+    def push(self, data):
+        if self.pendingBytes + len(data) > self.fanout.max_buffer:
+            self.overflow()
+            return False
+        if self.pending is None:
+            self.pending = [data]
+        else:
+            self.pending.append(data)
+        self.pendingBytes += len(data)
+        return True
+
+    def overflow(self):
+        self.dropped += 1
+        self.fanout.dropped += 1
+        if self.fanout.policy == DISCONNECT and not self.transport.disconnecting:
+            self.pending = None
+            self.pendingBytes = 0
+            abort = getattr(self.transport, "abortConnection", self.transport.loseConnection)
+            abort()
+
+    def flush(self):
+        if self.paused:
+            return
+        if self.pending:
+            batch, self.pending = self.pending, None
+            self.fanout.written += self.pendingBytes
+            self.pendingBytes = 0
+            self.transport.writeSequence(batch)
+            if self.batched:
+                self.flushed = self.fanout.clock.seconds()
+        if self.streams and not self.paused:
+            self.fanout.pump(self)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        self.pending = None
+        self.pendingBytes = 0
+        self.fanout.detach(self.client)
+
+class FanOut:
+    # Delivers serialized messages to many connections. A broadcast hands the same
+    # immutable bytes object to every recipient queue, and everything queued during one
+    # reactor iteration goes out as a single writeSequence call per connection.
+    #
+    # Connections that asked for batching wait longer, Nagle style: a message to one
+    # that wrote less than delay seconds ago is held and goes out with whatever else
+    # arrives for it until delay after the first message held, or as soon as
+    # batch_bytes are waiting. One that was quiet for longer gets its message at once,
+    # so batching adds no latency to sparse traffic and at most delay to a burst.
+    def __init__(self, max_buffer=1024 * 1024, policy=DROP, clock=reactor, delay=0, batch_bytes=16 * 1024):
+        self.max_buffer = max_buffer
+        self.policy = policy
+        self.clock = clock
+        self.delay = delay
+        self.batch_bytes = batch_bytes
+        self.queues = {}
+        self.dirty = set()
+        self.held = set()
+        self.dropped = 0
+        self.published = 0
+        self.written = 0
+        self._flushCall = None
+        self._heldCall = None
+
+    def attach(self, client):
+        if client not in self.queues:
+            self.queues[client] = ClientQueue(self, client)
+
+    def batch(self, client):
+        queue = self.queues.get(client)
+        if queue is not None and self.delay:
+            queue.batched = True
+
+    def wrapTransport(self, client, transport):
+        # What is queued for the client goes out as it is; everything after it through
+        # transport, which wraps the client's own (to compress it, say)
+        queue = self.queues.get(client)
+        if queue is not None:
+            if queue.pending:
+                self.written += queue.pendingBytes
+                queue.transport.writeSequence(queue.pending)
+                queue.pending = None
+                queue.pendingBytes = 0
+            queue.transport = transport
+        client.transport = transport
+
+    def detach(self, client):
+        queue = self.queues.pop(client, None)
+        if queue is not None:
+            self.dirty.discard(queue)
+            self.held.discard(queue)
+            # Whatever is still queued goes out before the connection leaves the engine
+            if queue.pending and not queue.transport.disconnecting:
+                self.written += queue.pendingBytes
+                queue.transport.writeSequence(queue.pending)
+            if queue.transport.producer is queue:
+                queue.transport.unregisterProducer()
+            for stream in queue.streams or ():
+                stream.interrupted()
+            queue.streams = None
+
+    def send(self, client, data):
+        queue = self.queues.get(client)
+        if queue is None:
+            self.written += len(data)
+            client.transport.write(data)
+        elif queue.push(data):
+            self._markDirty(queue, queue.batched)
+
+    def stream(self, client, source):
+        # Queues a stream to the client behind any it already has. source.produce()
+        # writes one chunk to the transport and returns False when there is no more;
+        # then source.finished() is called, or source.interrupted() if the client left.
+        queue = self.queues.get(client)
+        if queue is None:
+            source.interrupted()
+            return
+        if queue.streams is None:
+            queue.streams = deque()
+        queue.streams.append(source)
+        self._markDirty(queue)
+
+    def pump(self, queue):
+        # One chunk of the client's current stream, then back to the reactor, so that
+        # chat queued in the meantime goes out before the next chunk
+        stream = queue.streams[0]
+        if not stream.produce():
+            queue.streams.popleft()
+            stream.finished()
+            if not queue.streams:
+                queue.streams = None
+                return
+        self._markDirty(queue)
+
+    def publish(self, clients, data):
+        # ClientQueue.push inlined: this loop runs once per recipient of every broadcast
+        self.published += 1
+        size = len(data)
+        limit = self.max_buffer
+        queues = self.queues
+        dirty = self.dirty
+        held = self.held
+        delay = self.delay
+        now = self.clock.seconds() if delay else 0.0
+        for client in clients:
+            queue = queues.get(client)
+            if queue is None:
+                continue
+            if queue.pendingBytes + size > limit:
+                queue.overflow()
+                continue
+            if queue.pending is None:
+                queue.pending = [data]
+            else:
+                queue.pending.append(data)
+            queue.pendingBytes += size
+            if queue.batched and now - queue.flushed < delay and queue.pendingBytes < self.batch_bytes:
+                held.add(queue)
+            else:
+                dirty.add(queue)
+        if dirty and self._flushCall is None:
+            self._flushCall = self.clock.callLater(0, self.flush)
+        if held and self._heldCall is None:
+            self._heldCall = self.clock.callLater(delay, self.flushHeld)
+
+    def _markDirty(self, queue, batched=False):
+        if (batched and self.clock.seconds() - queue.flushed < self.delay
+                and queue.pendingBytes < self.batch_bytes):
+            self.held.add(queue)
+            if self._heldCall is None:
+                self._heldCall = self.clock.callLater(self.delay, self.flushHeld)
+            return
+        self.dirty.add(queue)
+        if self._flushCall is None:
+            self._flushCall = self.clock.callLater(0, self.flush)
+
+    def pendingBytes(self):
+        return sum(queue.pendingBytes for queue in self.queues.values())
+
+    def flush(self):
+        self._flushCall = None
+        dirty, self.dirty = self.dirty, set()
+        for queue in dirty:
+            queue.flush()
+
+    def flushHeld(self):
+        self._heldCall = None
+        held, self.held = self.held, set()
+        for queue in held:
+            queue.flush()
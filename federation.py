@@ -0,0 +1,290 @@
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from twisted.internet import protocol, reactor
+from chatlog import logger
+from framing import FrameReceiver
+
+# Frames carried by a federation link between two chat nodes
+FED_HELLO = 32
+FED_JOIN = 33
+FED_LEAVE = 34
+FED_SEND = 35
+FED_BROADCAST = 36
+FED_AUTH = 37
+
+CHALLENGE_SIZE = 16
+PROOF_SIZE = hashlib.sha256().digest_size
+
+FEDERATE_COMMAND = "/federate"
+
+class FederationLink(FrameReceiver):
+    # The single link between this node and one peer node. Routing updates, forwarded
+    # /send messages and broadcasts for every user of both nodes share it.
+    #
+    # A node dials a peer's ordinary chat port and upgrades the connection with a
+    # "/federate <node_id> <challenge>" line. Both nodes must hold the federation key: the
+    # peer answers with a HELLO frame carrying its own challenge and node ID and a proof
+    # (HMAC with the key) over the dialler's challenge, and the dialler answers that with
+    # an AUTH frame proving the same over the peer's. Until then no other frame is taken.
+    # The dialling side skips the welcome line the peer sends to every new connection.
+    def __init__(self, federation, node_id=None, dialer=None, challenge=None):
+        self.federation = federation
+        self.node_id = node_id
+        self.dialer = dialer
+        self.greeted = dialer is None
+        self.linkFactory = None
+        self.challenge = challenge  # the dialler's, on the accepting side
+        self.nonce = os.urandom(CHALLENGE_SIZE)
+        self.authenticated = False
+
+    def connectionMade(self):
+        own_id = self.federation.node_id.encode('utf-8')
+        if self.dialer is None:
+            self.dialer = self.node_id
+            proof = self.federation.proof(b"hello", self.challenge, own_id)
+            self.sendFrame(FED_HELLO, self.nonce + proof + own_id)
+        else:
+            self.transport.write(f"{FEDERATE_COMMAND} {self.federation.node_id} {self.nonce.hex()}\r\n".encode('utf-8'))
+
+    def dataReceived(self, data):
+        if not self.greeted:
+            end = data.find(b"\n")
+            if end < 0:
+                return
+            self.greeted = True
+            data = data[end + 1:]
+        if data:
+            super().dataReceived(data)
+
+    def frameReceived(self, frame_type, flags, payload):
+        payload = bytes(payload)
+        if self.authenticated:
+            self.federation.frameReceived(self, frame_type, payload)
+        elif frame_type == FED_HELLO and self.linkFactory is not None:
+            challenge, proof, node_id = (payload[:CHALLENGE_SIZE], payload[CHALLENGE_SIZE:CHALLENGE_SIZE + PROOF_SIZE],
+                                         payload[CHALLENGE_SIZE + PROOF_SIZE:])
+            if not self.federation.verify(proof, b"hello", self.nonce, node_id):
+                self.refuse("wrong federation key")
+                return
+            self.node_id = node_id.decode('utf-8')
+            self.sendFrame(FED_AUTH, self.federation.proof(b"auth", challenge, self.federation.node_id.encode('utf-8')))
+            self.authenticated = True
+            self.federation.linkUp(self)
+        elif frame_type == FED_AUTH and self.linkFactory is None:
+            if not self.federation.verify(payload, b"auth", self.nonce, self.node_id.encode('utf-8')):
+                self.refuse("wrong federation key")
+                return
+            self.authenticated = True
+            self.federation.linkUp(self)
+        else:
+            self.refuse(f"unexpected frame {frame_type} before authentication")
+
+    def refuse(self, reason):
+        peer = self.transport.getPeer()
+        logger.log(f"Refused federation link with {peer.host}:{peer.port}: {reason}")
+        self.federation.drop(self)  # a dialler retrying with the same key would fail the same way
+
+    def connectionLost(self, reason):
+        self.federation.linkDown(self)
+
+class FederationLinkFactory(protocol.ReconnectingClientFactory):
+    # Keeps the dialled link to one peer node up, backing off exponentially between attempts
+    maxDelay = 30
+    initialDelay = 0.5
+
+    def __init__(self, federation, address):
+        self.federation = federation
+        self.address = address
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        link = FederationLink(self.federation, dialer=self.federation.node_id)
+        link.linkFactory = self
+        return link
+
+    def clientConnectionFailed(self, connector, reason):
+        logger.log(f"Connection to node {self.address[0]}:{self.address[1]} failed, retrying")
+        super().clientConnectionFailed(connector, reason)
+
+class Federation:
+    # Node-to-node routing for one ChatFactory. Peers announce the users they host, so
+    # /send to a user on another node travels over that node's link, and broadcasts are
+    # flooded across the mesh once, deduplicated by message ID.
+    #
+    # With --workers every worker is a node of its own. It announces the users of the
+    # whole server, and hands what arrives from its links to the other workers over the
+    # worker bus. A user's /send and a broadcast may then reach a worker twice, through
+    # its own link and through a sibling's, so /send messages carry a message ID as well.
+    #
+    # The node ID is the node's address plus a random part drawn at every start, so
+    # nodes listening on the same address (0.0.0.0:9000, say) stay apart, and message IDs
+    # from before a restart never match those after it.
+    #
+    # Federation is off without a key: the node neither dials nor accepts links. With
+    # peers given, only connections from those hosts may ask for a link.
+    def __init__(self, factory, address, seen_limit=65536, key=None, peers=()):
+        self.factory = factory
+        self.node_id = f"{address}/{os.urandom(4).hex()}"
+        self.key = key
+        self.peers = set(peers)
+        self.links = {}
+        self.routes = {}  # user -> IDs of the peer nodes holding a connection of theirs
+        self.connectors = {}
+        self.seen = OrderedDict()
+        self.seen_limit = seen_limit
+        self.sequence = 0
+        self.forwarded = 0
+        self.duplicates = 0
+
+    def proof(self, *parts):
+        return hmac.new(self.key, b"\0".join(parts), hashlib.sha256).digest()
+
+    def verify(self, proof, *parts):
+        return hmac.compare_digest(proof, self.proof(*parts))
+
+    def admits(self, host):
+        return self.key is not None and (not self.peers or host in self.peers)
+
+    def connect(self, ip, port):
+        if self.key is None:
+            return None
+        address = (ip, port)
+        if address in self.connectors:
+            return self.connectors[address]  # one pooled link per peer node
+        link_factory = FederationLinkFactory(self, address)
+        self.connectors[address] = link_factory
+        reactor.connectTCP(ip, port, link_factory)
+        return link_factory
+
+    def accept(self, transport, node_id, challenge):
+        link = FederationLink(self, node_id, challenge=challenge)
+        link.makeConnection(transport)
+        return link
+
+    def linkUp(self, link):
+        existing = self.links.get(link.node_id)
+        if existing is not None and existing is not link and existing.transport.connected:
+            # Both nodes dialled each other; both keep the link dialled by the lower node ID
+            if existing.dialer <= link.dialer:
+                self.drop(link)
+                return
+            self.drop(existing)
+        self.links[link.node_id] = link
+        logger.log(f"Linked with node {link.node_id}")
+        for user in self.users():
+            link.sendFrame(FED_JOIN, user.encode('utf-8'))
+
+    def users(self):
+        # The users of this process and, with workers, those of the other workers
+        users = set(self.factory.registry.users)
+        if self.factory.bus is not None:
+            users.update(self.factory.bus.directory)
+        return users
+
+    def drop(self, link):
+        if link.linkFactory is not None:
+            link.linkFactory.stopTrying()
+            self.connectors.pop(link.linkFactory.address, None)
+        link.node_id, node_id = None, link.node_id
+        link.transport.loseConnection()
+        if self.links.get(node_id) is link:
+            del self.links[node_id]
+
+    def linkDown(self, link):
+        if link.node_id is not None and self.links.get(link.node_id) is link:
+            del self.links[link.node_id]
+            for user in [user for user, node_ids in self.routes.items() if link.node_id in node_ids]:
+                self.forget(user, link.node_id)
+            logger.log(f"Lost link with node {link.node_id}")
+
+    def announce(self, frame_type, user):
+        payload = user.encode('utf-8')
+        for link in self.links.values():
+            link.sendFrame(frame_type, payload)
+
+    def join(self, user):
+        self.announce(FED_JOIN, user)
+
+    def leave(self, user):
+        self.announce(FED_LEAVE, user)
+
+    def send(self, user, message):
+        # To every peer node the user is connected to
+        links = [self.links[node_id] for node_id in self.routes.get(user, ()) if node_id in self.links]
+        if not links:
+            return False
+        payload = b"\0".join((self.messageId(), user.encode('utf-8'), message))
+        for link in links:
+            self.forwarded += 1
+            link.sendFrame(FED_SEND, payload)
+        return True
+
+    def messageId(self):
+        self.sequence += 1
+        message_id = f"{self.node_id}/{self.sequence}".encode('utf-8')
+        self.markSeen(message_id)
+        return message_id
+
+    def sent(self, payload):
+        # A /send from another node for connections of this process; returns the user,
+        # or None if it came here before
+        message_id, user, message = payload.split(b"\0", 2)
+        if not self.markSeen(message_id):
+            return None
+        user = user.decode('utf-8')
+        self.factory.deliver(user, message)
+        return user
+
+    def forget(self, user, node_id):
+        node_ids = self.routes.get(user)
+        if node_ids is not None:
+            node_ids.discard(node_id)
+            if not node_ids:
+                del self.routes[user]
+
+    def broadcast(self, message):
+        # Returns the broadcast as it goes to other nodes, for the worker bus to pass on
+        payload = self.messageId() + b"\0" + message
+        self.flood(payload, None)
+        return payload
+
+    def relay(self, payload, source):
+        # A broadcast from another node, or from another worker (source None): to this
+        # process's clients and on across the mesh, once. Returns whether it was new.
+        message_id, message = payload.split(b"\0", 1)
+        if not self.markSeen(message_id):
+            return False
+        self.factory.broadcastLocal(message)
+        self.flood(payload, source)
+        return True
+
+    def flood(self, payload, source):
+        for link in self.links.values():
+            if link is not source:
+                self.forwarded += 1
+                link.sendFrame(FED_BROADCAST, payload)
+
+    def markSeen(self, message_id):
+        if message_id in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen[message_id] = True
+        if len(self.seen) > self.seen_limit:
+            self.seen.popitem(last=False)
+        return True
+
+    def frameReceived(self, link, frame_type, payload):
+        bus = self.factory.bus
+        if frame_type == FED_SEND:
+            user = self.sent(payload)
+            if user is not None and bus is not None:
+                bus.relaySend(user, payload)
+        elif frame_type == FED_BROADCAST:
+            if self.relay(payload, link) and bus is not None:
+                bus.broadcast(payload)
+        elif frame_type == FED_JOIN:
+            self.routes.setdefault(payload.decode('utf-8'), set()).add(link.node_id)
+        elif frame_type == FED_LEAVE:
+            self.forget(payload.decode('utf-8'), link.node_id)
@@ -0,0 +1,266 @@
+import hashlib
+import itertools
+import os
+from collections import OrderedDict, deque
+from twisted.internet import threads
+from chatlog import logger
+
+CHUNK_SIZE = 64 * 1024
+MAX_TRANSFERS = 4
+
+# SHA-256 of files by (path, size, mtime), so sending the same file again or resuming
+# a transfer does not read it all once more just to hash it
+digests = {}
+
+def file_digest(path):
+    # Returns (size, mtime, hex digest); runs on a thread, it reads the whole file
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    digest = digests.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        if len(digests) >= 1024:
+            digests.clear()
+        digests[key] = digest
+    return stat.st_size, stat.st_mtime_ns, digest
+
+def shared_file(directory, name):
+    # The file name refers to inside directory, or None if there is no such file there
+    if not directory:
+        return None
+    root = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    return path
+
+def buffer_empty(transport):
+    # Whether a Twisted TCP transport has none of its own data waiting to be written
+    data = getattr(transport, "dataBuffer", None)
+    return data is not None and len(data) == transport.offset and not transport._tempDataLen
+
+def send_chunk(transport, header, file, offset, length):
+    # Writes header and then length bytes of file from offset. When the transport has
+    # nothing buffered, so nothing can be overtaken, they go to the socket directly and
+    # the file data with os.sendfile, straight from the page cache; whatever the socket
+    # does not take right away is read and written through the transport as usual, and
+    # the transport's backpressure then pauses the stream. Returns the bytes sent by
+    # os.sendfile.
+    sent = 0
+    if hasattr(os, "sendfile") and buffer_empty(transport):
+        sock = transport.socket
+        try:
+            written = sock.send(header)
+            header = header[written:]
+            if not header:
+                sent = os.sendfile(sock.fileno(), file.fileno(), offset, length)
+        except BlockingIOError:
+            pass
+        except OSError:
+            pass  # the transport sees the broken connection on its next write
+    if header or sent < length:
+        transport.writeSequence([header, os.pread(file.fileno(), length - sent, offset + sent)])
+    return sent
+
+def pick_recipient(clients):
+    # A file goes to one connection of the user, the one they were last active on: the
+    # same file to each of their devices would multiply what is sent, and one that is
+    # cut off can be resumed from any connection logged in to the user's name
+    return max(clients, key=lambda client: client.session.last_seen)
+
+class Transfer:
+    # One file on its way to one connection. It is a stream of the recipient's fan-out
+    # queue, which pulls it a chunk at a time and only after writing the chat messages
+    # queued meanwhile, so a transfer never holds chat up by more than a chunk. The
+    # recipient protocol writes the chunks: startTransfer, sendFileChunk, endTransfer.
+    cipher = None  # set by recipients that encrypt the stream
+
+    def __init__(self, manager, transfer_id, sender, recipient, path, size, mtime, digest):
+        self.manager = manager
+        self.id = transfer_id
+        self.sender = sender
+        self.recipient = recipient
+        self.account = recipient.session.account  # who else may resume it: a connection logged in to it
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.offset = 0
+        self.file = None
+
+    def produce(self):
+        # Writes the next chunk; False once the whole file is out
+        if self.offset >= self.size or self.file is None:
+            return False
+        length = min(self.manager.chunk_size, self.size - self.offset)
+        self.manager.zero_copy_bytes += self.recipient.sendFileChunk(self, self.offset, length) or 0
+        self.manager.bytes_sent += length
+        self.offset += length
+        return True
+
+    def finished(self):
+        self.manager.finished(self)
+
+    def interrupted(self):
+        self.manager.interrupted(self)
+
+class TransferManager:
+    # The file transfers of one ChatFactory. At most max_active stream at once and the
+    # rest wait their turn. A transfer cut off by a disconnect is kept (the last keep of
+    # them) so its recipient can resume it from the offset it got to.
+    def __init__(self, fanout, max_active=MAX_TRANSFERS, chunk_size=CHUNK_SIZE, keep=256):
+        self.fanout = fanout
+        self.max_active = max_active
+        self.chunk_size = chunk_size
+        self.keep = keep
+        self.active = {}
+        self.waiting = deque()
+        self.stopped = OrderedDict()
+        self.completed = 0
+        self.bytes_sent = 0
+        self.zero_copy_bytes = 0
+        self._ids = itertools.count(1)
+
+    def sendFile(self, sender, recipient, path):
+        # Hashes the file on a thread first; fires with the queued Transfer
+        d = threads.deferToThread(file_digest, path)
+        d.addCallback(lambda result: self.add(Transfer(self, next(self._ids), sender, recipient, path, *result)))
+        return d
+
+    def resume(self, recipient, transfer_id, offset):
+        # A stopped transfer to this connection, or to the account it logged in to,
+        # continues from offset; None if there is none
+        transfer = self.stopped.get(transfer_id)
+        if transfer is None or not 0 <= offset <= transfer.size:
+            return None
+        if transfer.recipient is not recipient and (transfer.account is None
+                                                    or transfer.account != recipient.session.account):
+            return None
+        del self.stopped[transfer_id]
+        d = threads.deferToThread(file_digest, transfer.path)
+        d.addCallback(self.resumed, transfer, recipient, offset)
+        return d
+
+    def resumed(self, result, transfer, recipient, offset):
+        size, mtime, digest = result
+        if (size, mtime, digest) != (transfer.size, transfer.mtime, transfer.digest):
+            return None  # the file changed since, so the received part is of no use
+        transfer.recipient = recipient
+        transfer.offset = offset
+        return self.add(transfer)
+
+    def add(self, transfer):
+        if len(self.active) < self.max_active:
+            self.start(transfer)
+        else:
+            self.waiting.append(transfer)
+        return transfer
+
+    def start(self, transfer):
+        # Takes a slot only once the file is open; one that cannot be opened now is kept
+        # stopped like one whose recipient left
+        if transfer.recipient.transport.disconnecting or transfer.recipient not in self.fanout.queues:
+            self.keepStopped(transfer)
+            return
+        try:
+            transfer.file = open(transfer.path, 'rb')
+        except OSError as e:
+            logger.log(f"Cannot send {transfer.path}: {e}")
+            self.keepStopped(transfer)
+            return
+        self.active[transfer.id] = transfer
+        transfer.recipient.startTransfer(transfer)
+
+    def finished(self, transfer):
+        self.close(transfer)
+        self.completed += 1
+        transfer.recipient.endTransfer(transfer)
+        self.startWaiting()
+
+    def interrupted(self, transfer):
+        self.close(transfer)
+        self.keepStopped(transfer)
+        self.startWaiting()
+
+    def close(self, transfer):
+        self.active.pop(transfer.id, None)
+        if transfer.file is not None:
+            transfer.file.close()
+            transfer.file = None
+
+    def keepStopped(self, transfer):
+        self.stopped[transfer.id] = transfer
+        while len(self.stopped) > self.keep:
+            self.stopped.popitem(last=False)
+
+    def startWaiting(self):
+        while self.waiting and len(self.active) < self.max_active:
+            self.start(self.waiting.popleft())
+
+class IncomingFile:
+    def __init__(self, path, file, size, offset, digest, sha):
+        self.path = path
+        self.file = file
+        self.size = size
+        self.offset = offset
+        self.digest = digest
+        self.sha = sha
+        self.cipher = None
+
+class FileReceiver:
+    # Receiving side of transfers: writes the chunks of each file to <name>.part in
+    # directory, hashing as they arrive, and renames it to <name> once the file is
+    # complete and its SHA-256 matches. After a reconnect, offset(transfer_id) is where
+    # to ask the sender to resume from (/resumefile <id> <offset>).
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def offer(self, transfer_id, name, size, offset, digest):
+        # Returns the IncomingFile, or None if the part received before is shorter than offset
+        path = os.path.join(self.directory, os.path.basename(name))
+        part = path + ".part"
+        incoming = self.files.pop(transfer_id, None)
+        if incoming is not None:
+            incoming.file.close()
+        file = open(part, 'r+b' if os.path.exists(part) else 'w+b')
+        sha = hashlib.sha256()
+        remaining = offset
+        while remaining:
+            block = file.read(min(remaining, 1 << 20))
+            if not block:
+                file.close()
+                return None
+            sha.update(block)
+            remaining -= len(block)
+        file.truncate(offset)
+        incoming = self.files[transfer_id] = IncomingFile(path, file, size, offset, digest, sha)
+        return incoming
+
+    def chunk(self, transfer_id, data):
+        incoming = self.files.get(transfer_id)
+        if incoming is not None:
+            incoming.file.write(data)
+            incoming.sha.update(data)
+            incoming.offset += len(data)
+        return incoming
+
+    def done(self, transfer_id):
+        # The complete file's path, or None if it is short or its digest does not match
+        incoming = self.files.pop(transfer_id, None)
+        if incoming is None:
+            return None
+        incoming.file.close()
+        if incoming.offset != incoming.size or incoming.sha.hexdigest() != incoming.digest:
+            return None
+        os.replace(incoming.path + ".part", incoming.path)
+        return incoming.path
+
+    def offset(self, transfer_id):
+        incoming = self.files.get(transfer_id)
+        return incoming.offset if incoming is not None else 0
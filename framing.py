@@ -0,0 +1,92 @@
+import struct
+from twisted.internet import protocol
+
+# Every frame is a fixed header followed by the payload:
+#   length (uint32, payload bytes only) | version (uint8) | type (uint8) | flags (uint8)
+HEADER = struct.Struct("!IBBB")
+HEADER_SIZE = HEADER.size
+VERSION = 1
+
+FRAME_TEXT = 1
+FRAME_SESSION_KEY = 2
+FRAME_SESSION_MESSAGE = 3
+FRAME_FILE_OFFER = 4  # the offer text, sealed with the session
+FRAME_FILE_CHUNK = 5  # transfer ID (uint32) | chunk sealed with the stream's ChunkCipher
+FRAME_FILE_END = 6  # transfer ID (uint32)
+FRAME_GROUP_KEY = 7  # a sender key announcement, sealed with the session
+FRAME_GROUP_MESSAGE = 8  # key ID (uint32) | message sealed once with the sender key
+
+# Text, session and group message frames: the message (inside the encryption, for the
+# encrypted ones) is compressed with the codec the connection negotiated
+FLAG_COMPRESSED = 0x01
+
+def encode_frame(frame_type, payload, flags=0):
+    return HEADER.pack(len(payload), VERSION, frame_type, flags) + payload
+
+class FrameReceiver(protocol.Protocol):
+    # Int32StringReceiver-style receiver for length-prefixed frames. Complete frames are
+    # handed to frameReceived as memoryview slices of the received data, so pipelined
+    # frames are never copied; only a frame split across reads is joined, once, when
+    # its last byte has arrived.
+    #
+    # The receive state is allocated lazily and needs no pool: an idle connection has
+    # the class-level empty _chunks, and a split frame holds views of the bytes it came
+    # in, no more. LineReceiver (node.py) is the same between lines, its _buffer being
+    # the shared empty bytes. Twisted reads every socket into a new bytes object that is
+    # freed once dataReceived returns, so pooled fixed-size buffers would only add memory.
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    _chunks = ()
+    _pending = 0
+    _needed = HEADER_SIZE
+
+    def dataReceived(self, data):
+        if self._chunks:
+            self._chunks.append(data)
+            self._pending += len(data)
+            if self._pending < self._needed:
+                return
+            data = b"".join(self._chunks)
+        self._chunks = ()
+        self._pending = 0
+
+        view = memoryview(data)
+        offset = 0
+        end = len(data)
+        needed = HEADER_SIZE
+        while end - offset >= HEADER_SIZE:
+            length, version, frame_type, flags = HEADER.unpack_from(data, offset)
+            if version != VERSION:
+                self.frameError(f"unsupported frame version {version}")
+                return
+            if length > self.MAX_LENGTH:
+                self.lengthLimitExceeded(length)
+                return
+            frame_end = offset + HEADER_SIZE + length
+            if frame_end > end:
+                needed = frame_end - offset
+                break
+            self.frameReceived(frame_type, flags, view[offset + HEADER_SIZE:frame_end])
+            offset = frame_end
+            if self.transport is not None and self.transport.disconnecting:
+                return
+
+        if offset < end:
+            self._chunks = [view[offset:]]
+            self._pending = end - offset
+        self._needed = needed
+
+    def frameReceived(self, frame_type, flags, payload):
+        raise NotImplementedError
+
+    def sendFrame(self, frame_type, payload, flags=0):
+        if len(payload) > self.MAX_LENGTH:
+            raise ValueError(f"frame of {len(payload)} bytes exceeds {self.MAX_LENGTH}")
+        self.transport.writeSequence([HEADER.pack(len(payload), VERSION, frame_type, flags), payload])
+
+    def lengthLimitExceeded(self, length):
+        self.transport.loseConnection()
+
+    def frameError(self, reason):
+        print(f"Dropping connection: {reason}")
+        self.transport.loseConnection()
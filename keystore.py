@@ -0,0 +1,75 @@
+import os
+import queue
+import threading
+from Crypto.PublicKey import RSA
+
+KEY_BITS = 2048
+
+def export_pair(rsa_key):
+    private_key = rsa_key.export_key().decode('utf-8')
+    public_key = rsa_key.publickey().export_key().decode('utf-8')
+    return private_key, public_key
+
+def save_identity(path, rsa_key, passphrase=None):
+    if passphrase:
+        data = rsa_key.export_key(passphrase=passphrase, pkcs=8, protection="scryptAndAES128-CBC")
+    else:
+        data = rsa_key.export_key()
+    # Only the owner may read the identity file, even when it is passphrase protected
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+
+def load_identity(path, passphrase=None, bits=KEY_BITS):
+    # Loads the node identity from disk, creating it on first start. With no path the
+    # identity only lives in memory for the lifetime of the process.
+    if path and os.path.exists(path):
+        with open(path, 'rb') as file:
+            rsa_key = RSA.import_key(file.read(), passphrase=passphrase or None)
+    else:
+        rsa_key = RSA.generate(bits)
+        if path:
+            save_identity(path, rsa_key, passphrase)
+    return export_pair(rsa_key)
+
+class KeyPool:
+    # Key pairs generated ahead of time on a background thread so that handing one
+    # out never runs RSA generation on the reactor thread unless the pool ran dry.
+    def __init__(self, size=8, bits=KEY_BITS):
+        self.bits = bits
+        self.keys = queue.Queue(maxsize=size)
+        self.hits = 0
+        self.misses = 0
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._fill, name="KeyPool", daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _fill(self):
+        while not self._stopped.is_set():
+            pair = export_pair(RSA.generate(self.bits))
+            while not self._stopped.is_set():
+                try:
+                    self.keys.put(pair, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self):
+        try:
+            pair = self.keys.get_nowait()
+            self.hits += 1
+        except queue.Empty:
+            self.misses += 1
+            pair = export_pair(RSA.generate(self.bits))
+        return pair
+
+    def qsize(self):
+        return self.keys.qsize()
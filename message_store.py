@@ -0,0 +1,147 @@
+import queue
+import sqlite3
+import threading
+import time
+from twisted.internet import threads
+from encrypter import decrypt, encrypt, open_keyring
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    body BLOB NOT NULL,
+    delivered INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_recipient_time ON messages (recipient, timestamp);
+CREATE INDEX IF NOT EXISTS messages_pending ON messages (recipient, timestamp) WHERE delivered = 0;
+CREATE TABLE IF NOT EXISTS accounts (
+    name TEXT PRIMARY KEY,
+    salt BLOB NOT NULL,
+    digest BLOB NOT NULL
+);
+"""
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+class MessageStore:
+    # Chat messages kept in SQLite, bodies encrypted with the Fernet key from encrypter.py.
+    #
+    # Writes never touch the database on the calling (reactor) thread: they are queued for
+    # one writer thread, which commits whatever has accumulated as a single transaction.
+    # Reads run on the reactor's thread pool and return Deferreds.
+    #
+    # The keys are kept in keyring (path + ".keys" by default), so bodies encrypted
+    # with a key added by a rotation can still be read after a restart.
+    def __init__(self, path, batch_size=1000, keyring=None):
+        self.path = path
+        self.keyring = keyring or path + ".keys"
+        open_keyring(self.keyring)
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._writer = None
+        self._reader = connect(path)
+        self._readLock = threading.Lock()
+
+    def start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write, name="MessageStore", daemon=True)
+            self._writer.start()
+
+    def stop(self):
+        # Commits everything queued so far before returning
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def store(self, sender, recipient, message, delivered=True):
+        self._queue.put(("insert", (sender, recipient, time.time(), message, int(delivered))))
+
+    def markDelivered(self, ids):
+        self._queue.put(("delivered", [(message_id,) for message_id in ids]))
+
+    # Accounts (see accounts.py) are read and written at once, not through the writer
+    # thread: they are few, and workers sharing the file must agree on who registered first
+
+    def accounts(self):
+        # Every registered name's (salt, password digest)
+        with self._readLock:
+            rows = self._reader.execute("SELECT name, salt, digest FROM accounts").fetchall()
+        return {name: (salt, digest) for name, salt, digest in rows}
+
+    def account(self, name):
+        with self._readLock:
+            return self._reader.execute("SELECT salt, digest FROM accounts WHERE name = ?", (name,)).fetchone()
+
+    def register(self, name, salt, digest):
+        # Returns the name's (salt, digest): these, unless another process registered it first
+        with self._readLock, self._reader:
+            self._reader.execute("INSERT OR IGNORE INTO accounts (name, salt, digest) VALUES (?, ?, ?)",
+                                 (name, salt, digest))
+            return tuple(self._reader.execute("SELECT salt, digest FROM accounts WHERE name = ?", (name,)).fetchone())
+
+    def backlog(self):
+        return self._queue.qsize()
+
+    def _write(self):
+        conn = connect(self.path)
+        running = True
+        while running:
+            operations = [self._queue.get()]
+            while len(operations) < self.batch_size:
+                try:
+                    operations.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in operations:
+                running = False
+                operations = [operation for operation in operations if operation is not None]
+            rows = [(sender, recipient, timestamp, encrypt(message), delivered)
+                    for kind, (sender, recipient, timestamp, message, delivered)
+                    in (operation for operation in operations if operation[0] == "insert")]
+            with conn:
+                if rows:
+                    conn.executemany("INSERT INTO messages (sender, recipient, timestamp, body, delivered) "
+                                     "VALUES (?, ?, ?, ?, ?)", rows)
+                for kind, values in operations:
+                    if kind == "delivered":
+                        conn.executemany("UPDATE messages SET delivered = 1 WHERE id = ?", values)
+            self.written += len(rows)
+            self.batches += 1
+        conn.close()
+
+    def _query(self, sql, args):
+        with self._readLock:
+            rows = self._reader.execute(sql, args).fetchall()
+        return [(message_id, sender, timestamp, decrypt(body)) for message_id, sender, timestamp, body in rows]
+
+    def fetchPending(self, recipient, after=None, limit=500):
+        # Oldest first; pass the (timestamp, id) of the last row as after for the next page
+        after = after or (0, 0)
+        return self._query("SELECT id, sender, timestamp, body FROM messages "
+                           "WHERE recipient = ? AND delivered = 0 AND (timestamp, id) > (?, ?) "
+                           "ORDER BY timestamp, id LIMIT ?", (recipient, after[0], after[1], limit))
+
+    def fetchHistory(self, recipient, before=None, limit=20):
+        # Newest first; pass the (timestamp, id) of the last row as before for the next page
+        if before is None:
+            return self._query("SELECT id, sender, timestamp, body FROM messages WHERE recipient = ? "
+                               "ORDER BY timestamp DESC, id DESC LIMIT ?", (recipient, limit))
+        return self._query("SELECT id, sender, timestamp, body FROM messages WHERE recipient = ? "
+                           "AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?",
+                           (recipient, before[0], before[1], limit))
+
+    def pending(self, recipient, after=None, limit=500):
+        return threads.deferToThread(self.fetchPending, recipient, after, limit)
+
+    def history(self, recipient, before=None, limit=20):
+        return threads.deferToThread(self.fetchHistory, recipient, before, limit)
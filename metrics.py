@@ -0,0 +1,170 @@
+import time
+from twisted.internet import reactor
+from twisted.web import resource, server
+from chatlog import logger
+from commands import UsageError, choice
+
+# Latency histogram with power-of-two buckets in microseconds: bucket i counts the
+# observations below 2**i microseconds. Observing is a couple of integer operations,
+# cheap enough for the hot path.
+BUCKETS = 32
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[min(int(seconds * 1000000).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, in seconds
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(2 ** index / 1000000, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return (f"n={self.count} mean={self.mean() * 1000:.3f}ms p50={self.percentile(0.5) * 1000:.3f}ms "
+                f"p99={self.percentile(0.99) * 1000:.3f}ms max={self.max * 1000:.3f}ms")
+
+class Metrics:
+    # Counters, gauges and histograms of one chat node, shown by /stats and served in
+    # the Prometheus text format. Counters are bumped on the hot path, so they are plain
+    # dict entries; gauges are functions that are only called when someone looks.
+    def __init__(self, prefix="chat", clock=time.time):
+        self.prefix = prefix
+        self.clock = clock
+        self.started = clock()
+        self.counters = {}
+        self.gauges = {}  # name -> (function, "gauge" or "counter")
+        self.histograms = {}  # name -> (label name, {label value: Histogram})
+
+    def inc(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, function, kind="gauge"):
+        self.gauges[name] = (function, kind)
+
+    def histogram(self, name, label, label_name="command"):
+        histograms = self.histograms.get(name)
+        if histograms is None:
+            histograms = self.histograms[name] = (label_name, {})
+        histogram = histograms[1].get(label)
+        if histogram is None:
+            histogram = histograms[1][label] = Histogram()
+        return histogram
+
+    def histogramSet(self, name, histograms, label_name):
+        # Exposes histograms kept elsewhere, for example a CryptoExecutor's
+        self.histograms[name] = (label_name, histograms)
+
+    def observe(self, name, label, seconds):
+        self.histogram(name, label).observe(seconds)
+
+    def uptime(self):
+        return self.clock() - self.started
+
+    def summary(self):
+        uptime = max(self.uptime(), 1e-9)
+        lines = [f"uptime {uptime:.0f}s"]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name} {value} ({value / uptime:.1f}/s)")
+        for name, (function, kind) in sorted(self.gauges.items()):
+            lines.append(f"{name} {function()}")
+        for name, (label_name, histograms) in sorted(self.histograms.items()):
+            for label, histogram in sorted(histograms.items()):
+                lines.append(f"{name}{{{label_name}={label}}} {histogram.summary()}")
+        return lines
+
+    def render(self):
+        prefix = self.prefix
+        lines = [f"# TYPE {prefix}_uptime_seconds gauge", f"{prefix}_uptime_seconds {self.uptime():.3f}"]
+        for name, value in sorted(self.counters.items()):
+            lines += [f"# TYPE {prefix}_{name} counter", f"{prefix}_{name} {value}"]
+        for name, (function, kind) in sorted(self.gauges.items()):
+            lines += [f"# TYPE {prefix}_{name} {kind}", f"{prefix}_{name} {function()}"]
+        for name, (label_name, histograms) in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for label, histogram in sorted(histograms.items()):
+                labels = f'{label_name}="{label}"'
+                last = max((index for index, count in enumerate(histogram.buckets) if count), default=0)
+                cumulative = 0
+                for index in range(last + 1):
+                    cumulative += histogram.buckets[index]
+                    lines.append(f'{prefix}_{name}_bucket{{{labels},le="{2 ** index / 1000000:g}"}} {cumulative}')
+                lines += [f'{prefix}_{name}_bucket{{{labels},le="+Inf"}} {histogram.count}',
+                          f'{prefix}_{name}_sum{{{labels}}} {histogram.total:.6f}',
+                          f'{prefix}_{name}_count{{{labels}}} {histogram.count}']
+        return "\n".join(lines) + "\n"
+
+class MetricsPage(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return self.metrics.render().encode('utf-8')
+
+def listen_metrics(metrics, port, interface="127.0.0.1"):
+    # Serves the metrics at http://<interface>:<port>/ (any path) for Prometheus to scrape
+    return reactor.listenTCP(port, server.Site(MetricsPage(metrics)), interface=interface)
+
+def node_metrics(factory):
+    # The metrics of what node.py's and test.py's factories have in common; each adds
+    # those of its own parts
+    metrics = Metrics()
+    metrics.gauge("connected_clients", lambda: len(factory.registry))
+    metrics.gauge("users", lambda: len(factory.registry.users))
+    metrics.gauge("rooms", lambda: len(factory.rooms.rooms))
+    metrics.gauge("bytes_sent_total", lambda: factory.fanout.written, "counter")
+    metrics.gauge("fanout_pending_bytes", lambda: factory.fanout.pendingBytes())
+    metrics.gauge("fanout_dropped_total", lambda: factory.fanout.dropped, "counter")
+    metrics.gauge("idle_reaped_total", lambda: factory.reaper.reaped, "counter")
+    metrics.gauge("transfers_active", lambda: len(factory.transfers.active))
+    metrics.gauge("transfers_waiting", lambda: len(factory.transfers.waiting))
+    metrics.gauge("file_bytes_sent_total", lambda: factory.transfers.bytes_sent, "counter")
+    metrics.gauge("compression_input_bytes_total", lambda: factory.compression.raw, "counter")
+    metrics.gauge("compression_output_bytes_total", lambda: factory.compression.compressed, "counter")
+    metrics.gauge("log_lines_dropped_total", lambda: logger.dropped, "counter")
+    if factory.store:
+        metrics.gauge("store_backlog", factory.store.backlog)
+    return metrics
+
+def show_stats(protocol):
+    # /stats, a method of both servers' protocols
+    protocol.sendLine("\n".join(protocol.factory.metrics.summary()).encode('utf-8'))
+
+def profile(console, action):
+    # /profile start samples the reactor thread until /profile stop prints the report
+    profiler = console.factory.profiler
+    if action == "start" and not profiler.running:
+        profiler.start()
+        print("Profiling the reactor thread; /profile stop to see the report")
+    elif action == "stop" and profiler.running:
+        profiler.stop()
+        print("\n".join(profiler.report()))
+    else:
+        raise UsageError(action)
+
+def add_profile_command(commands):
+    # For server consoles: the profiler runs in the server's process
+    commands.add("/profile", profile, [choice("start", "stop")], usage="/profile start|stop",
+                 help="Sample the reactor thread until /profile stop prints where it spends its time")
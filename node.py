@@ -1,128 +1,275 @@
+import argparse
+import time
 from twisted.internet import reactor, protocol, stdio
 from twisted.protocols import basic
+from accounts import Accounts
+from chatcore import ChatConsoleBase, ChatFactoryBase, ChatProtocolBase
+from chatlog import logger
+from commands import UsageError, chat_commands
+from compression import CODECS, CompressedTransport, Compression, StreamSwitch, caps_request, codec_names
+from fanout import FanOut
+from filetransfer import MAX_TRANSFERS, FileReceiver, TransferManager, send_chunk
+from message_store import MessageStore
+from metrics import add_profile_command, listen_metrics, node_metrics
+from federation import FEDERATE_COMMAND, Federation
+from profiler import SamplingProfiler
+from registry import ClientRegistry, IdleReaper
+from rooms import RoomRouter
+import workers
 
-class ChatProtocol(basic.LineReceiver):
-    def __init__(self, factory):
-        self.factory = factory
+def text_line(message):
+    # What users write, as a line to clients. Only the server's own lines (/hello, /file,
+    # /chunk...) start with a single "/", so user text that starts with one gets a second
+    # one, and a line break in it loses its "\r" so it cannot start a line of its own.
+    if b"\r\n" in message:
+        message = message.replace(b"\r", b"")
+    if message[:1] == b"/":
+        message = b"/" + message
+    return message
 
-    def connectionMade(self):
-        peer = self.transport.getPeer()
-        print(f"Client connected from {peer.host}:{peer.port}")
-        print(f"Server running on {self.factory.server_ip}:{self.factory.server_port}")
-        self.factory.clients[peer.host] = self
-        self.sendLine(b"Welcome to the chat server!")
+class ChatProtocol(ChatProtocolBase, basic.LineReceiver):
+    commands = chat_commands()
+
+    # One of these per connection, so what most connections never set stays on the class
+    link = None
+    session = None
 
     def connectionLost(self, reason):
+        if self.link:
+            self.link.connectionLost(reason)
+            return
         peer = self.transport.getPeer()
-        print(f"Client disconnected from {peer.host}:{peer.port}")
-        del self.factory.clients[peer.host]
+        if not hasattr(peer, "host"):
+            return  # the console's stdio closed
+        logger.log(f"Client disconnected from {peer.host}:{peer.port}")
+        self.factory.metrics.inc("disconnections_total")
+        self.leave()
 
-    def lineReceived(self, line):
-        line = line.decode('utf-8')
-        if line.startswith("/disconnect"):
-            self.disconnectClient()
-        elif line.startswith("/exit"):
-            reactor.stop()
-        elif line.startswith("/send"):
-            self.sendToClient(line)
-        elif line.startswith("/broadcast"):
-            self.broadcastMessage(line)
-        elif line.startswith("/help"):
-            self.showHelp()
-        elif line.startswith("/connect"):
-            self.connectToServer(line)
-        else:
-            print(f"Received message: {line}")
-            self.broadcast(line)
-
-    def sendToClient(self, line):
-        parts = line.split(" ", 2)
-        if len(parts) == 3:
-            dest_ip, message = parts[1:]
-            client = self.factory.clients.get(dest_ip)
-            if client:
-                client.sendLine(message.encode('utf-8'))
-            else:
-                self.sendLine(f"Client with IP {dest_ip} not found.".encode('utf-8'))
+    def leave(self):
+        self.factory.rooms.leaveAll(self.session)
+        self.factory.registry.unregister(self.session)
+        self.factory.fanout.detach(self)
+
+    def sendLine(self, line):
+        # Goes through the fan-out queue so replies stay in order with broadcasts
+        self.factory.fanout.send(self, line + self.delimiter)
+
+    def chatMessage(self, line):
+        if not self.federate(line):
+            super().chatMessage(line)
+
+    def setCapabilities(self, options=b""):
+        # The confirmation is the last line sent as is; from the next one on the client
+        # gets a compressed stream, if it asked for one. Compression stays as it was
+        # first negotiated.
+        compression = self.factory.compression
+        codec, batch = compression.negotiate(bytes(options).decode('utf-8'))
+        if isinstance(self.transport, CompressedTransport):
+            codec = self.transport.codec
+        if batch:
+            self.factory.fanout.batch(self)
+        self.sendLine(compression.confirmation(self.session.conn_id, codec, batch))
+        if codec is not None and not isinstance(self.transport, CompressedTransport):
+            self.factory.fanout.wrapTransport(self, compression.transport(self.transport, codec))
+
+    def sendToClient(self, user, message):
+        # Kept past this line by the queues and the store, so it becomes bytes once here
+        super().sendToClient(user, bytes(message))
+
+    # The recipient's side of a transfer: a "/file" line announces the file (again from
+    # an offset on resume), every chunk is a "/chunk <id> <length>" line followed by
+    # that many raw bytes, and "/filedone <id>" ends it
+    def startTransfer(self, transfer):
+        self.sendLine(f"/file {transfer.id} {transfer.size} {transfer.offset} {transfer.digest} {transfer.name}".encode('utf-8'))
+        self.factory.fanout.stream(self, transfer)
+
+    def sendFileChunk(self, transfer, offset, length):
+        return send_chunk(self.transport, f"/chunk {transfer.id} {length}\r\n".encode('utf-8'), transfer.file, offset, length)
+
+    def endTransfer(self, transfer):
+        self.sendLine(f"/filedone {transfer.id}".encode('utf-8'))
+
+    def sendHistory(self, rows):
+        for message_id, sender, timestamp, message in reversed(rows):
+            self.sendLine(f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}] {sender}: {message}".encode('utf-8'))
+        if rows:
+            self.sendLine(f"Older messages: /history {rows[-1][2]}:{rows[-1][0]}".encode('utf-8'))
         else:
-            self.sendLine("Invalid command usage. Use /send <IP> <message>".encode('utf-8'))
+            self.sendLine(b"No more messages.")
+
+    def joinRoom(self, room):
+        self.factory.rooms.join(self.session, room)
+        self.sendLine(f"Joined {room}".encode('utf-8'))
 
-    def showHelp(self):
-        help_message = """Available commands:
-                        /exit: Stop the server
-                        /send <IP>: Send a message to a specific client
-                        /broadcast <message>: Send a message to all connected clients
-                        /help: Show this help message
-                        /connect <IP> <port>: Connect to a server"""
-        self.sendLine(help_message.encode('utf-8'))
+    def leaveRoom(self, room):
+        if room not in self.session.rooms:
+            raise UsageError(room)
+        self.factory.rooms.leave(self.session, room)
+        self.sendLine(f"Left {room}".encode('utf-8'))
 
-    def broadcastMessage(self, line):
-        message = line[len("/broadcast"):].strip()  # Extract the message from the command
-        self.broadcast(message.encode('utf-8'))
+    def messageRoom(self, room, message):
+        if room not in self.session.rooms:
+            raise UsageError(room)
+        # The body is copied once, straight from the received line into the published bytes
+        data = b"".join((f"{room} {self.session.user}: ".encode('utf-8'), message, self.delimiter))
+        if data.find(self.delimiter, 0, len(data) - len(self.delimiter)) >= 0:
+            data = text_line(data[:-len(self.delimiter)]) + self.delimiter
+        self.factory.rooms.publish(room, data)
 
     def broadcast(self, message):
-        message_str = message.decode('utf-8')  # Convert bytes to string
-        for client in self.factory.clients.values():
-            client.sendLine(message_str.encode('utf-8'))  # Send the string message
-
-    def disconnectClient(self):
-        self.transport.loseConnection()
-
-    def connectToServer(self, line):
-        parts = line.split(" ")
-        if len(parts) == 3:
-            ip, port = parts[1], int(parts[2])
-            reactor.connectTCP(ip, port, ChatClientFactory())
-        else:
-            self.sendLine("Invalid command usage. Use /connect <IP> <port>".encode('utf-8'))
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        self.factory.broadcast(message)
+
+    def connectToServer(self, ip, port):
+        if self.factory.federation.connect(ip, port) is None:
+            self.sendLine(b"Federation is off on this server (no --federation-key)")
 
-class ChatFactory(protocol.Factory):
-    def __init__(self, server_ip, server_port):
-        self.clients = {}
+    def federate(self, line):
+        # Another node dialled in with "/federate <node> <challenge>": from here on this
+        # connection is a federation link. Not a chat command, and only taken from allowed
+        # hosts of a node with a federation key; the link then checks the peer holds it too.
+        federation = self.factory.federation
+        if not line.startswith(FEDERATE_COMMAND.encode('utf-8') + b" ") or not federation.admits(self.transport.getPeer().host):
+            return False
+        try:
+            node_id, challenge = line.decode('utf-8').split()[1:]
+            challenge = bytes.fromhex(challenge)
+        except ValueError:
+            return False
+        self.leave()
+        self.setRawMode()
+        self.link = federation.accept(self.transport, node_id, challenge)
+        return True
+
+    def rawDataReceived(self, data):
+        self.link.dataReceived(data)
+
+class ChatFactory(ChatFactoryBase, protocol.Factory):
+    protocol = ChatProtocol
+
+    def __init__(self, server_ip, server_port, history=0, store=None, max_clients=0, idle_timeout=0, files_dir=None,
+                 max_transfers=MAX_TRANSFERS, compress=None, batch_ms=0, federation_key=None, federation_peers=()):
+        self.registry = ClientRegistry(self.announce, self.withdraw)
+        self.max_clients = max_clients
+        self.reaper = IdleReaper(self.registry, idle_timeout)
         self.server_ip = server_ip
         self.server_port = server_port
+        self.compression = Compression(compress, batch_ms)
+        self.fanout = FanOut(delay=batch_ms / 1000)
+        self.files_dir = files_dir
+        self.transfers = TransferManager(self.fanout, max_transfers)
+        self.rooms = RoomRouter(self.registry, self.fanout, history)
+        self.bus = None  # set when running as one of several worker processes
+        self.federation = Federation(self, f"{server_ip}:{server_port}", key=federation_key, peers=federation_peers)
+        self.store = store
+        self.accounts = Accounts(store)
+        self.profiler = SamplingProfiler()
+        self.metrics = node_metrics(self)
+        self.metrics.gauge("federation_links", lambda: len(self.federation.links))
+        self.metrics.gauge("federation_forwarded_total", lambda: self.federation.forwarded, "counter")
+        self.metrics.gauge("file_zero_copy_bytes_total", lambda: self.transfers.zero_copy_bytes, "counter")
 
-    def buildProtocol(self, addr):
-        return ChatProtocol(self)
+    def deliver(self, user, message):
+        # Every connection of the user gets the message
+        clients = self.findClients(user)
+        message = text_line(message)
+        for client in clients:
+            client.sendLine(message)
+        return bool(clients)
+
+    def route(self, user, message):
+        # Every connection of the user gets it: those of this process and those on each
+        # worker and node that announced the user
+        delivered = self.deliver(user, message)
+        if self.bus is not None and self.bus.send(user, message):
+            delivered = True
+        if self.federation.send(user, message):
+            delivered = True
+        return delivered
+
+    # Called by the registry when a user's first connection arrives or the last one leaves
+    def announce(self, user):
+        if self.bus:
+            self.bus.join(user)
+        self.federation.join(user)
+        super().announce(user)
+
+    def withdraw(self, user):
+        if self.bus:
+            self.bus.leave(user)
+            if user in self.bus.directory:
+                return  # still on another worker, which other nodes reach through this one too
+        self.federation.leave(user)
+
+    def broadcastLocal(self, message):
+        # Serialized once, the same bytes are queued to every client
+        self.fanout.publish(self.registry, text_line(message) + ChatProtocol.delimiter)
+
+    def broadcast(self, message):
+        self.broadcastLocal(message)
+        payload = self.federation.broadcast(message)
+        if self.bus:
+            self.bus.broadcast(payload)
+
+class ChatConsoleProtocol(ChatConsoleBase, ChatProtocol, protocol.Protocol):
+    commands = ChatProtocol.commands.copy("/exit", "/send", "/sendfile", "/broadcast", "/connect", "/stats", "/help")
+    add_profile_command(commands)
 
-class ChatConsoleProtocol(ChatProtocol, protocol.Protocol):
-    def connectionMade(self):
-        self.transport.write(b">>> ")  # Write prompt symbol when connection is made
 
-    def dataReceived(self, data):
-        command = data.strip().decode("utf-8")  # Decode bytes to string and remove leading/trailing whitespace
-        if command == "/exit":
-            reactor.stop()  # Stop the server
-        elif command.startswith("/send"):
-            self.prepareMessage(command)
-        elif command.startswith("/help"):
-            super().showHelp()
-        elif command.startswith("/broadcast"):
-            self.broadcastMessage(command)
-        elif command.startswith("/connect"):
-            super().connectToServer(command)
-        else:
-            print("Unknown command. Type '/help' to see the list of valid commands.")
-        self.transport.write(b">>> ")  # Write prompt symbol again after handling command
-
-    def prepareMessage(self, command):
-        parts = command.split(" ", 2)
-        if len(parts) == 3:
-            dest_ip, message = parts[1:]
-            client = self.factory.clients.get(dest_ip)
-            if client:
-                client.sendLine(message.encode('utf-8'))
-            else:
-                print(f"Client with IP {dest_ip} not found.")
-        else:
-            print("Invalid command usage. Use /send <IP> <message>")
 
-class ChatClientProtocol(protocol.Protocol):
+
+class ChatClientProtocol(basic.LineReceiver):
+    # Prints what the server sends and saves files sent to it into directory. It asks
+    # for the best compression the server offers and for batching.
+    def __init__(self, directory="."):
+        self.files = FileReceiver(directory)
+        self.receiving = None
+        self.remaining = 0
+        self.switch = None
+
     def connectionMade(self):
         print("Connected to server")
 
     def dataReceived(self, data):
-        print(f"Received message: {data.decode('utf-8')}")
+        if self.switch is not None:
+            data = self.switch.feed(data)
+        super().dataReceived(data)
+
+    def lineReceived(self, line):
+        if line[:2] == b"//":
+            print(f"Received message: {line[1:].decode('utf-8')}")  # user text, see text_line
+            return
+        command, _, rest = line.partition(b" ")
+        if command == b"/hello":
+            token, request, codec = caps_request(line)
+            self.switch = StreamSwitch(token, CODECS.get(codec))
+            self.sendLine(request)
+        elif command == b"/caps":
+            pass
+        elif command == b"/chunk":
+            transfer_id, length = rest.split()
+            self.receiving = int(transfer_id)
+            self.remaining = int(length)
+            self.setRawMode()
+        elif command == b"/file":
+            transfer_id, size, offset, digest, name = rest.decode('utf-8').split(" ", 4)
+            if self.files.offer(int(transfer_id), name, int(size), int(offset), digest) is None:
+                print(f"Cannot resume {name}: the part received before is gone")
+        elif command == b"/filedone":
+            path = self.files.done(int(rest))
+            print(f"Received file {path}" if path else f"Transfer {int(rest)} arrived damaged")
+        else:
+            print(f"Received message: {line.decode('utf-8')}")
+
+    def rawDataReceived(self, data):
+        chunk = data[:self.remaining]
+        self.files.chunk(self.receiving, chunk)
+        self.remaining -= len(chunk)
+        if not self.remaining:
+            self.setLineMode()
+            # Already decompressed, so past dataReceived straight back to the line parser
+            basic.LineReceiver.dataReceived(self, data[len(chunk):])
 
     def connectionLost(self, reason):
         print("Connection lost")
@@ -134,13 +281,91 @@ class ChatClientFactory(protocol.ClientFactory):
     def clientConnectionFailed(self, connector, reason):
         print("Connection failed")
 
+def open_store(args):
+    return MessageStore(args.store, keyring=args.keyring) if args.store else None
+
+def read_federation_key(args):
+    if not args.federation_key:
+        return None
+    with open(args.federation_key, "rb") as key_file:
+        key = key_file.read().strip()
+    if not key:
+        raise SystemExit(f"Federation key file {args.federation_key} is empty")
+    return key
+
 def main():
-    server_ip = input("Enter server IP: ")  
-    server_port = int(input("Enter the port number (Use 9000 for testing): "))  
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--ip", help="server IP, asked for when not given")
+    parser.add_argument("--port", type=int, help="server port, asked for when not given")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port")
+    parser.add_argument("--history", type=int, default=0, help="recent messages replayed to new room members")
+    parser.add_argument("--store", help="SQLite file that keeps messages, also for offline users")
+    parser.add_argument("--keyring", help="file keeping the store's encryption keys (default: the store's name + .keys)")
+    parser.add_argument("--max-clients", type=int, default=0, help="refuse connections beyond this many clients")
+    parser.add_argument("--idle-timeout", type=float, default=0, help="close client connections idle for this many seconds")
+    parser.add_argument("--files", help="directory whose files clients may send with /sendfile")
+    parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS, help="file transfers streaming at once")
+    parser.add_argument("--compress", type=codec_names, help="codecs offered to clients, best first "
+                        f"(default: those available of {','.join(CODECS)}), or none")
+    parser.add_argument("--batch-ms", type=float, default=10, help="latency budget of micro-batching for clients "
+                        "that ask for it, 0 to not offer it")
+    parser.add_argument("--plugin", action="append", default=[], help="module whose register(registry) adds commands")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on 127.0.0.1 (port + worker ID with --workers)")
+    parser.add_argument("--federation-key", help="file holding the secret shared by federated nodes; "
+                        "without it the server neither links to nor accepts other nodes")
+    parser.add_argument("--federation-peer", action="append", default=[],
+                        help="host allowed to link to this node (default: any holding the key)")
+    parser.add_argument("--ssh-port", type=int, help="also serve SSH clients (ssh_client.py) on this port, without --workers")
+    parser.add_argument("--ssh-host-key", default="ssh_host_key", help="SSH host key file, created on first start")
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--bus-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    for plugin in args.plugin:
+        ChatProtocol.commands.load(plugin)
+    server_ip = args.ip or input("Enter server IP: ")
+    server_port = args.port or int(input("Enter the port number (Use 9000 for testing): "))
+
+    if args.worker_id is not None:
+        factory = ChatFactory(server_ip, server_port, args.history, open_store(args),
+                              args.max_clients, args.idle_timeout, args.files, args.max_transfers, args.compress,
+                              args.batch_ms, read_federation_key(args), args.federation_peer)
+        if args.metrics_port:
+            listen_metrics(factory.metrics, args.metrics_port + args.worker_id)
+        workers.run_worker(factory, args.listen_fd, args.worker_id, args.workers, args.bus_dir)
+        return
+    if args.workers > 1:
+        # The workers have no console; stop the server with Ctrl+C or /exit from a client
+        extra_args = ["--history", str(args.history), "--max-clients", str(args.max_clients),
+                      "--idle-timeout", str(args.idle_timeout), "--max-transfers", str(args.max_transfers),
+                      "--batch-ms", str(args.batch_ms)]
+        if args.compress is not None:
+            extra_args += ["--compress", ",".join(args.compress) or "none"]
+        extra_args += (["--store", args.store] if args.store else []) + (["--files", args.files] if args.files else [])
+        extra_args += ["--keyring", args.keyring] if args.keyring else []
+        extra_args += ["--federation-key", args.federation_key] if args.federation_key else []
+        for peer in args.federation_peer:
+            extra_args += ["--federation-peer", peer]
+        for plugin in args.plugin:
+            extra_args += ["--plugin", plugin]
+        if args.metrics_port:
+            extra_args += ["--metrics-port", str(args.metrics_port)]
+        workers.supervise(__file__, server_ip, server_port, args.workers, extra_args)
+        return
 
-    factory = ChatFactory(server_ip, server_port)
+    factory = ChatFactory(server_ip, server_port, args.history, open_store(args),
+                          args.max_clients, args.idle_timeout, args.files, args.max_transfers, args.compress, args.batch_ms,
+                          read_federation_key(args), args.federation_peer)
     reactor.listenTCP(server_port, factory)
     print(f"Chat server started on {server_ip}:{server_port}")
+    if args.metrics_port:
+        listen_metrics(factory.metrics, args.metrics_port)
+        print(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.ssh_port:
+        from ssh_server import SSHChatServer
+        SSHChatServer(factory, server_ip, args.ssh_port, args.ssh_host_key).start()
+        print(f"SSH clients on {server_ip}:{args.ssh_port}")
 
     stdio.StandardIO(ChatConsoleProtocol(factory))  
 
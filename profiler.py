@@ -0,0 +1,63 @@
+import collections
+import sys
+import threading
+
+class SamplingProfiler:
+    # Statistical profiler that can be switched on and off in a running server. A
+    # background thread looks at the stack of the profiled thread (the reactor's by
+    # default) every interval seconds and counts the functions on it, so the profiled
+    # code itself runs at full speed.
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples = 0
+        self.own = collections.Counter()  # the function running when sampled
+        self.total = collections.Counter()  # every function on the stack
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self.samples = 0
+            self.own.clear()
+            self.total.clear()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[self._where(frame)] += 1
+            seen = set()
+            while frame is not None:
+                where = self._where(frame)
+                if where not in seen:
+                    seen.add(where)
+                    self.total[where] += 1
+                frame = frame.f_back
+
+    def _where(self, frame):
+        code = frame.f_code
+        return f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno} {code.co_name}"
+
+    def report(self, limit=15):
+        if not self.samples:
+            return ["No samples"]
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms", "own%   total%  function"]
+        for where, count in self.own.most_common(limit):
+            lines.append(f"{count * 100 / self.samples:5.1f}  {self.total[where] * 100 / self.samples:6.1f}  {where}")
+        return lines
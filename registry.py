@@ -0,0 +1,149 @@
+import itertools
+import time
+from twisted.internet import reactor, task
+
+NO_ROOMS = frozenset()
+
+class Session:
+    # One connection as seen by the registry. A user can hold several sessions, for
+    # example a laptop and a phone behind the same NAT address. There is one per
+    # connected client, so it has slots and only gets a set of rooms once it joins one.
+    # account is the name it logged in to with /login, if it did.
+    __slots__ = ("conn_id", "protocol", "user", "fingerprint", "rooms", "last_seen", "account")
+
+    def __init__(self, conn_id, protocol, user, fingerprint=None):
+        self.conn_id = conn_id
+        self.protocol = protocol
+        self.user = user
+        self.fingerprint = fingerprint
+        self.rooms = NO_ROOMS
+        self.last_seen = time.monotonic()
+        self.account = None
+
+class ClientRegistry:
+    # Connected clients indexed by connection ID, user name and public-key fingerprint,
+    # plus the subscriber set of every room. Each index maps to a dict of sessions keyed
+    # by connection ID, so adding or removing one connection is O(1) per index it is in.
+    def __init__(self, on_user_joined=None, on_user_left=None):
+        self.sessions = {}
+        self.users = {}
+        self.fingerprints = {}
+        self.rooms = {}
+        self.on_user_joined = on_user_joined
+        self.on_user_left = on_user_left
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return (session.protocol for session in self.sessions.values())
+
+    def register(self, protocol, user, fingerprint=None):
+        session = Session(next(self._ids), protocol, user, fingerprint)
+        self.sessions[session.conn_id] = session
+        self._index(self.users, user, session, self.on_user_joined)
+        if fingerprint is not None:
+            self._index(self.fingerprints, fingerprint, session)
+        return session
+
+    def unregister(self, session):
+        if self.sessions.pop(session.conn_id, None) is None:
+            return
+        self._unindex(self.users, session.user, session, self.on_user_left)
+        if session.fingerprint is not None:
+            self._unindex(self.fingerprints, session.fingerprint, session)
+        for room in session.rooms:
+            self._unindex(self.rooms, room, session)
+        session.rooms = NO_ROOMS
+
+    def available(self, session, user, account=None):
+        # A name is only shared by connections logged in to the same account
+        return all(other is session or (account is not None and other.account == account)
+                   for other in self.users.get(user, {}).values())
+
+    def rename(self, session, user, account=None):
+        # Whether the session now goes by user (as account, when it logged in to it)
+        if session.conn_id not in self.sessions or not self.available(session, user, account):
+            return False
+        session.account = account
+        if user != session.user:
+            self._unindex(self.users, session.user, session, self.on_user_left)
+            session.user = user
+            self._index(self.users, user, session, self.on_user_joined)
+        return True
+
+    def setFingerprint(self, session, fingerprint):
+        if session.conn_id in self.sessions:
+            if session.fingerprint is not None:
+                self._unindex(self.fingerprints, session.fingerprint, session)
+            session.fingerprint = fingerprint
+            self._index(self.fingerprints, fingerprint, session)
+
+    def get(self, conn_id):
+        return self.sessions.get(conn_id)
+
+    def byUser(self, user):
+        return [session.protocol for session in self.users.get(user, {}).values()]
+
+    def byFingerprint(self, fingerprint):
+        return [session.protocol for session in self.fingerprints.get(fingerprint, {}).values()]
+
+    def join(self, session, room):
+        if session.conn_id in self.sessions and room not in session.rooms:
+            if session.rooms is NO_ROOMS:
+                session.rooms = set()
+            session.rooms.add(room)
+            self._index(self.rooms, room, session)
+
+    def leave(self, session, room):
+        if room in session.rooms:
+            session.rooms.discard(room)
+            self._unindex(self.rooms, room, session)
+
+    def members(self, room):
+        return [session.protocol for session in self.rooms.get(room, {}).values()]
+
+    def _index(self, index, key, session, on_first=None):
+        entries = index.get(key)
+        if entries is None:
+            entries = index[key] = {}
+        entries[session.conn_id] = session
+        if on_first and len(entries) == 1:
+            on_first(key)
+
+    def _unindex(self, index, key, session, on_last=None):
+        entries = index.get(key)
+        if entries is not None and entries.pop(session.conn_id, None) is not None and not entries:
+            del index[key]
+            if on_last:
+                on_last(key)
+
+class IdleReaper:
+    # Closes the connections that have sent nothing for timeout seconds; clients that are
+    # quiet but alive keep theirs by sending /ping now and then. A connection still here
+    # one sweep after it was closed is not reading what is left to send, so it is aborted.
+    def __init__(self, registry, timeout, clock=reactor):
+        self.registry = registry
+        self.timeout = timeout
+        self.reaped = 0
+        self._loop = task.LoopingCall(self.sweep)
+        self._loop.clock = clock
+
+    def start(self):
+        if self.timeout and not self._loop.running:
+            self._loop.start(max(1.0, self.timeout / 4), now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.timeout
+        for session in [session for session in self.registry.sessions.values() if session.last_seen < cutoff]:
+            transport = session.protocol.transport
+            if transport.disconnecting:
+                transport.abortConnection()
+            else:
+                self.reaped += 1
+                transport.loseConnection()
@@ -0,0 +1,57 @@
+from collections import deque
+
+class Room:
+    def __init__(self, name, history_size=0):
+        self.name = name
+        self.messages = 0
+        self.history = deque(maxlen=history_size) if history_size else None
+
+class RoomRouter:
+    # Topic-based pub-sub on top of the registry's room subscriber sets. Publishing costs
+    # one fan-out to the room's members, however many clients the server holds. Messages
+    # arrive already serialized, so history can be replayed to new members as is.
+    def __init__(self, registry, fanout, history_size=0):
+        self.registry = registry
+        self.fanout = fanout
+        self.history_size = history_size
+        self.rooms = {}
+
+    def join(self, session, name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, self.history_size)
+        if name not in session.rooms:
+            self.registry.join(session, name)
+            for data in room.history or ():
+                self.fanout.send(session.protocol, data)
+        return room
+
+    def leave(self, session, name):
+        self.registry.leave(session, name)
+        if name not in self.registry.rooms:
+            self.rooms.pop(name, None)
+
+    def leaveAll(self, session):
+        for name in list(session.rooms):
+            self.leave(session, name)
+
+    def publish(self, name, data):
+        if self.record(name, data) is None:
+            return 0
+        members = self.registry.rooms.get(name, {})
+        self.fanout.publish((session.protocol for session in members.values()), data)
+        return len(members)
+
+    def record(self, name, data=None):
+        # Counts a message to the room and keeps data, if given, for its history; for
+        # callers that deliver the message themselves
+        room = self.rooms.get(name)
+        if room is not None:
+            room.messages += 1
+            if room.history is not None and data is not None:
+                room.history.append(data)
+        return room
+
+    def stats(self):
+        return [(room.name, len(self.registry.rooms.get(room.name, ())), room.messages)
+                for room in self.rooms.values()]
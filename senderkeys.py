@@ -0,0 +1,104 @@
+import itertools
+import struct
+from collections import OrderedDict
+from Crypto.Random import get_random_bytes
+from RSA_encrypter import SESSION_KEY_SIZE, SessionCipher
+
+KEY_ID = struct.Struct("!I")
+EVERYONE = "*"  # the group of /broadcast: every connected client
+
+class SenderKey:
+    # One sender's key for one group. Announced once to every member over the member's
+    # own session; after that each message is sealed once and the same bytes go to all.
+    __slots__ = ("id", "group", "sender", "key", "cipher", "missed")
+
+    def __init__(self, key_id, group, sender):
+        self.id = key_id
+        self.group = group
+        self.sender = sender
+        self.key = get_random_bytes(SESSION_KEY_SIZE)
+        self.cipher = SessionCipher(self.key)
+        self.missed = None  # members the announcement did not reach, to try again
+
+    def miss(self, member):
+        if self.missed is None:
+            self.missed = set()
+        self.missed.add(member)
+
+    def announcement(self):
+        # What a member gets (sealed with its session) to read this sender's messages
+        return KEY_ID.pack(self.id) + self.key + f"{self.group} {self.sender}".encode('utf-8')
+
+    def seal(self, message):
+        return KEY_ID.pack(self.id) + self.cipher.encrypt(message)
+
+class SenderKeys:
+    # Sender keys of every group of one server. A sender's key for a group is made on
+    # its first message and announced to the members of that moment. When the members
+    # change, all keys of the group are dropped, so the next message of each sender
+    # comes with a new key: a member that left cannot read what follows, and one that
+    # joined cannot read what came before.
+    def __init__(self):
+        self.groups = {}
+        self._ids = itertools.count(1)
+        self.created = 0
+        self.announced = 0
+        self.sealed = 0
+        self.rekeys = 0
+
+    def key(self, group, sender_id, sender):
+        # Returns (key, whether it is new and still has to be announced)
+        senders = self.groups.get(group)
+        if senders is None:
+            senders = self.groups[group] = {}
+        key = senders.get(sender_id)
+        if key is not None:
+            return key, False
+        key = senders[sender_id] = SenderKey(next(self._ids) & 0xFFFFFFFF, group, sender)
+        self.created += 1
+        return key, True
+
+    def rekey(self, group):
+        if self.groups.pop(group, None):
+            self.rekeys += 1
+
+    def forget(self, sender_id):
+        # The sender's next message in each group comes with a new key (and its new name)
+        for senders in self.groups.values():
+            senders.pop(sender_id, None)
+
+class GroupKeyRing:
+    # Receiving side: the sender keys announced to this client, the most recent max_size
+    # of them. A message can overtake the announcement of its key (the server does not
+    # hold a group message back for a member whose session is still being set up), so
+    # up to max_early such messages wait for their key.
+    def __init__(self, max_size=1024, max_early=256):
+        self.max_size = max_size
+        self.max_early = max_early
+        self.keys = OrderedDict()
+        self.early = OrderedDict()
+
+    def add(self, announcement):
+        # Returns the messages that were waiting for this key as (group, sender, message, flags)
+        key_id = KEY_ID.unpack_from(announcement)[0]
+        key = announcement[KEY_ID.size:KEY_ID.size + SESSION_KEY_SIZE]
+        group, _, sender = announcement[KEY_ID.size + SESSION_KEY_SIZE:].decode('utf-8').partition(" ")
+        self.keys[key_id] = (SessionCipher(key), group, sender)
+        while len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+        return [opened for opened in (self.open(*early) for early in self.early.pop(key_id, ())) if opened is not None]
+
+    def open(self, payload, flags=0):
+        # (group, sender, message, flags), or None if the key is not known (yet) or it fails
+        key_id = KEY_ID.unpack_from(payload)[0]
+        entry = self.keys.get(key_id)
+        if entry is None:
+            self.early.setdefault(key_id, []).append((payload, flags))
+            while sum(len(waiting) for waiting in self.early.values()) > self.max_early:
+                self.early.popitem(last=False)
+            return None
+        cipher, group, sender = entry
+        message = cipher.decrypt(payload[KEY_ID.size:])
+        if message is None:
+            return None
+        return group, sender, message, flags
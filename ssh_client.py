@@ -1,26 +1,304 @@
+import argparse
+import queue
+import shlex
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
 import paramiko
+from framing import HEADER, HEADER_SIZE, VERSION, encode_frame
+
+# Frames on the "chat" subsystem channel, in framing.py's header. Messages carry a
+# sequence number that the other side acknowledges cumulatively.
+SUBSYSTEM = "chat"
+SSH_MESSAGE = 48  # seq (uint64) | message
+SSH_ACK = 49      # seq (uint64) of the last message received
+SSH_PING = 50     # answered with an ACK; keeps an idle channel checked
+SEQ = struct.Struct("!Q")
+
+MAX_BATCH = 64 * 1024
+
+def read_frames(channel, buffer):
+    # Blocks for the next read and returns every complete frame in the buffer; a
+    # partial frame stays in the buffer for the next call
+    data = channel.recv(65536)
+    if not data:
+        raise EOFError("channel closed")
+    buffer += data
+    frames = []
+    offset = 0
+    end = len(buffer)
+    while end - offset >= HEADER_SIZE:
+        length, version, frame_type, flags = HEADER.unpack_from(buffer, offset)
+        if version != VERSION:
+            raise ValueError(f"unsupported frame version {version}")
+        frame_end = offset + HEADER_SIZE + length
+        if frame_end > end:
+            break
+        frames.append((frame_type, bytes(buffer[offset + HEADER_SIZE:frame_end])))
+        offset = frame_end
+    del buffer[:offset]
+    return frames
+
+def ack_frame(seq):
+    return encode_frame(SSH_ACK, SEQ.pack(seq))
 
 def send_message(ssh_client, message):
+    # One exec channel and one remote process per message; SSHChannel is the fast path
     try:
-        stdin, stdout, stderr = ssh_client.exec_command(f"echo '{message}'")
+        stdin, stdout, stderr = ssh_client.exec_command(f"echo {shlex.quote(message)}")
         print("Message sent successfully!")
     except Exception as e:
         print(f"Failed to send message: {e}")
 
-if __name__ == "__main__":
-    host = 'your_server_ip'  # SSH server IP address
-    port = 2222  # Custom SSH port
-    username = 'your_username'  # SSH username
-    password = 'your_password'  # SSH password
+class SSHChannel:
+    # One authenticated connection to a host and one long-lived "chat" subsystem channel
+    # on it, carrying framed messages both ways. send() only queues: a writer thread
+    # batches queued frames into as few channel writes as it can, and up to window
+    # messages may wait for their acknowledgement, so sends are pipelined instead of
+    # costing a round trip each.
+    #
+    # A reader thread handles acknowledgements and messages from the server and pings
+    # the server when the channel was quiet for a keepalive interval; if two pings go
+    # unanswered, or the connection fails, it reconnects with backoff and sends the
+    # unacknowledged messages again, in order. Delivery is at least once: a message the
+    # server got but had not acknowledged yet arrives twice.
+    def __init__(self, host, port, username, password, on_message=None, on_ack=None, window=1024, keepalive=15):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.on_message = on_message
+        self.on_ack = on_ack
+        self.window = window
+        self.keepalive = keepalive
+        self.state = threading.Condition()
+        self.connecting = threading.Lock()
+        self.unacked = OrderedDict()  # seq -> frame
+        self.outgoing = queue.SimpleQueue()  # seqs of new messages, or ready frames
+        self.next_seq = 1
+        self.written = 0  # last message seq written to a channel
+        self.received = 0  # last message seq received on the current channel
+        self.client = None
+        self.channel = None
+        self.closed = False
+        self.reconnects = 0
 
-    try:
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(host, port=port, username=username, password=password)
+    def start(self):
+        self.connect()
+        threading.Thread(target=self.write, daemon=True).start()
+        return self
 
-        message = input("Enter your message: ")
-        send_message(ssh_client, message)
+    def connect(self):
+        delay = 0.5
+        while not self.closed:
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(self.host, port=self.port, username=self.username, password=self.password,
+                               timeout=10, allow_agent=False, look_for_keys=False)
+                transport = client.get_transport()
+                transport.set_keepalive(self.keepalive)
+                channel = transport.open_session()
+                channel.invoke_subsystem(SUBSYSTEM)
+                channel.settimeout(self.keepalive)
+            except (paramiko.SSHException, OSError) as e:
+                client.close()
+                print(f"SSH connection to {self.host}:{self.port} failed: {e}, retrying in {delay:g} s")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            self.client = client
+            self.received = 0
+            self.channel = channel
+            threading.Thread(target=self.read, args=(channel,), daemon=True).start()
+            return
 
-        ssh_client.close()
-    except Exception as e:
-        print(f"[-] Error: {e}")
+    def reconnect(self, channel):
+        # Called by the reader or the writer when the channel failed; only the first
+        # caller for a channel reconnects
+        with self.connecting:
+            if self.closed or self.channel is not channel:
+                return
+            self.client.close()
+            self.reconnects += 1
+            print(f"SSH channel to {self.host}:{self.port} lost, reconnecting")
+            self.connect()
+
+    def send(self, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        with self.state:
+            while len(self.unacked) >= self.window and not self.closed:
+                self.state.wait()
+            if self.closed:
+                return None
+            seq = self.next_seq
+            self.next_seq += 1
+            self.unacked[seq] = encode_frame(SSH_MESSAGE, SEQ.pack(seq) + message)
+        self.outgoing.put(seq)
+        return seq
+
+    def flush(self, timeout=None):
+        # Waits until the server acknowledged everything sent so far
+        with self.state:
+            return self.state.wait_for(lambda: not self.unacked or self.closed, timeout)
+
+    def close(self):
+        self.closed = True
+        self.outgoing.put(None)
+        with self.state:
+            self.state.notify_all()
+        if self.client is not None:
+            self.client.close()
+
+    def batch(self, item):
+        # The frames to write for this queue item and whatever else is already queued
+        frames = []
+        size = 0
+        last = self.written
+        while True:
+            if item is None:
+                self.outgoing.put(None)
+                break
+            if isinstance(item, int):
+                with self.state:
+                    frame = self.unacked.get(item)
+                if frame is not None:
+                    frames.append(frame)
+                    size += len(frame)
+                last = item
+            else:
+                frames.append(item)
+                size += len(item)
+            if size >= MAX_BATCH:
+                break
+            try:
+                item = self.outgoing.get_nowait()
+            except queue.Empty:
+                break
+        return frames, last
+
+    def write(self):
+        channel = self.channel
+        while not self.closed:
+            item = self.outgoing.get()
+            if item is None:
+                return
+            frames, last = self.batch(item)
+            while not self.closed:
+                try:
+                    if channel is not self.channel:
+                        # A new connection: first what the old one never got acknowledged
+                        channel = self.channel
+                        with self.state:
+                            resend = [frame for seq, frame in self.unacked.items() if seq <= self.written]
+                        if resend:
+                            channel.sendall(b"".join(resend))
+                    if frames:
+                        channel.sendall(b"".join(frames))
+                    self.written = last
+                    break
+                except (paramiko.SSHException, OSError, EOFError):
+                    self.reconnect(channel)
+
+    def read(self, channel):
+        buffer = bytearray()
+        quiet = 0
+        while not self.closed and channel is self.channel:
+            try:
+                frames = read_frames(channel, buffer)
+            except socket.timeout:
+                quiet += 1
+                if quiet > 2:
+                    break
+                self.outgoing.put(encode_frame(SSH_PING, b""))
+                continue
+            except (paramiko.SSHException, OSError, EOFError, ValueError):
+                break
+            quiet = 0
+            received = self.received
+            for frame_type, payload in frames:
+                if frame_type == SSH_ACK:
+                    self.acknowledged(SEQ.unpack_from(payload)[0])
+                elif frame_type == SSH_MESSAGE:
+                    seq = SEQ.unpack_from(payload)[0]
+                    if seq > self.received:
+                        self.received = seq
+                        if self.on_message is not None:
+                            self.on_message(payload[SEQ.size:])
+                elif frame_type == SSH_PING:
+                    received = -1
+            # One acknowledgement for everything this read brought in
+            if self.received != received:
+                self.outgoing.put(ack_frame(self.received))
+        self.reconnect(channel)
+
+    def acknowledged(self, seq):
+        with self.state:
+            while self.unacked:
+                first = next(iter(self.unacked))
+                if first > seq:
+                    break
+                del self.unacked[first]
+            self.state.notify_all()
+        if self.on_ack is not None:
+            self.on_ack(seq)
+
+class SSHChannelPool:
+    # One SSHChannel per (host, port, username), connected on first use
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, username, password, **options):
+        key = (host, port, username)
+        with self.lock:
+            channel = self.channels.get(key)
+            if channel is None or channel.closed:
+                channel = self.channels[key] = SSHChannel(host, port, username, password, **options).start()
+            return channel
+
+    def close(self):
+        with self.lock:
+            for channel in self.channels.values():
+                channel.close()
+            self.channels.clear()
+
+pool = SSHChannelPool()
+
+def main():
+    parser = argparse.ArgumentParser(description="SSH chat client")
+    parser.add_argument("host")
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--exec", action="store_true", help="send each message with its own exec request")
+    args = parser.parse_args()
+
+    if args.exec:
+        try:
+            ssh_client = paramiko.SSHClient()
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(args.host, port=args.port, username=args.username, password=args.password)
+
+            message = input("Enter your message: ")
+            send_message(ssh_client, message)
+
+            ssh_client.close()
+        except Exception as e:
+            print(f"[-] Error: {e}")
+        return
+
+    channel = pool.get(args.host, args.port, args.username, args.password,
+                       on_message=lambda message: print(message.decode('utf-8', 'replace'), end=""))
+    try:
+        while True:
+            channel.send(input())
+    except (EOFError, KeyboardInterrupt):
+        channel.flush(5)
+    pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,35 @@
-import paramiko
+import argparse
+import os
+import socket
 import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+from twisted.internet import address, error, reactor
+from twisted.python import failure
+from framing import encode_frame
+from ssh_client import SUBSYSTEM, SSH_MESSAGE, SSH_PING, SEQ, ack_frame, read_frames
+
+# Host keys by file, so that every server in the process (and every restart of one)
+# reuses the key instead of generating it again
+host_keys = {}
+
+def load_host_key(path, bits=2048):
+    # Loads the host key from disk, creating it on first start
+    key = host_keys.get(path)
+    if key is not None:
+        return key
+    if path and os.path.exists(path):
+        key = paramiko.RSAKey.from_private_key_file(path)
+    else:
+        key = paramiko.RSAKey.generate(bits)
+        if path:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                key.write_private_key(file)
+    host_keys[path] = key
+    return key
 
 class SSHServer(paramiko.ServerInterface):
     def __init__(self):
@@ -19,26 +49,298 @@ class SSHServer(paramiko.ServerInterface):
         self.event.set()
         return True
 
-    def run(self, client_address):
-        transport = paramiko.Transport(client_address)
-        transport.add_server_key(paramiko.RSAKey.generate(1024))
-        transport.set_subsystem_handler('', paramiko.DummyChannel)
-        server = SSHServer()
-        transport.start_server(server=server)
+class ChatSubsystem(paramiko.SubsystemHandler):
+    # Server end of ssh_client's "chat" subsystem: hands each framed message to
+    # on_message(subsystem, message) and acknowledges everything one read brought in
+    # with a single ACK. send() writes a message the other way; the client acknowledges
+    # those, but the server does not keep them for a reconnect.
+    def __init__(self, channel, name, server, on_message=None):
+        super().__init__(channel, name, server)
+        self.channel = channel
+        self.on_message = on_message or (lambda subsystem, message: print(message.decode('utf-8', 'replace')))
+        self.lock = threading.Lock()
+        self.next_seq = 1
 
-        server.event.wait()
+    def start_subsystem(self, name, transport, channel):
+        self.channelOpened()
+        buffer = bytearray()
+        received = 0
+        while transport.is_active():
+            try:
+                frames = read_frames(channel, buffer)
+            except (paramiko.SSHException, OSError, EOFError, ValueError):
+                break
+            messages = []
+            answer = False
+            for frame_type, payload in frames:
+                if frame_type == SSH_MESSAGE:
+                    received = SEQ.unpack_from(payload)[0]
+                    messages.append(payload[SEQ.size:])
+                    answer = True
+                elif frame_type == SSH_PING:
+                    answer = True
+            if messages:
+                self.messagesReceived(messages)
+            if answer:
+                self.sendFrame(ack_frame(received))
+        self.channelClosed()
+        channel.close()
 
-        transport.close()
+    def channelOpened(self):
+        pass
 
-if __name__ == "__main__":
-    host_key = paramiko.RSAKey.generate(1024)
-    server = '0.0.0.0'  # Listen on all interfaces
-    port = 2222  # Custom SSH port
+    def messagesReceived(self, messages):
+        for message in messages:
+            self.on_message(self, message)
+
+    def channelClosed(self):
+        pass
+
+    def sendFrame(self, frame):
+        with self.lock:
+            self.channel.sendall(frame)
+
+    def send(self, message):
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+        self.sendFrame(encode_frame(SSH_MESSAGE, SEQ.pack(seq) + message))
+
+class BridgedSubsystem(ChatSubsystem):
+    # A "chat" channel served by a Twisted ChatFactory: the channel gets a ChatProtocol
+    # from the factory like a TCP connection does and is its transport, so the client
+    # is in the same registry, rooms and fan-out as every other client. Its messages are
+    # handed to the reactor thread a read at a time, and what the protocol writes is
+    # queued here and sent by the server's writer pool without ever blocking the reactor.
+    HIGH_WATER = 256 * 1024
+    LOW_WATER = 64 * 1024
+
+    disconnecting = False
+    producer = None
+    protocol = None
+
+    def __init__(self, channel, name, server, chat_server):
+        super().__init__(channel, name, server)
+        self.chat_server = chat_server
+        host, port = channel.get_transport().getpeername()[:2]
+        self.peer = address.IPv4Address("TCP", host, port)
+        self.pending = deque()
+        self.pendingBytes = 0
+        self.scheduled = False
+        self.paused = False
+
+    def channelOpened(self):
+        reactor.callFromThread(self.connect)
+
+    def connect(self):
+        protocol = self.chat_server.factory.buildProtocol(self.peer)
+        if protocol is None:
+            self.channel.close()
+            return
+        self.protocol = protocol
+        protocol.makeConnection(self)
+
+    def messagesReceived(self, messages):
+        reactor.callFromThread(self.deliver, messages)
+
+    def deliver(self, messages):
+        protocol = self.protocol
+        if protocol is None or self.disconnecting:
+            return
+        protocol.factory.metrics.inc("bytes_received_total", sum(len(message) for message in messages))
+        protocol.session.last_seen = time.monotonic()
+        for message in messages:
+            protocol.lineReceived(message)
+            if self.disconnecting:
+                break
+
+    def channelClosed(self):
+        reactor.callFromThread(self.connectionLost)
+
+    def connectionLost(self):
+        protocol, self.protocol = self.protocol, None
+        self.disconnecting = True
+        if protocol is not None:
+            protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    # The parts of ITransport that ChatProtocol, FanOut and IdleReaper use
+
+    def getPeer(self):
+        return self.peer
 
-    print(f"[*] Listening for connections on {server}:{port}...")
+    def getHost(self):
+        return address.IPv4Address("TCP", *self.channel.get_transport().sock.getsockname()[:2])
 
-    try:
-        ssh_server = SSHServer()
-        ssh_server.run((server, port))
-    except Exception as e:
-        print(f"[-] Error: {e}")
+    def write(self, data):
+        self.writeSequence([data])
+
+    def writeSequence(self, data):
+        # Whatever one write carries (one or more lines) is one message to the client
+        if self.disconnecting:
+            return
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+        self.sendFrame(encode_frame(SSH_MESSAGE, SEQ.pack(seq) + b"".join(data)))
+        if self.pendingBytes > self.HIGH_WATER and self.producer is not None and not self.paused:
+            self.paused = True
+            self.producer.pauseProducing()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        # Closes the channel once what is queued has been sent
+        self.disconnecting = True
+        self.sendFrame(b"")
+
+    def abortConnection(self):
+        self.disconnecting = True
+        with self.lock:
+            self.pending.clear()
+            self.pendingBytes = 0
+        self.channel.close()
+
+    def sendFrame(self, frame):
+        # From the reactor thread (writes) and the channel's reader thread (ACKs)
+        with self.lock:
+            if frame:
+                self.pending.append(frame)
+                self.pendingBytes += len(frame)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.chat_server.writers.submit(self.drain)
+
+    def drain(self):
+        # Runs on the writer pool. Only sends what the channel's window takes right
+        # away, and comes back later for the rest, so a slow client never holds a writer.
+        try:
+            while True:
+                with self.lock:
+                    if not self.pending:
+                        self.scheduled = False
+                        break
+                    data = self.pending[0]
+                if not self.channel.send_ready():
+                    if self.channel.closed:
+                        self.abortConnection()
+                        return
+                    reactor.callFromThread(reactor.callLater, 0.02, self.chat_server.writers.submit, self.drain)
+                    return
+                sent = self.channel.send(data)
+                with self.lock:
+                    if sent < len(data):
+                        self.pending[0] = data[sent:]
+                    else:
+                        self.pending.popleft()
+                    self.pendingBytes -= sent
+        except (paramiko.SSHException, OSError, EOFError):
+            self.abortConnection()
+            return
+        if self.disconnecting:
+            self.channel.close()
+        elif self.paused and self.pendingBytes < self.LOW_WATER:
+            self.paused = False
+            reactor.callFromThread(self.resume)
+
+    def resume(self):
+        if self.producer is not None:
+            self.producer.resumeProducing()
+
+class SSHChatServer:
+    # Serves ssh_client's "chat" subsystem to many clients for a node ChatFactory. An
+    # accept thread hands each connection to a bounded pool that runs the SSH handshake
+    # (key exchange and authentication, the expensive part); after it, paramiko's
+    # transport thread and the channel's reader thread carry the connection, and
+    # max_sessions bounds how many there are. The host key is loaded once.
+    def __init__(self, factory, host, port, host_key_path=None, max_sessions=1024, handshake_workers=8,
+                 write_workers=8):
+        self.factory = factory
+        self.host = host
+        self.port = port
+        self.host_key = load_host_key(host_key_path)
+        self.max_sessions = max_sessions
+        self.handshakes = ThreadPoolExecutor(handshake_workers, thread_name_prefix="ssh-handshake")
+        self.writers = ThreadPoolExecutor(write_workers, thread_name_prefix="ssh-writer")
+        self.transports = set()
+        self.lock = threading.Lock()
+        self.listener = None
+        self.accepted = 0
+        self.refused = 0
+        self.failed = 0
+
+    def start(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(1024)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.acceptLoop, name="ssh-accept", daemon=True).start()
+        self.factory.metrics.gauge("ssh_sessions", self.sessions)
+        self.factory.metrics.gauge("ssh_handshake_failures_total", lambda: self.failed, "counter")
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        return self
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        with self.lock:
+            transports = list(self.transports)
+        for transport in transports:
+            transport.close()
+        self.handshakes.shutdown(wait=False)
+        self.writers.shutdown(wait=False)
+
+    def sessions(self):
+        with self.lock:
+            self.transports = {transport for transport in self.transports if transport.is_active()}
+            return len(self.transports)
+
+    def acceptLoop(self):
+        while self.listener is not None:
+            try:
+                sock, peer = self.listener.accept()
+            except OSError:
+                return
+            if self.sessions() >= self.max_sessions:
+                self.refused += 1
+                sock.close()
+                continue
+            self.accepted += 1
+            self.handshakes.submit(self.handshake, sock, peer)
+
+    def handshake(self, sock, peer):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler(SUBSYSTEM, BridgedSubsystem, self)
+        with self.lock:
+            self.transports.add(transport)
+        try:
+            transport.start_server(server=SSHServer())
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            self.failed += 1
+            print(f"SSH handshake with {peer[0]}:{peer[1]} failed: {e}")
+            transport.close()
+
+def main():
+    from node import ChatFactory
+    parser = argparse.ArgumentParser(description="SSH chat server")
+    parser.add_argument("--ip", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--host-key", default="ssh_host_key", help="host key file, created on first start")
+    parser.add_argument("--max-sessions", type=int, default=1024)
+    args = parser.parse_args()
+
+    factory = ChatFactory(args.ip, args.port)
+    factory.doStart()
+    server = SSHChatServer(factory, args.ip, args.port, args.host_key, args.max_sessions).start()
+    print(f"[*] Listening for connections on {args.ip}:{server.port}...")
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -1,197 +1,531 @@
-from twisted.internet import reactor, protocol, stdio
-from twisted.protocols import basic
+from twisted.internet import defer, reactor, protocol, stdio
 import getpass
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
 import os
-
-def encrypt_message(public_key, message):
-    rsa_key = RSA.import_key(public_key)
-    cipher = PKCS1_OAEP.new(rsa_key)
-    encrypted_message = cipher.encrypt(message.encode())
-    return encrypted_message
-
-def decrypt_message(private_key, encrypted_message):
-    rsa_key = RSA.import_key(private_key)
-    cipher = PKCS1_OAEP.new(rsa_key)
-    try:
-        decrypted_message = cipher.decrypt(encrypted_message)
-        return decrypted_message.decode()
-    except ValueError as e:
-        print("Error decrypting message:", e)
-        return None
-
-def gen_keys(seed):
-    os.environ['PYTHONHASHSEED'] = seed
-    rsa_key = RSA.generate(2048)
-    private_key = rsa_key.export_key().decode('utf-8')
-    public_key = rsa_key.publickey().export_key().decode('utf-8')
-    return private_key, public_key
-
-def get_public_key(seed):
-    os.environ['PYTHONHASHSEED'] = seed
-    rsa_key = RSA.generate(2048)
-    return rsa_key.publickey().export_key().decode('utf-8')
+import struct
+import time
+from accounts import Accounts
+from chatcore import ChatConsoleBase, ChatFactoryBase, ChatProtocolBase
+from chatlog import logger
+from commands import UsageError, chat_commands
+from compression import CODECS, Compression, caps_request, parse_caps
+from crypto_executor import CryptoExecutor
+from fanout import FanOut
+from filetransfer import MAX_TRANSFERS, FileReceiver, TransferManager
+from framing import (FLAG_COMPRESSED, FRAME_FILE_CHUNK, FRAME_FILE_END, FRAME_FILE_OFFER, FRAME_GROUP_KEY,
+                     FRAME_GROUP_MESSAGE, FRAME_SESSION_KEY, FRAME_SESSION_MESSAGE, FRAME_TEXT, FrameReceiver,
+                     encode_frame)
+from keystore import KeyPool, load_identity
+from message_store import MessageStore
+from metrics import add_profile_command, listen_metrics, node_metrics
+from profiler import SamplingProfiler
+from registry import ClientRegistry, IdleReaper
+from rooms import RoomRouter
+from RSA_encrypter import TAG_SIZE, key_fingerprint, new_session, open_session
+from senderkeys import EVERYONE, GroupKeyRing, SenderKeys
+
+IDENTITY_FILE = "node_identity.pem"
+MESSAGE_DB = "messages.db"  # SQLite file that keeps messages, None to keep none
+KEYRING_FILE = "messages.db.keys"  # the encryption keys of the messages kept
+METRICS_PORT = 0  # serve Prometheus metrics on 127.0.0.1:<port> when set
+PLUGINS = ()  # modules whose register(registry) adds commands for clients
+MAX_CLIENTS = 0  # refuse connections beyond this many clients when set
+IDLE_TIMEOUT = 0  # close client connections idle for this many seconds when set
+FILES_DIR = None  # directory whose files clients may send with /sendfile
+COMPRESS = None  # codecs offered to clients, best first; None for all available
+BATCH_MS = 10  # latency budget of micro-batching for clients that ask for it
+
+TRANSFER_ID = struct.Struct("!I")
 
 def get_password():
     password = getpass.getpass("Enter your password: ")
     return password
 
-class ChatProtocol(basic.LineReceiver):
-    def __init__(self, factory):
-        self.factory = factory
-        self.private_key, self.public_key = gen_keys(get_password())
-        print(f"Public key: {self.public_key}")
-        print(f"Private key: {self.private_key}")
+class ChatProtocol(ChatProtocolBase, FrameReceiver):
+    commands = chat_commands()
+    commands.add("/send", "sendToClient", [str], payload=True, usage="/send <user> <message>",
+                 help="Send a message to a user (nickname, IP or key fingerprint)")
+    commands.add("/publickey", "showPublicKey", help="Display your public key")
+
+    # One of these per connection, so what an idle connection never needs stays on the
+    # class: the key pair and the sessions dict only appear with the first encrypted message
+    _keys = None
+    sessions = None
+    session = None
+    codec = None  # compression the client asked for with /caps
+
+    # Session keys are only taken from the factory's pool once a command needs them,
+    # so accepting a connection never pays for RSA key generation. The pool is read on
+    # a crypto thread, since it generates a key inline when it has run dry.
+    def withKeys(self, function, *args):
+        # Calls function((private_key, public_key), *args) once the key pair is ready
+        self.keyPair().addCallback(self.callWithKeys, function, args)
+
+    def keyPair(self):
+        # The Deferred key pair; it fires with None if the pair could not be had. When
+        # the crypto pool sheds the request the Deferred has already failed here, and
+        # keysFailed has reset self._keys, so the local is what is returned.
+        keys = self._keys
+        if keys is None:
+            keys = self._keys = self.factory.crypto.run("key_pair", self.factory.keyPool.get)
+            keys.addCallbacks(self.keysReady, self.keysFailed)
+        return keys
+
+    def keysReady(self, keys):
+        if self.session:
+            self.factory.registry.setFingerprint(self.session, key_fingerprint(keys[1]))
+        return keys
+
+    def keysFailed(self, failure):
+        self._keys = None  # try again on the next command
+        logger.log(f"No key pair for {self.session.user}: {failure.getErrorMessage()}")
+
+    def callWithKeys(self, keys, function, args):
+        # Errors in function stay off the shared key pair Deferred, which would
+        # otherwise be left failed and every later keyed command would do nothing
+        if keys is not None:
+            defer.maybeDeferred(function, keys, *args).addErrback(self.keyedFailed, function)
+        return keys
+
+    def keyedFailed(self, failure, function):
+        logger.log(f"{function.__name__} failed for {self.session.user}: {failure.getErrorMessage()}")
 
     def connectionMade(self):
-        peer = self.transport.getPeer()
-        print(f"Client connected from {peer.host}:{peer.port}")
-        print(f"Server running on {self.factory.server_ip}:{self.factory.server_port}")
-        self.factory.clients[peer.host] = self
-        self.sendLine(b"Welcome to the chat server!")
+        super().connectionMade()
+        self.factory.senderKeys.rekey(EVERYONE)
+
+    # Commands and replies travel as text frames, encrypted payloads as session frames
+    def frameReceived(self, frame_type, flags, payload):
+        if frame_type == FRAME_TEXT:
+            self.lineReceived(bytes(payload))
+
+    def sendLine(self, line):
+        self.sendFrame(FRAME_TEXT, line)
+
+    def sendFrame(self, frame_type, payload, flags=0):
+        # Goes through the fan-out queue so replies stay in order with broadcasts
+        if frame_type == FRAME_TEXT:
+            payload, flags = self.packed(payload, flags)
+        self.factory.fanout.send(self, encode_frame(frame_type, payload, flags))
+
+    # Compression is per message, not of the connection's stream: messages are
+    # compressed before they are encrypted (ciphertext does not compress), and a group
+    # message is sealed once for all members that use the same codec. Frames carry
+    # FLAG_COMPRESSED outside the encryption; flipping it only garbles the message.
+    def packed(self, message, flags=0):
+        if self.codec is not None:
+            packed = self.factory.compression.pack(self.codec, message)
+            if packed is not None:
+                return packed, flags | FLAG_COMPRESSED
+        return message, flags
+
+    def setCapabilities(self, options=b""):
+        codec, batch = self.factory.compression.negotiate(bytes(options).decode('utf-8'))
+        if batch:
+            self.factory.fanout.batch(self)
+        self.sendLine(self.factory.compression.confirmation(self.session.conn_id, codec, batch))
+        self.codec = codec
 
     def connectionLost(self, reason):
         if hasattr(self.transport.getPeer(), "host"):
             peer = self.transport.getPeer()
-            print(f"Client disconnected from {peer.host}:{peer.port}")
-            del self.factory.clients[peer.host]
-
-    def lineReceived(self, line):
-        line = line.decode('utf-8')
-        if line.startswith("/disconnect"):
-            self.disconnectClient()
-        elif line.startswith("/exit"):
-            reactor.stop()
-        elif line.startswith("/send"):
-            self.sendToClient(line)
-        elif line.startswith("/broadcast"):
-            self.broadcastMessage(line)
-        elif line.startswith("/help"):
-            self.showHelp()
-        elif line.startswith("/connect"):
-            self.connectToServer(line)
-        elif line.startswith("/publickey"):
-            self.showPublicKey()
+            logger.log(f"Client disconnected from {peer.host}:{peer.port}")
+            self.factory.metrics.inc("disconnections_total")
+            for room in self.session.rooms:
+                self.factory.senderKeys.rekey(room)
+            self.factory.senderKeys.rekey(EVERYONE)
+            self.factory.rooms.leaveAll(self.session)
+            self.factory.registry.unregister(self.session)
+        self.factory.fanout.detach(self)
+
+    def sendHistory(self, rows):
+        # History is only ever sent to its owner, so it goes encrypted like /send
+        for message_id, sender, timestamp, message in reversed(rows):
+            self.deliverEncrypted(f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}] {sender}: {message}")
+        self.withKeys(self.historyEnd, rows)
+
+    def historyEnd(self, keys, rows):
+        if rows:
+            self.sendLine(f"Older messages: /history {rows[-1][2]}:{rows[-1][0]}".encode('utf-8'))
         else:
-            print(f"Received message: {line}")
-            self.broadcast(line)
-
-    def sendToClient(self, line):
-        parts = line.split(" ", 2)
-        if len(parts) == 3:
-            dest_ip, message = parts[1:]
-            client = self.factory.clients.get(dest_ip)
-            if client:
-                encrypted_message = encrypt_message(client.public_key, message)
-                client.sendLine(encrypted_message)
-            else:
-                self.sendLine(f"Client with IP {dest_ip} not found.".encode('utf-8'))
+            self.sendLine(b"No more messages.")
+
+    def renamed(self, name):
+        self.factory.senderKeys.forget(self.session.conn_id)
+        super().renamed(name)
+
+    def joinRoom(self, room):
+        if room not in self.session.rooms:
+            self.factory.senderKeys.rekey(room)
+        self.factory.rooms.join(self.session, room)
+        self.sendLine(f"Joined {room}".encode('utf-8'))
+
+    def leaveRoom(self, room):
+        if room not in self.session.rooms:
+            raise UsageError(room)
+        self.factory.rooms.leave(self.session, room)
+        self.factory.senderKeys.rekey(room)
+        self.sendLine(f"Left {room}".encode('utf-8'))
+
+    def messageRoom(self, room, message):
+        if room not in self.session.rooms:
+            raise UsageError(room)
+        # Not kept for the room's history: new members have no key for what came before
+        self.factory.publishGroup(room, self.factory.registry.members(room), self.session.conn_id, self.session.user,
+                                  message)
+        self.factory.rooms.record(room)
+
+    def deliverEncrypted(self, message):
+        self.withKeys(lambda keys: self.sendEncrypted(keys[1], message))
+
+    def sendEncrypted(self, public_key, message):
+        # The first message to a key wraps a fresh session key with RSA/OAEP on a crypto
+        # thread, every message after that is sealed with the session's AES-GCM cipher.
+        # AES-GCM takes microseconds, less than a hop to the pool, so it stays inline;
+        # messages sent while the session is being set up wait for it in order.
+        self.sessionFor(public_key).addCallback(self.sendSessionMessage, message)
+
+    def sessionFor(self, public_key):
+        # The Deferred session with this key; callbacks added to it must return the session
+        if self.sessions is None:
+            self.sessions = {}
+        session = self.sessions.get(public_key)
+        if session is None:
+            session = self.sessions[public_key] = self.factory.crypto.run("new_session", new_session, public_key)
+            session.addCallbacks(self.sessionOpened, self.sessionFailed, errbackArgs=(public_key,))
+        return session
+
+    def sessionOpened(self, result):
+        session, wrapped_key = result
+        self.sendFrame(FRAME_SESSION_KEY, wrapped_key)
+        return session
+
+    def sessionFailed(self, failure, public_key):
+        self.sessions.pop(public_key, None)
+        logger.log(f"Dropped encrypted messages for {self.session.user}: {failure.getErrorMessage()}")
+
+    def sendSessionMessage(self, session, message):
+        if session is not None:
+            message, flags = self.packed(message)
+            self.sendFrame(FRAME_SESSION_MESSAGE, session.encrypt(message), flags)
+        return session
+
+    # Room messages and broadcasts are encrypted once per message with a sender key
+    # (see senderkeys.py) instead of once per recipient. A sender key reaches each
+    # member over the member's own session, like a /send message.
+    def announceKey(self, key):
+        self.keyPair().addCallback(self.announceWithKeys, key)
+
+    def announceWithKeys(self, keys, key):
+        if keys is None:
+            key.miss(self)
         else:
-            self.sendLine("Invalid command usage. Use /send <IP> <message>".encode('utf-8'))
-
-    def showHelp(self):
-        help_message = """Available commands:
-                        /exit: Stop the server
-                        /send <IP>: Send a message to a specific client
-                        /broadcast <message>: Send a message to all connected clients
-                        /help: Show this help message
-                        /connect <IP> <port>: Connect to a server
-                        /publickey: Display your public key"""
-        self.sendLine(help_message.encode('utf-8'))
-
-    def broadcastMessage(self, line):
-        message = line[len("/broadcast"):].strip()  # Extract the message from the command
-        self.broadcast(message.encode('utf-8'))
+            self.sessionFor(keys[1]).addCallback(self.sendKeyAnnouncement, key)
+        return keys
 
-    def broadcast(self, message):
-        message_str = message.decode('utf-8')  # Convert bytes to string
-        for client in self.factory.clients.values():
-            client.sendLine(message_str.encode('utf-8'))  # Send the string message
-
-    def disconnectClient(self):
-        self.transport.loseConnection()
-
-    def connectToServer(self, line):
-        parts = line.split(" ")
-        if len(parts) == 3:
-            ip, port = parts[1], int(parts[2])
-            reactor.connectTCP(ip, port, self.factory.getClientProtocol(self.private_key))
+    def sendKeyAnnouncement(self, session, key):
+        if session is None:
+            key.miss(self)
         else:
-            self.sendLine("Invalid command usage. Use /connect <IP> <port>".encode('utf-8'))
+            self.factory.senderKeys.announced += 1
+            self.sendFrame(FRAME_GROUP_KEY, session.encrypt(key.announcement()))
+        return session
+
+    # The recipient's side of a transfer. Every (re)start of it gets a fresh random
+    # prefix, from which it and the client derive a stream key from their session key;
+    # the offer carrying the prefix is sealed like a /send message, and every chunk
+    # with the stream's ChunkCipher. Chunks cannot go out with os.sendfile, since each
+    # is encrypted on its way.
+    def startTransfer(self, transfer):
+        self.withKeys(lambda keys: self.sessionFor(keys[1]).addCallback(self.streamFile, transfer))
+
+    def streamFile(self, session, transfer):
+        if session is None:
+            transfer.interrupted()
+            return session
+        prefix = os.urandom(16)
+        transfer.cipher = session.chunk_cipher(prefix)
+        offer = f"{transfer.id} {transfer.size} {transfer.offset} {transfer.digest} {prefix.hex()} {transfer.name}"
+        self.sendFrame(FRAME_FILE_OFFER, session.encrypt(offer))
+        self.factory.fanout.stream(self, transfer)
+        return session
+
+    def sendFileChunk(self, transfer, offset, length):
+        data = os.pread(transfer.file.fileno(), length, offset)
+        sealed = transfer.cipher.seal(data, offset, offset + length >= transfer.size)
+        # Written directly: the fan-out queue calls this once its queued frames are out
+        FrameReceiver.sendFrame(self, FRAME_FILE_CHUNK, TRANSFER_ID.pack(transfer.id) + sealed)
+        return 0
+
+    def endTransfer(self, transfer):
+        self.sendFrame(FRAME_FILE_END, TRANSFER_ID.pack(transfer.id))
+
+    def broadcast(self, message):
+        # Sealed and framed once, the same bytes are queued to every client
+        sender_id, sender = (self.session.conn_id, self.session.user) if self.session else (0, "console")
+        self.factory.publishGroup(EVERYONE, list(self.factory.registry), sender_id, sender, message)
+
+    def connectToServer(self, ip, port):
+        self.withKeys(lambda keys: self.factory.connectToNode(ip, port, keys[0]))
 
     def showPublicKey(self):
-        self.sendLine(f"Your public key is: {self.public_key}".encode('utf-8'))
+        self.withKeys(lambda keys: self.sendLine(f"Your public key is: {keys[1]}".encode('utf-8')))
 
-class ChatFactory(protocol.Factory):
-    def __init__(self, server_ip, server_port, private_key):
-        self.clients = {}
+class ChatFactory(ChatFactoryBase, protocol.Factory):
+    protocol = ChatProtocol
+
+    def __init__(self, server_ip, server_port, identity, pool_size=8, history=0, store=None, crypto_threads=4,
+                 max_clients=0, idle_timeout=0, files_dir=None, max_transfers=MAX_TRANSFERS, compress=None, batch_ms=0):
+        self.registry = ClientRegistry(on_user_joined=self.announce)
+        self.max_clients = max_clients
+        self.reaper = IdleReaper(self.registry, idle_timeout)
         self.server_ip = server_ip
         self.server_port = server_port
-        self.private_key = private_key
+        self.private_key, self.public_key = identity
+        self.keyPool = KeyPool(pool_size)
+        self.crypto = CryptoExecutor(crypto_threads)
+        self.compression = Compression(compress, batch_ms)
+        self.fanout = FanOut(delay=batch_ms / 1000)
+        self.files_dir = files_dir
+        self.transfers = TransferManager(self.fanout, max_transfers)
+        self.rooms = RoomRouter(self.registry, self.fanout, history)
+        self.senderKeys = SenderKeys()
+        self.links = {}
+        self.store = store
+        self.accounts = Accounts(store)
+        self.profiler = SamplingProfiler()
+        self.metrics = node_metrics(self)
+        self.metrics.gauge("crypto_pending", lambda: self.crypto.pending)
+        self.metrics.gauge("crypto_shed_total", lambda: self.crypto.shed, "counter")
+        self.metrics.gauge("key_pool_ready", self.keyPool.qsize)
+        self.metrics.histogramSet("crypto_seconds", self.crypto.latency, "operation")
+        self.metrics.gauge("sender_keys_created_total", lambda: self.senderKeys.created, "counter")
+        self.metrics.gauge("sender_keys_announced_total", lambda: self.senderKeys.announced, "counter")
+        self.metrics.gauge("group_messages_sealed_total", lambda: self.senderKeys.sealed, "counter")
+
+    def startFactory(self):
+        super().startFactory()
+        self.keyPool.start()
+        self.crypto.start()
+
+    def stopFactory(self):
+        super().stopFactory()
+        self.keyPool.stop()
+        self.crypto.stop()
+
+    def findClients(self, user):
+        return self.registry.byUser(user) or self.registry.byFingerprint(user)
+
+    def deliver(self, user, message):
+        clients = self.findClients(user)
+        for client in clients:
+            client.deliverEncrypted(message)
+        return bool(clients)
+
+    route = deliver  # no workers or other nodes to reach users through
+
+    def publishGroup(self, group, members, sender_id, sender, message):
+        # Sends one message to the members of a group, sealed with the sender's key for
+        # it: once per codec the members use, most often once. A new key is announced to
+        # the members first, and one that did not reach some of them is announced to
+        # those again.
+        key, new = self.senderKeys.key(group, sender_id, sender)
+        if new:
+            for member in members:
+                member.announceKey(key)
+        elif key.missed:
+            missed, key.missed = key.missed, None
+            for member in missed:
+                member.announceKey(key)
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        recipients = {}
+        for member in members:
+            clients = recipients.get(member.codec)
+            if clients is None:
+                clients = recipients[member.codec] = []
+            clients.append(member)
+        for codec, clients in recipients.items():
+            self.fanout.publish(clients, self.groupFrame(key, codec, message))
+
+    def groupFrame(self, key, codec, message):
+        flags = 0
+        if codec is not None:
+            packed = self.compression.pack(codec, message)
+            if packed is not None:
+                message, flags = packed, FLAG_COMPRESSED
+        self.senderKeys.sealed += 1
+        return encode_frame(FRAME_GROUP_MESSAGE, key.seal(message), flags)
+
+    def getClientFactory(self, private_key):
+        return ChatClientFactory(private_key, self.crypto)
+
+    def connectToNode(self, ip, port, private_key):
+        # One persistent, reconnecting link per node and key instead of a new one per /connect
+        address = (ip, port, private_key)
+        if address not in self.links:
+            self.links[address] = self.getClientFactory(private_key)
+            reactor.connectTCP(ip, port, self.links[address])
+        return self.links[address]
+
+class ChatConsoleProtocol(ChatConsoleBase, ChatProtocol, protocol.Protocol):
+    commands = ChatProtocol.commands.copy("/exit", "/send", "/sendfile", "/broadcast", "/connect", "/publickey", "/stats",
+                                          "/help")
+    commands.add("/sendkey", "sendWithKey", [str, str], payload=True, usage="/sendkey <public_key> <user> <message>",
+                 help="Send a message to a user, encrypted for the given public key")
+    add_profile_command(commands)
 
-    def buildProtocol(self, addr):
-        return ChatProtocol(self)
+    def __init__(self, factory):
+        super().__init__(factory)
+        # The console speaks for the node itself, so it uses the node identity
+        self._keys = defer.succeed((factory.private_key, factory.public_key))
+
+    def sendLine(self, line):
+        self.transport.write(line + b"\n")  # The console gets plain text, not frames
+
+    def sendWithKey(self, public_key, user, message):
+        clients = self.factory.findClients(user)
+        for client in clients:
+            client.sendEncrypted(public_key, message)
+        if self.factory.keeps(user):
+            self.factory.store.store("console", user, bytes(message), bool(clients))
+        if clients:
+            return
+        if self.factory.keeps(user):
+            print(f"{user} is offline, the message will be delivered when they reconnect.")
+        else:
+            print(f"User {user} not found.")
 
-    def getClientProtocol(self, private_key):
-        return ChatClientProtocol(private_key)
+class ChatClientFactory(protocol.ReconnectingClientFactory):
+    maxDelay = 30
+    initialDelay = 0.5
 
-class ChatConsoleProtocol(ChatProtocol, protocol.Protocol):
-    def connectionMade(self):
-        self.transport.write(b">>> ")  # Write prompt symbol when connection is made
-
-    def dataReceived(self, data):
-        command = data.strip().decode("utf-8")  # Decode bytes to string and remove leading/trailing whitespace
-        if command == "/exit":
-            reactor.stop()  # Stop the server
-        elif command.startswith("/send"):
-            self.prepareMessage(command)
-        elif command.startswith("/help"):
-            super().showHelp()
-        elif command.startswith("/broadcast"):
-            self.broadcastMessage(command)
-        elif command.startswith("/connect"):
-            super().connectToServer(command)
-        elif command.startswith("/publickey"):
-            super().showPublicKey()
-        else:
-            print("Unknown command. Type '/help' to see the list of valid commands.")
-        self.transport.write(b">>> ")  # Write prompt symbol again after handling command
-
-    def prepareMessage(self, command):
-        parts = command.split(" ", 3)
-        if len(parts) == 4:
-            public_key_client, ip_client, message_client = parts[1:]
-            client = self.factory.clients.get(ip_client)
-            if client:
-                encrypted_message = encrypt_message(public_key_client, message_client)
-                client.sendLine(encrypted_message)
-            else:
-                print(f"Client with IP {ip_client} not found.")
-        else:
-            print("Invalid command usage. Use /send <public_key> <IP> <message>")
+    def __init__(self, private_key, crypto):
+        self.private_key = private_key
+        self.crypto = crypto
 
-class ChatClientFactory(protocol.ClientFactory):
     def buildProtocol(self, addr):
-        return ChatClientProtocol(self.private_key)
+        self.resetDelay()
+        return ChatClientProtocol(self.private_key, self.crypto)
 
     def clientConnectionFailed(self, connector, reason):
         print("Connection failed")
+        super().clientConnectionFailed(connector, reason)
 
-class ChatClientProtocol(protocol.ClientFactory):
-    def __init__(self, private_key):
+class ChatClientProtocol(FrameReceiver):
+    def __init__(self, private_key, crypto, directory="."):
         self.private_key = private_key
-
-    def buildProtocol(self, addr):
-        return self
+        self.crypto = crypto
+        # Fires with the current session; session messages queue behind an RSA unwrap
+        self.session = defer.succeed(None)
+        self.files = FileReceiver(directory)
+        self.groupKeys = GroupKeyRing()
+        self.codec = None
 
     def connectionMade(self):
         print("Connected to server")
 
-    def dataReceived(self, data):
-        received_message = decrypt_message(self.private_key, data)
-        if received_message:
-            print(f"Received message: {received_message}")
+    def frameReceived(self, frame_type, flags, payload):
+        if frame_type == FRAME_TEXT:
+            self.textReceived(self.unpacked(bytes(payload), flags))
+        elif frame_type == FRAME_SESSION_KEY:
+            wrapped_key = bytes(payload)
+            self.session.addCallback(lambda session: self.crypto.run("open_session", open_session,
+                                                                     self.private_key, wrapped_key))
+            self.session.addErrback(self.sessionFailed)
+        elif frame_type == FRAME_SESSION_MESSAGE:
+            self.session.addCallback(self.showMessage, bytes(payload), flags)
+        elif frame_type == FRAME_FILE_OFFER:
+            self.session.addCallback(self.fileOffered, bytes(payload))
+        elif frame_type == FRAME_FILE_CHUNK:
+            self.session.addCallback(self.fileChunk, bytes(payload))
+        elif frame_type == FRAME_FILE_END:
+            self.session.addCallback(self.fileDone, TRANSFER_ID.unpack_from(payload)[0])
+        elif frame_type == FRAME_GROUP_KEY:
+            self.session.addCallback(self.groupKeyAnnounced, bytes(payload))
+        elif frame_type == FRAME_GROUP_MESSAGE:
+            # Behind the session too, so it is opened after the announcements before it
+            self.session.addCallback(self.showGroupMessage, bytes(payload), flags)
+
+    def textReceived(self, text):
+        # Asks for the best compression the server offers, and for batching
+        if text is None:
+            return
+        if text.startswith(b"/hello "):
+            token, request, codec = caps_request(text)
+            self.sendFrame(FRAME_TEXT, request)
+        elif text.startswith(b"/caps "):
+            self.codec = CODECS.get(parse_caps(text)[1].get("compress"))
+        else:
+            print(f"Received message: {text.decode('utf-8')}")
+
+    def unpacked(self, message, flags):
+        # The message as sent, or None if it was compressed and does not decompress
+        if message is None or not flags & FLAG_COMPRESSED:
+            return message
+        if self.codec is None:
+            return None
+        return self.codec.unpack(message, self.MAX_LENGTH)
+
+    def fileOffered(self, session, payload):
+        offer = session.decrypt(payload) if session is not None else None
+        if offer is not None:
+            transfer_id, size, offset, digest, prefix, name = offer.decode('utf-8').split(" ", 5)
+            incoming = self.files.offer(int(transfer_id), name, int(size), int(offset), digest)
+            if incoming is None:
+                print(f"Cannot resume {name}: the part received before is gone")
+            else:
+                incoming.cipher = session.chunk_cipher(bytes.fromhex(prefix))
+        return session
+
+    def fileChunk(self, session, payload):
+        transfer_id = TRANSFER_ID.unpack_from(payload)[0]
+        incoming = self.files.files.get(transfer_id)
+        if incoming is not None and incoming.cipher is not None:
+            sealed = payload[TRANSFER_ID.size:]
+            last = incoming.offset + len(sealed) - TAG_SIZE >= incoming.size
+            data = incoming.cipher.open(sealed, incoming.offset, last)
+            if data is None:
+                incoming.cipher = None  # the rest of the stream cannot be trusted
+            else:
+                self.files.chunk(transfer_id, data)
+        return session
+
+    def fileDone(self, session, transfer_id):
+        path = self.files.done(transfer_id)
+        print(f"Received file {path}" if path else f"Transfer {transfer_id} arrived damaged")
+        return session
+
+    def showMessage(self, session, payload, flags=0):
+        if session is not None:
+            received_message = self.unpacked(session.decrypt(payload), flags)
+            if received_message is not None:
+                print(f"Received message: {received_message.decode('utf-8')}")
+        return session
+
+    def groupKeyAnnounced(self, session, payload):
+        announcement = session.decrypt(payload) if session is not None else None
+        if announcement is not None:
+            for opened in self.groupKeys.add(announcement):
+                self.printGroupMessage(*opened)
+        return session
+
+    def showGroupMessage(self, session, payload, flags=0):
+        opened = self.groupKeys.open(payload, flags)
+        if opened is not None:
+            self.printGroupMessage(*opened)
+        return session
+
+    def printGroupMessage(self, group, sender, message, flags):
+        message = self.unpacked(message, flags)
+        if message is None:
+            return
+        if group == EVERYONE:
+            print(f"Received message: {sender}: {message.decode('utf-8')}")
+        else:
+            print(f"Received message: {group} {sender}: {message.decode('utf-8')}")
+
+    def sessionFailed(self, failure):
+        print(f"Could not open the session: {failure.getErrorMessage()}")
 
     def connectionLost(self, reason):
         print("Connection lost")
@@ -201,9 +535,22 @@ def main():
     server_ip = input("Enter server IP: ")
     server_port = int(input("Enter the port number (Use 9000 for testing): "))
 
-    factory = ChatFactory(server_ip, server_port, get_password())
+    try:
+        identity = load_identity(IDENTITY_FILE, get_password())
+    except ValueError:
+        print(f"Could not unlock {IDENTITY_FILE}: wrong password?")
+        return
+    for plugin in PLUGINS:
+        ChatProtocol.commands.load(plugin)
+    store = MessageStore(MESSAGE_DB, keyring=KEYRING_FILE) if MESSAGE_DB else None
+    factory = ChatFactory(server_ip, server_port, identity, store=store,
+                          max_clients=MAX_CLIENTS, idle_timeout=IDLE_TIMEOUT, files_dir=FILES_DIR, compress=COMPRESS,
+                          batch_ms=BATCH_MS)
     reactor.listenTCP(server_port, factory)
     print(f"Chat server started on {server_ip}:{server_port}")
+    if METRICS_PORT:
+        listen_metrics(factory.metrics, METRICS_PORT)
+        print(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
 
     stdio.StandardIO(ChatConsoleProtocol(factory))
 
@@ -0,0 +1,205 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from twisted.internet import protocol, reactor
+from framing import FrameReceiver
+
+# Frames exchanged between worker processes over their Unix socket bus
+BUS_HELLO = 16
+BUS_JOIN = 17
+BUS_LEAVE = 18
+BUS_SEND = 19
+BUS_BROADCAST = 20  # a broadcast as federation.py floods it, with its message ID
+BUS_FED_SEND = 21  # a /send that came from another node, as federation.py got it
+
+def bus_path(bus_dir, worker_id):
+    return os.path.join(bus_dir, f"worker-{worker_id}.sock")
+
+class BusLink(FrameReceiver):
+    # One direction of the link between two workers. Each worker dials every other
+    # worker and only writes on the links it dialled, while frames arriving on the links
+    # it accepted are handed to the bus.
+    def __init__(self, bus, peer_id=None):
+        self.bus = bus
+        self.peer_id = peer_id
+        self.remote_id = None
+
+    def connectionMade(self):
+        if self.peer_id is not None:
+            self.bus.linkUp(self)
+
+    def connectionLost(self, reason):
+        if self.peer_id is not None:
+            self.bus.linkDown(self)
+
+    def frameReceived(self, frame_type, flags, payload):
+        payload = bytes(payload)
+        if frame_type == BUS_HELLO:
+            self.remote_id = int(payload)
+        else:
+            self.bus.frameReceived(self.remote_id, frame_type, payload)
+
+class BusLinkFactory(protocol.ReconnectingClientFactory):
+    maxDelay = 2
+    initialDelay = 0.05
+
+    def __init__(self, bus, peer_id):
+        self.bus = bus
+        self.peer_id = peer_id
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return BusLink(self.bus, self.peer_id)
+
+class BusServerFactory(protocol.Factory):
+    def __init__(self, bus):
+        self.bus = bus
+
+    def buildProtocol(self, addr):
+        return BusLink(self.bus)
+
+class WorkerBus:
+    # Routes /send and /broadcast between the workers of one server. Every worker
+    # announces the clients it holds, so a /send goes straight to the workers that have
+    # a connection of the recipient (a user can be connected to several) and a broadcast
+    # is forwarded once to each other worker.
+    def __init__(self, factory, worker_id, workers, bus_dir):
+        self.factory = factory
+        self.worker_id = worker_id
+        self.workers = workers
+        self.bus_dir = bus_dir
+        self.links = {}
+        self.directory = {}  # user -> IDs of the other workers holding a connection of theirs
+        self.forwarded = 0
+        factory.bus = self
+        factory.accounts.elsewhere = self.directory
+
+    def start(self):
+        path = bus_path(self.bus_dir, self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        reactor.listenUNIX(path, BusServerFactory(self))
+        for peer_id in range(self.workers):
+            if peer_id != self.worker_id:
+                reactor.connectUNIX(bus_path(self.bus_dir, peer_id), BusLinkFactory(self, peer_id))
+
+    def linkUp(self, link):
+        self.links[link.peer_id] = link
+        link.sendFrame(BUS_HELLO, str(self.worker_id).encode())
+        for user in self.factory.registry.users:
+            link.sendFrame(BUS_JOIN, user.encode('utf-8'))
+
+    def linkDown(self, link):
+        if self.links.get(link.peer_id) is link:
+            del self.links[link.peer_id]
+            for user in [user for user, peer_ids in self.directory.items() if link.peer_id in peer_ids]:
+                self.forget(user, link.peer_id)
+
+    def announce(self, frame_type, user):
+        payload = user.encode('utf-8')
+        for link in self.links.values():
+            link.sendFrame(frame_type, payload)
+
+    def join(self, user):
+        self.announce(BUS_JOIN, user)
+
+    def leave(self, user):
+        self.announce(BUS_LEAVE, user)
+
+    def send(self, user, message):
+        return self.sendTo(user, BUS_SEND, user.encode('utf-8') + b"\0" + message)
+
+    def relaySend(self, user, payload):
+        # A /send from another node, for the user's connections on the other workers
+        return self.sendTo(user, BUS_FED_SEND, payload)
+
+    def sendTo(self, user, frame_type, payload):
+        links = [self.links[peer_id] for peer_id in self.directory.get(user, ()) if peer_id in self.links]
+        for link in links:
+            self.forwarded += 1
+            link.sendFrame(frame_type, payload)
+        return bool(links)
+
+    def forget(self, user, peer_id):
+        peer_ids = self.directory.get(user)
+        if peer_ids is not None:
+            peer_ids.discard(peer_id)
+            if not peer_ids:
+                del self.directory[user]
+                if user not in self.factory.registry.users:
+                    self.factory.federation.leave(user)
+
+    def broadcast(self, message):
+        self.forwarded += len(self.links)
+        for link in self.links.values():
+            link.sendFrame(BUS_BROADCAST, message)
+
+    def frameReceived(self, peer_id, frame_type, payload):
+        if frame_type == BUS_SEND:
+            user, message = payload.split(b"\0", 1)
+            self.factory.deliver(user.decode('utf-8'), message)
+        elif frame_type == BUS_FED_SEND:
+            self.factory.federation.sent(payload)
+        elif frame_type == BUS_BROADCAST:
+            self.factory.federation.relay(payload, None)
+        elif frame_type == BUS_JOIN:
+            user = payload.decode('utf-8')
+            if user not in self.directory and user not in self.factory.registry.users:
+                self.factory.federation.join(user)  # other nodes reach them through this worker too
+            self.directory.setdefault(user, set()).add(peer_id)
+        elif frame_type == BUS_LEAVE:
+            self.forget(payload.decode('utf-8'), peer_id)
+
+def listening_socket(server_ip, server_port, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((server_ip, server_port))
+    sock.listen(backlog)
+    # Shared by every worker's reactor, so accept must never block
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+def supervise(script, server_ip, server_port, workers, extra_args=()):
+    # Binds the listening socket once and starts the workers, which all accept from it.
+    # Stopping any worker (for example with /exit) stops the whole server.
+    sock = listening_socket(server_ip, server_port)
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    children = []
+    for worker_id in range(workers):
+        command = [sys.executable, os.path.abspath(script), "--ip", server_ip, "--port", str(server_port),
+                   "--workers", str(workers), "--worker-id", str(worker_id),
+                   "--listen-fd", str(sock.fileno()), "--bus-dir", bus_dir, *extra_args]
+        children.append(subprocess.Popen(command, pass_fds=[sock.fileno()], stdin=subprocess.DEVNULL))
+    sock.close()
+    print(f"Chat server started on {server_ip}:{server_port} with {workers} workers")
+
+    def stop(signum=None, frame=None):
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while all(child.poll() is None for child in children):
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop()
+        for child in children:
+            child.wait()
+        for worker_id in range(workers):
+            if os.path.exists(bus_path(bus_dir, worker_id)):
+                os.unlink(bus_path(bus_dir, worker_id))
+        os.rmdir(bus_dir)
+
+def run_worker(factory, listen_fd, worker_id, workers, bus_dir):
+    reactor.adoptStreamPort(listen_fd, socket.AF_INET, factory)
+    os.close(listen_fd)
+    WorkerBus(factory, worker_id, workers, bus_dir).start()
+    reactor.run()